@@ -0,0 +1,414 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Run the data acquisition without the GUI, for rigs that record unattended.  The same PlantUSB and StreamingData
+pipeline as the GUI is used, but nothing is drawn and no tk window or matplotlib is made.
+
+Each device is read by a DevicePipeline, which stands in for the tk root PlantUSB is given: it has the device's
+data class as .data and after and after_cancel methods, which are run by the AcquisitionDaemon's event loop.  With
+all_devices every connected device gets a pipeline and they all share the one event loop, each recording to its
+own raw file, e.g. 171017_120000_device0.raw.  The adc buffers of each device are time stamped against the host
+clock as they are read (see clock_sync.py) and when the recording is stopped they are merged into one .plant file
+with the channels of every device on the same sample times, e.g. 171017_120000.plant.
+
+The event loop waits on a control socket for commands until the next timer is due.  A client connects, sends one
+line with a command and gets one line of json back:
+
+start [filename]   start reading the device and recording to filename, or a new file in the data folder
+stop               stop reading and close the recording
+status             get the state of the acquisition
+quit               stop reading and end the daemon
+
+Run the daemon with
+python acquisition_daemon.py run --channels 3 [--all-devices]
+and control it from the same computer with
+python acquisition_daemon.py start
+python acquisition_daemon.py status
+python acquisition_daemon.py stop
+"""
+# standard libraries
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+# installed libraries
+import usb
+# local files
+import clock_sync
+import data_class
+import usb_comm
+
+__author__ = 'Kyle Vitautas Lopin'
+
+CONTROL_ADDRESS = ('127.0.0.1', 50555)  # only takes connections from this computer
+FLUSH_INTERVAL = 10000  # ms, between flushing the recording to disk
+MAX_COMMAND_SIZE = 4096  # bytes, a longer command line is not accepted
+STOP_TIMEOUT = 2.0  # s, to wait for the acquisition thread to stop
+
+
+class DevicePipeline(object):
+    """ The PlantUSB and data class of one device, with the after, after_cancel, data and calibrate_finish that
+    PlantUSB needs from its master.  The timers are run by the daemon's event loop """
+
+    def __init__(self, daemon, number_channels, usb_backend=usb, acquisition_mode='pipelined', usb_device=None):
+        """
+        :param daemon: AcquisitionDaemon that runs the timers
+        :param number_channels: int, adc channels to read
+        :param usb_backend: module used to find the device, the pyusb module or a usb_mock.SimulatedUSBBackend
+        :param acquisition_mode: 'pipelined', 'threaded' or 'process', see PlantUSB.acquisition_mode, the 'process'
+        mode does not time stamp the adc buffers
+        :param usb_device: device from usb_comm.find_devices, None to use the first one found
+        """
+        self.daemon = daemon
+        self.data = data_class.StreamingData()
+        self.data.set_display_mode('off')
+        self.device = usb_comm.PlantUSB(self, usb_backend=usb_backend, usb_device=usb_device)
+        self.device.acquisition_mode = acquisition_mode
+        self.clock = self.device.clock_sync  # type: clock_sync.ClockSync
+        if self.device.connected:
+            self.device.set_number_channels(number_channels)
+
+    def after(self, delay, function, *args):
+        return self.daemon.after(delay, function, *args)
+
+    def after_cancel(self, timer_id):
+        self.daemon.after_cancel(timer_id)
+
+    def calibrate_finish(self):
+        logging.info('calibration finished, gain = {0}'.format(self.device.gain))
+
+    def start(self, filename):
+        """ Start reading the device and recording to filename """
+        self.data.clear()
+        self.data.start_recording(filename)
+        self.device.start_reading()
+
+    def stop(self):
+        """ Stop reading the device, without waiting for the acquisition thread """
+        self.device.stop_reading()
+
+    def drain(self):
+        """ Wait for the acquisition thread to stop and add the adc buffers it already read to the recording """
+        acquisition = self.device.threaded_data_stream
+        if hasattr(acquisition, 'join'):
+            acquisition.join(timeout=STOP_TIMEOUT)
+        while self.device.display_scheduler.drain(self.device.data_source, self.data.extend):
+            pass
+
+    def status(self):
+        recorder = self.data.recorder
+        frames = self.data.adc_counts_read // self.data.number_channels
+        return {'connected': self.device.connected,
+                'channels': self.data.number_channels,
+                'recording': recorder.filename if recorder else None,
+                'seconds recorded': frames / data_class.SAMPLE_RATE,
+                'clock': self.clock.stats(),
+                'drain': self.device.display_scheduler.stats(),
+                'usb commands': self.device.command_writer.stats() if self.device.command_writer else None}
+
+
+class AcquisitionDaemon(object):
+    """ Event loop that runs the timers of the device pipelines and the commands from the control socket """
+
+    def __init__(self, number_channels=1, data_folder='data', control_address=CONTROL_ADDRESS, usb_backend=usb,
+                 acquisition_mode='pipelined', all_devices=False):
+        """
+        :param number_channels: int, adc channels to read from each device
+        :param data_folder: str, folder the recordings are made in
+        :param control_address: (host, port) of the tcp control socket, or a str path of a unix socket
+        :param usb_backend: module used to find the device, the pyusb module or a usb_mock.SimulatedUSBBackend
+        :param acquisition_mode: 'pipelined', 'threaded' or 'process', see PlantUSB.acquisition_mode
+        :param all_devices: True to read every connected device, False to read only the first one found
+        """
+        self.data_folder = data_folder
+        self.control_address = control_address
+        self.timers = []  # heap of [time due, timer id, function, args]
+        self.cancelled_timers = set()
+        self.next_timer_id = 0
+        self.running = False  # the event loop
+        self.reading = False  # the devices
+        self.flush_timer = None
+        self.start_time = None  # time.time() reading was started
+        self.merged_filename = None  # .plant file the recordings of all the devices are merged into
+        self.merged = None  # metadata of the last merged recording
+        self.selector = selectors.DefaultSelector()
+        usb_devices = usb_comm.find_devices(usb_backend) if all_devices else [None]
+        if all_devices and acquisition_mode != 'pipelined':
+            logging.info("only the 'pipelined' acquisition mode time stamps the adc buffers, it is used instead")
+            acquisition_mode = 'pipelined'
+        self.pipelines = [DevicePipeline(self, number_channels, usb_backend, acquisition_mode, usb_device)
+                          for usb_device in usb_devices]
+
+    def connected(self):
+        return bool(self.pipelines) and all(pipeline.device.connected for pipeline in self.pipelines)
+
+    def after(self, delay, function, *args):
+        """ Call function(*args) after delay ms, the same as tk.after
+        :return: int, id to cancel it with
+        """
+        timer_id = self.next_timer_id
+        self.next_timer_id += 1
+        heapq.heappush(self.timers, [time.perf_counter() + delay / 1000., timer_id, function, args])
+        return timer_id
+
+    def after_cancel(self, timer_id):
+        self.cancelled_timers.add(timer_id)
+
+    def start(self, filename=None):
+        """ Start reading the devices and recording to a file, with several devices each is recorded to its own
+        file named by adding _device# to filename
+        :param filename: str, file to record to, if None a file named by the time is made in the data folder
+        :return: dict of the status
+        """
+        if not self.connected():
+            raise IOError("The device is not connected")
+        if self.reading:
+            raise ValueError("Already reading")
+        if not filename:
+            if not os.path.exists(self.data_folder):
+                os.makedirs(self.data_folder)
+            filename = os.path.join(self.data_folder,
+                                    '{0:%y%m%d_%H%M%S}.raw'.format(datetime.datetime.now()))
+        if len(self.pipelines) == 1:
+            self.merged_filename = None
+            self.pipelines[0].start(filename)
+        else:
+            base_filename = os.path.splitext(filename)[0]
+            self.merged_filename = base_filename + '.plant'
+            for i, pipeline in enumerate(self.pipelines):
+                pipeline.start('{0}_device{1}.raw'.format(base_filename, i))
+        self.merged = None
+        self.reading = True
+        self.start_time = time.time()
+        self.flush_timer = self.after(FLUSH_INTERVAL, self.flush)
+        return self.status()
+
+    def stop(self):
+        """ Stop reading the devices, add the adc buffers already read to the recordings and close them, then merge
+        the recordings if there are several devices
+        :return: dict of the status
+        """
+        if not self.reading:
+            return self.status()
+        for pipeline in self.pipelines:  # stop them all before waiting for any, so they stop at about the same time
+            pipeline.stop()
+        self.after_cancel(self.flush_timer)
+        for pipeline in self.pipelines:
+            pipeline.drain()
+        self.reading = False
+        status = self.status()
+        recordings = [(pipeline.data.recorder.filename, pipeline.clock) for pipeline in self.pipelines]
+        for pipeline in self.pipelines:
+            pipeline.data.stop_recording()
+        if self.merged_filename:
+            try:
+                self.merged = clock_sync.merge_recordings(recordings, self.merged_filename, data_class.SAMPLE_RATE)
+                status['merged'] = self.merged
+            except ValueError as error:
+                logging.error('recordings not merged: {0}'.format(error))
+        logging.info('recording stopped: {0}'.format(status))
+        return status
+
+    def flush(self):
+        for pipeline in self.pipelines:
+            pipeline.data.flush_recording()
+        self.flush_timer = self.after(FLUSH_INTERVAL, self.flush)
+
+    def status(self):
+        """ Get the state of the acquisition
+        :return: dict that can be written as json
+        """
+        return {'connected': self.connected(),
+                'reading': self.reading,
+                'devices': [pipeline.status() for pipeline in self.pipelines],
+                'merged recording': self.merged_filename,
+                'seconds running': time.time() - self.start_time if self.reading else 0,
+                'cpu seconds': time.process_time(),
+                'memory MB': resident_memory()}
+
+    def handle_command(self, line):
+        """ Run a command from the control socket
+        :param line: str, command and its argument
+        :return: dict to send back
+        """
+        command, _, argument = line.strip().partition(' ')
+        try:
+            if command == 'start':
+                return {'ok': True, 'status': self.start(argument.strip() or None)}
+            elif command == 'stop':
+                return {'ok': True, 'status': self.stop()}
+            elif command == 'status':
+                return {'ok': True, 'status': self.status()}
+            elif command == 'quit':
+                self.running = False
+                return {'ok': True, 'status': self.stop()}
+            return {'ok': False, 'error': 'unknown command: {0}'.format(command)}
+        except (IOError, ValueError) as error:
+            return {'ok': False, 'error': str(error)}
+
+    def open_control_socket(self):
+        if isinstance(self.control_address, str):
+            if os.path.exists(self.control_address):
+                os.remove(self.control_address)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.control_address)
+        server.listen(5)
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, None)
+        return server
+
+    def accept(self, server):
+        connection, _ = server.accept()
+        connection.setblocking(False)
+        self.selector.register(connection, selectors.EVENT_READ, bytearray())
+
+    def read_command(self, connection, received):
+        """ Read what a client has sent, once it has sent a whole line run the command and send the result back
+        :param connection: socket of the client
+        :param received: bytearray of what the client has sent so far
+        """
+        chunk = connection.recv(MAX_COMMAND_SIZE)
+        received.extend(chunk)
+        if chunk and b'\n' not in received and len(received) < MAX_COMMAND_SIZE:
+            return  # wait for the rest of the line
+        self.selector.unregister(connection)
+        if b'\n' in received:
+            reply = self.handle_command(received.split(b'\n')[0].decode(errors='replace'))
+            connection.setblocking(True)
+            connection.settimeout(1.0)
+            try:
+                connection.sendall((json.dumps(reply) + '\n').encode())
+            except OSError as error:
+                logging.info('control client went away: {0}'.format(error))
+        connection.close()
+
+    def run_timers(self):
+        """ Call the timers that are due
+        :return: float, s until the next timer is due, None if there are none
+        """
+        while self.timers:
+            due_time, timer_id, function, args = self.timers[0]
+            if timer_id in self.cancelled_timers:
+                heapq.heappop(self.timers)
+                self.cancelled_timers.discard(timer_id)
+                continue
+            wait_time = due_time - time.perf_counter()
+            if wait_time > 0:
+                return wait_time
+            heapq.heappop(self.timers)
+            function(*args)
+        return None
+
+    def mainloop(self):
+        """ Run the timers and the control socket until a quit command, a keyboard interrupt or a SIGTERM """
+        server = self.open_control_socket()
+        logging.info('acquisition daemon listening on {0}'.format(self.control_address))
+        self.running = True
+        try:
+            while self.running:
+                wait_time = self.run_timers()
+                for key, _ in self.selector.select(timeout=1.0 if wait_time is None else wait_time):
+                    if key.data is None:
+                        self.accept(key.fileobj)
+                    else:
+                        self.read_command(key.fileobj, key.data)
+        except KeyboardInterrupt:
+            logging.info('acquisition daemon interrupted')
+        finally:
+            self.stop()
+            self.selector.close()
+            server.close()
+            if isinstance(self.control_address, str) and os.path.exists(self.control_address):
+                os.remove(self.control_address)
+
+
+def send_command(command, control_address=CONTROL_ADDRESS, timeout=5.0):
+    """ Send a command to a running daemon
+    :param command: str, command line, e.g. 'start' or 'status'
+    :param control_address: (host, port) or str path of the daemon's control socket
+    :param timeout: float, s to wait for the reply
+    :return: dict of the reply
+    """
+    family = socket.AF_UNIX if isinstance(control_address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(control_address)
+        connection.sendall((command.strip() + '\n').encode())
+        reply = bytearray()
+        while not reply.endswith(b'\n'):
+            chunk = connection.recv(MAX_COMMAND_SIZE)
+            if not chunk:
+                break
+            reply.extend(chunk)
+    return json.loads(reply.decode())
+
+
+def resident_memory():
+    """ Get the resident memory of this process, from /proc on linux
+    :return: float, MB, or None if it can not be found
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def parse_control_address(address):
+    """ Get the control address from the command line, host:port for tcp or a path for a unix socket """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record the data acquisition device without the GUI")
+    parser.add_argument('command', choices=['run', 'start', 'stop', 'status', 'quit'],
+                        help="run the daemon, or send it a command")
+    parser.add_argument('filename', nargs='?', help="file to record to for start")
+    parser.add_argument('--control', default='{0}:{1}'.format(*CONTROL_ADDRESS),
+                        help="host:port or unix socket path of the control socket")
+    parser.add_argument('--channels', type=int, default=1, help="adc channels to read")
+    parser.add_argument('--data-folder', default='data', help="folder to make the recordings in")
+    parser.add_argument('--acquisition-mode', default='pipelined', choices=['pipelined', 'threaded', 'process'])
+    parser.add_argument('--all-devices', action='store_true',
+                        help="read every connected device and merge their recordings")
+    parser.add_argument('--simulate', type=int, nargs='?', const=1, default=0, metavar='DEVICES',
+                        help="read simulated devices instead of the usb ones")
+    args = parser.parse_args(argv)
+    control_address = parse_control_address(args.control)
+    if args.command != 'run':
+        command = args.command + (' ' + os.path.abspath(args.filename) if args.filename else '')
+        reply = send_command(command, control_address)
+        print(json.dumps(reply, indent=2))
+        return 0 if reply.get('ok') else 1
+    logging.basicConfig(format='%(asctime)s %(module)s %(lineno)d: %(levelname)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+    usb_backend = usb
+    if args.simulate:
+        import usb_mock
+        usb_backend = usb_mock.SimulatedUSBBackend(number_devices=args.simulate)
+    daemon = AcquisitionDaemon(args.channels, args.data_folder, control_address, usb_backend,
+                               args.acquisition_mode, args.all_devices)
+    if not daemon.connected():
+        logging.error("The device is not connected")
+        return 1
+    # stop reading and close the recording when the service manager stops the daemon
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: setattr(daemon, 'running', False))
+    daemon.mainloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
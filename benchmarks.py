@@ -0,0 +1,894 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Micro benchmarks for the data acquisition and display pipeline, run with
+python benchmarks.py [recording] [--soak HOURS]
+the soak test only streams SOAK_HOURS unless --soak is given, e.g. --soak 24 for a full day
+"""
+# standard libraries
+import argparse
+import array
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+# installed libraries
+import numpy as np
+# local files
+import acquisition_daemon
+import calibration
+import data_class
+import epochs
+import event_detector
+import raw_recorder
+import recording_format
+import running_stats
+import stimulation_protocol
+import stream_filter
+import usb_comm
+import usb_mock
+from usb_constants import *
+
+__author__ = 'Kyle Vitautas Lopin'
+
+ADC_BUFFER_SIZE = 4082  # adc counts in a buffer read from the device
+NUMBER_BUFFERS = 200
+SOAK_HOURS = 0.25  # hours of data the soak test streams unless --soak is given
+
+
+def legacy_sample_signal(data, data_packet, skip):
+    """ The original per sample loop of StreamingData.sample_signal, kept to check the vectorized version
+    gives the same display data and to time them against each other
+    :param data: data_class.StreamingData to update
+    :param data_packet: array of int16 adc counts, interleaved by channel
+    :param skip: int, how many frames to advance between displayed points
+    """
+    _len = len(data_packet)
+    number_channels = data.number_channels
+    while data.raw_data_ptr < _len:
+        for data_to_display in data.y_data_to_display:
+            data_to_display[data.display_data_ptr] = (data_packet[data.raw_data_ptr]
+                                                      * data.counts_to_volts)
+            data.raw_data_ptr += 1
+        data.raw_data_ptr += (skip * number_channels) - number_channels
+        data.display_data_ptr += 1
+
+    data.raw_data_ptr -= _len
+    data.end_time = data.t_data[data.display_data_ptr-1]
+
+
+def make_adc_buffers(number_buffers=NUMBER_BUFFERS, buffer_size=ADC_BUFFER_SIZE):
+    """ Make random adc buffers in the same format the usb thread puts them in the data queue
+    :param number_buffers: int, how many buffers to make
+    :param buffer_size: int, number of adc counts in each buffer
+    :return: list of array('h')
+    """
+    random_state = np.random.RandomState(42)
+    return [array.array('h', random_state.randint(-8192, 8192, buffer_size).astype(np.int16).tobytes())
+            for _ in range(number_buffers)]
+
+
+def benchmark_sample_signal(number_channels=2):
+    """ Time the per sample loop against the vectorized sample_signal over the same adc buffers and
+    check that they fill the display buffers with the same values """
+    adc_buffers = make_adc_buffers()
+    results = dict()
+    for name, sampler in [('loop', legacy_sample_signal),
+                          ('vectorized', data_class.StreamingData.sample_signal)]:
+        data = data_class.StreamingData()
+        data.number_channels = number_channels
+        data.clear()
+        data.counts_to_volts = 0.125
+        start = time.perf_counter()
+        for adc_buffer in adc_buffers:
+            sampler(data, adc_buffer, data_class.SAMPLING_RATIO)
+        run_time = time.perf_counter() - start
+        results[name] = data
+        print('sample_signal {0:>10}: {1:8.3f} ms per buffer'.format(name, 1000 * run_time / len(adc_buffers)))
+    loop_data, vector_data = results['loop'], results['vectorized']
+    assert loop_data.display_data_ptr == vector_data.display_data_ptr
+    assert loop_data.raw_data_ptr == vector_data.raw_data_ptr
+    _, vector_channels = vector_data.display_window()
+    for loop_channel, vector_channel in zip(loop_data.y_data_to_display, vector_channels):
+        assert np.array_equal(loop_channel[:loop_data.display_data_ptr], vector_channel)
+
+
+def benchmark_envelope(number_channels=2, spike_period=997):
+    """ Time the stride and min/max envelope display modes over the same adc buffers, and count how many single
+    sample spikes, added every spike_period frames, make it to the display in each mode
+    :param number_channels: int, number of channels interleaved in the adc buffers
+    :param spike_period: int, frames between spikes, not a multiple of SAMPLING_RATIO so the stride misses most
+    """
+    adc_buffers = [np.frombuffer(adc_buffer, dtype=np.int16).copy() for adc_buffer in make_adc_buffers()]
+    adc_buffers = [adc_buffer // 8 for adc_buffer in adc_buffers]  # noise of +-1024 counts
+    frame_ptr = 0
+    number_spikes = 0
+    for adc_buffer in adc_buffers:
+        spike_counts = np.arange(-frame_ptr % spike_period, len(adc_buffer) // number_channels, spike_period)
+        adc_buffer[spike_counts * number_channels] = 8000  # spike on the first channel
+        number_spikes += len(spike_counts)
+        frame_ptr += len(adc_buffer) // number_channels
+    for mode in ['stride', 'envelope']:
+        data = data_class.StreamingData()
+        data.number_channels = number_channels
+        data.clear()
+        data.set_display_mode(mode)
+        start = time.perf_counter()
+        for adc_buffer in adc_buffers:
+            data.extend(adc_buffer)
+        run_time = time.perf_counter() - start
+        spikes_shown = int(np.sum(data.display_window()[1][0] == 8000))
+        print('display {0:>8}: {1:8.3f} ms per buffer, {2} display points, {3} of {4} spikes shown'
+              .format(mode, 1000 * run_time / len(adc_buffers), data.display_data_ptr, spikes_shown,
+                      number_spikes))
+
+
+def benchmark_pyramid(recording_time=3600, number_channels=3, pixel_width=1000):
+    """ Time building the min/max pyramid as adc buffers come in, and getting ranges from 5 ms to the whole
+    recording to draw, which should take about the same time for any range
+    :param recording_time: float, seconds of data to add
+    :param number_channels: int, number of channels in the recording
+    :param pixel_width: int, points to ask for, the width of the plot
+    """
+    data = data_class.StreamingData()
+    data.number_channels = number_channels
+    data.clear()
+    data.start_recording('benchmark_pyramid.raw')
+    adc_buffer = np.random.RandomState(5).randint(-8192, 8192, 2 ** 16 * number_channels).astype(np.int16)
+    number_buffers = int(recording_time * data_class.SAMPLE_RATE / 2 ** 16)
+    start = time.perf_counter()
+    for _ in range(number_buffers):
+        data.recorder.append(adc_buffer)
+        data.pyramid.append(adc_buffer)
+    build_time = time.perf_counter() - start
+    print('pyramid: {0:.0f} s of {1} channels added in {2:.3f} s, {3:.1f} MB'
+          .format(data.pyramid.frames / data_class.SAMPLE_RATE, number_channels, build_time,
+                  data.pyramid.nbytes() / 2 ** 20))
+    end_time = data.pyramid.frames / data_class.SAMPLE_RATE
+    for time_range in [0.005, 0.5, 5, 60, 600, end_time]:
+        start = time.perf_counter()
+        for start_time in np.linspace(0, end_time - time_range, 20):
+            t_data, _ = data.get_display_range(start_time, start_time + time_range, pixel_width)
+        range_time = (time.perf_counter() - start) / 20
+        print('pyramid: {0:10.3f} s range, {1:6d} points in {2:.3f} ms'.format(time_range, len(t_data),
+                                                                               1000 * range_time))
+    data.stop_recording()
+    os.remove('benchmark_pyramid.raw')
+
+
+def benchmark_soak(hours=SOAK_HOURS, number_channels=3, buffer_size=2 ** 16, reports=8):
+    """ Stream hours of adc buffers through StreamingData, recording to disk as the GUI does, as fast as they can
+    be added and check the resident memory stays the same the whole time
+    :param hours: float, hours of data to stream
+    :param number_channels: int, number of channels in the adc buffers
+    :param buffer_size: int, adc counts in each buffer
+    :param reports: int, how many times to print the resident memory
+    """
+    data = data_class.StreamingData()
+    data.number_channels = number_channels
+    data.clear()
+    data.start_recording('benchmark_soak.raw')
+    adc_buffer = np.random.RandomState(6).randint(-8192, 8192, buffer_size).astype(np.int16)
+    number_buffers = int(hours * 3600 * data_class.SAMPLE_RATE * number_channels / buffer_size)
+    memory = []
+    start = time.perf_counter()
+    for i in range(number_buffers):
+        data.extend(adc_buffer)
+        if (i + 1) % max(number_buffers // reports, 1) == 0:
+            data.display_window(5)
+            memory.append(acquisition_daemon.resident_memory())
+            print('soak: {0:6.2f} h streamed, resident memory {1} MB, pyramid {2:.1f} MB'
+                  .format(data.end_time / 3600, memory[-1] and round(memory[-1], 1),
+                          data.pyramid.nbytes() / 2 ** 20))
+    run_time = time.perf_counter() - start
+    data.stop_recording()
+    os.remove('benchmark_soak.raw')
+    if memory[0]:
+        print('soak: {0} h in {1:.1f} s, resident memory grew {2:.1f} MB after the first report'
+              .format(hours, run_time, memory[-1] - memory[0]))
+
+
+def benchmark_plotter(number_channels=3, run_time=5.0, modes=('draw', 'blit', 'worker')):
+    """ Stream adc buffers into a Plotter in a tk window at real time and draw a frame after each one, as fast as
+    the plotter can go, drawing the whole figure, blitting the lines or with a render worker thread.  Needs
+    matplotlib and a display
+    :param number_channels: int, number of channels to draw
+    :param run_time: float, s to run each mode for
+    :param modes: modes to try
+    """
+    import tkinter as tk
+    try:
+        import plotter
+    except ImportError as error:
+        print('plotter: can not import the plotter, {0}'.format(error))
+        return
+    try:
+        root = tk.Tk()
+    except tk.TclError as error:
+        print('plotter: no display to draw on, {0}'.format(error))
+        return
+    data = data_class.StreamingData()
+    data.number_channels = number_channels
+    data.clear()
+    plot = plotter.Plotter(root, data)
+    plot.pack(side='top', fill=tk.BOTH, expand=True)
+    data.add_display_area(plot)
+    plot.draw_new_data(*data.display_window())
+    root.update()
+    adc_counts = make_plant_signal(run_time * len(modes) + 1, number_channels)
+    counts_per_second = int(data_class.SAMPLE_RATE * number_channels)
+    for mode in modes:
+        plot.set_blit(mode == 'blit')
+        plot.set_render_worker(mode == 'worker')
+        plot.frames = plot.full_redraws = 0
+        plot.total_frame_time = 0.0
+        plot.frame_start_times.clear()
+        start = time.perf_counter()
+        counts_added = 0
+        while time.perf_counter() - start < run_time:
+            counts_due = int((time.perf_counter() - start) * counts_per_second) - counts_added
+            data.extend(adc_counts[counts_added:counts_added + counts_due])
+            counts_added += counts_due
+            data.display_data()
+            root.update()
+        print('plotter {0}: {1}'.format(mode, plot.render_stats()))
+    plot.set_render_worker(False)
+    root.destroy()
+
+
+def benchmark_filter(number_channels=4, recording_time=60, buffer_size=ADC_BUFFER_SIZE):
+    """ Time the notch and band-pass filter on adc buffers of a plant like signal, and how many times faster than
+    real time it runs
+    :param number_channels: int, number of channels in the adc buffers
+    :param recording_time: float, s of data to filter
+    :param buffer_size: int, adc counts in each adc buffer
+    """
+    adc_counts = make_plant_signal(recording_time, number_channels)
+    _filter = stream_filter.StreamingFilter(number_channels, data_class.SAMPLE_RATE)
+    start = time.perf_counter()
+    for buffer_start in range(0, len(adc_counts), buffer_size):
+        _filter.process(adc_counts[buffer_start:buffer_start + buffer_size])
+    run_time = time.perf_counter() - start
+    number_buffers = -(-len(adc_counts) // buffer_size)
+    print('filter {0} sections, {1} channels: {2:.3f} ms per buffer, {3:.0f} times real time'
+          .format(len(_filter.sos), number_channels, 1000 * run_time / number_buffers, recording_time / run_time))
+
+
+def make_spike_signal(recording_time, number_channels=3, sample_rate=data_class.SAMPLE_RATE, spike_time=0.05,
+                      seed=7):
+    """ Make adc counts of noise on a slowly drifting baseline with gaussian shaped spikes of both signs at random
+    times, at least 3 s apart, on each channel
+    :param recording_time: float, seconds of signal to make
+    :param number_channels: int, number of channels to interleave
+    :param sample_rate: float, Hz
+    :param spike_time: float, s, standard deviation of the spike shape
+    :param seed: int, random seed
+    :return: numpy array of int16 adc counts interleaved by channel, list of (channel, sample) of each spike peak
+    """
+    random_state = np.random.RandomState(seed)
+    number_samples = int(recording_time * sample_rate)
+    sample_time = np.arange(number_samples) / sample_rate
+    drift_time = np.linspace(0, recording_time, int(recording_time * 10) + 1)  # the drift changes every 0.1 s
+    spike_width = int(spike_time * sample_rate)
+    channels = []
+    spikes = []
+    for channel in range(number_channels):
+        signal = np.interp(sample_time, drift_time, np.cumsum(random_state.normal(0, 2, len(drift_time))))
+        signal += 200 * np.sin(2 * np.pi * sample_time / 300 + channel)
+        signal += random_state.normal(0, 20, number_samples)
+        spike_times = np.sort(random_state.uniform(2, recording_time - 2, int(recording_time / 15)))
+        spike_times = spike_times[np.diff(spike_times, prepend=0) > 3]
+        for spike_time in spike_times:
+            peak = int(spike_time * sample_rate)
+            spike_index = np.arange(peak - 3 * spike_width, peak + 3 * spike_width)
+            amplitude = random_state.choice([-1, 1]) * random_state.uniform(200, 800)
+            signal[spike_index] += amplitude * np.exp(-0.5 * ((spike_index - peak) / spike_width) ** 2)
+            spikes.append((channel, peak))
+        channels.append(signal)
+    return np.clip(np.column_stack(channels), -32768, 32767).astype(np.int16).ravel(), spikes
+
+
+def benchmark_event_detector(number_channels=3, recording_time=600, buffer_size=ADC_BUFFER_SIZE):
+    """ Time the event detector on adc buffers with known spikes in them, check it finds them and does not find
+    events where there are none
+    :param number_channels: int, number of channels in the adc buffers
+    :param recording_time: float, s of data to process
+    :param buffer_size: int, adc counts in each adc buffer
+    """
+    adc_counts, spikes = make_spike_signal(recording_time, number_channels)
+    detector = event_detector.EventDetector(number_channels, data_class.SAMPLE_RATE)
+    start = time.perf_counter()
+    for buffer_start in range(0, len(adc_counts), buffer_size):
+        detector.process(adc_counts[buffer_start:buffer_start + buffer_size])
+    run_time = time.perf_counter() - start
+    events = detector.table.events()
+    tolerance = 0.05 * data_class.SAMPLE_RATE
+    found = sum(np.any((events['channel'] == channel) & (np.abs(events['sample'] - peak) < tolerance))
+                for channel, peak in spikes)
+    stats = detector.stats()
+    print('event detector {0} channels: {1:.0f} times real time, {2:.3f} ms per buffer ({3:.3f} ms longest), '
+          '{4} of {5} spikes found, {6} events'.format(number_channels, recording_time / run_time,
+                                                       1000 * stats['latency'], 1000 * stats['max latency'],
+                                                       found, len(spikes), len(events)))
+    assert found >= 0.95 * len(spikes)
+    assert len(events) <= 1.05 * len(spikes)
+
+
+def benchmark_running_stats(number_channels=3, recording_times=(60, 3600), buffer_size=ADC_BUFFER_SIZE):
+    """ Time updating the running statistics with each adc buffer early and late in a recording to check the cost
+    does not grow with the recording, and check the statistics against working them out from all the samples
+    :param number_channels: int, number of channels in the adc buffers
+    :param recording_times: list of s of data to process
+    :param buffer_size: int, adc counts in each adc buffer
+    """
+    adc_counts = make_plant_signal(max(recording_times), number_channels)
+    statistics = running_stats.RunningStatistics(number_channels, data_class.SAMPLE_RATE)
+    buffer_start = 0
+    for recording_time in recording_times:
+        end = int(recording_time * data_class.SAMPLE_RATE) * number_channels
+        start = time.perf_counter()
+        number_buffers = 0
+        while buffer_start < end:
+            buffer_end = min(buffer_start + buffer_size, end)
+            statistics.update(adc_counts[buffer_start:buffer_end])
+            buffer_start = buffer_end
+            number_buffers += 1
+        update_time = (time.perf_counter() - start) / number_buffers
+        start = time.perf_counter()
+        result = statistics.statistics()
+        statistics_time = time.perf_counter() - start
+        print('running statistics at {0} s: {1:.3f} ms per buffer, {2:.3f} ms to get the statistics'
+              .format(recording_time, 1000 * update_time, 1000 * statistics_time))
+        # the statistics are over the newest whole blocks, the frames of the unfinished block are not in them yet
+        window_end = statistics.blocks * statistics.block_size
+        window_start = window_end - statistics.window_blocks * statistics.block_size
+        window = adc_counts.reshape(-1, number_channels)[window_start:window_end].astype(np.float64)
+        assert np.allclose(result['mean'], window.mean(axis=0))
+        assert np.allclose(result['std'], window.std(axis=0))
+        assert np.allclose(result['rms'], np.sqrt(np.mean(window ** 2, axis=0)))
+        assert np.array_equal(result['min'], window.min(axis=0))
+        assert np.array_equal(result['max'], window.max(axis=0))
+
+
+def make_calibration_signal(recording_time, number_channels=3, sample_rate=data_class.SAMPLE_RATE, step=640,
+                            frequency=10.0, noise=8.0, settle_time=0.3, seed=3):
+    """ Make adc counts of the calibration square wave on channel 0, starting with the amplifier settling from a
+    large offset, and the plant signal on the other channels
+    :param recording_time: float, seconds of signal to make
+    :param number_channels: int, number of channels to interleave
+    :param sample_rate: float, Hz
+    :param step: float, adc counts between the levels of the square wave
+    :param frequency: float, Hz of the square wave
+    :param noise: float, standard deviation of the noise in adc counts
+    :param settle_time: float, s, time constant of the offset at the start
+    :param seed: int, random seed
+    :return: numpy array of int16 adc counts interleaved by channel
+    """
+    random_state = np.random.RandomState(seed)
+    sample_time = np.arange(int(recording_time * sample_rate)) / sample_rate
+    square_wave = -300 + step * (np.floor(2 * frequency * sample_time) % 2)
+    square_wave += 3000 * np.exp(-sample_time / settle_time) + random_state.normal(0, noise, len(sample_time))
+    adc_counts = make_plant_signal(recording_time, number_channels).reshape(-1, number_channels)
+    adc_counts[:, 0] = np.round(square_wave)
+    return adc_counts.ravel()
+
+
+def benchmark_calibration(number_channels=3, buffer_size=ADC_BUFFER_SIZE, frequencies=(2.0, 10.0, 50.0)):
+    """ Run the streaming calibration on square waves of different frequencies and check the step it finds, how
+    much data and CPU time it needs, and that it does not pass without a square wave
+    :param number_channels: int, number of channels in the adc buffers
+    :param buffer_size: int, adc counts in each adc buffer
+    :param frequencies: list of Hz of the square waves to try
+    """
+    step = 640  # adc counts, 80 mV at a gain of 1
+    for frequency in frequencies:
+        adc_counts = make_calibration_signal(calibration.MAX_CALIBRATION_TIME + 1, number_channels, step=step,
+                                             frequency=frequency)
+        streaming_calibration = calibration.StreamingCalibration(number_channels, data_class.SAMPLE_RATE)
+        for buffer_start in range(0, len(adc_counts), buffer_size):
+            streaming_calibration.process(adc_counts[buffer_start:buffer_start + buffer_size])
+            if streaming_calibration.finished:
+                break
+        result = streaming_calibration.result()
+        print('calibration {0} Hz square wave: step {1:.2f} +- {2:.2f} counts after {3:.2f} s of data, '
+              '{4:.1f} ms CPU'.format(frequency, result['step'], result['error'], result['time'],
+                                      1000 * result['cpu time']))
+        assert result['converged']
+        assert abs(result['step'] - step) < 1
+        assert result['cpu time'] < 1
+    no_signal = make_plant_signal(calibration.MAX_CALIBRATION_TIME + 1, number_channels)
+    streaming_calibration = calibration.StreamingCalibration(number_channels, data_class.SAMPLE_RATE)
+    for buffer_start in range(0, len(no_signal), buffer_size):
+        streaming_calibration.process(no_signal[buffer_start:buffer_start + buffer_size])
+    assert streaming_calibration.finished and not streaming_calibration.converged
+
+
+def benchmark_epochs(number_channels=3, recording_time=120, buffer_size=ADC_BUFFER_SIZE, stimulus_period=3.1):
+    """ Give stimuli to an epoch engine while adc buffers with a response after each stimulus are processed, check
+    the epochs and average it cuts against cutting them out of the whole signal, and time getting the average late in
+    the recording
+    :param number_channels: int, number of channels in the adc buffers
+    :param recording_time: float, s of data to process
+    :param buffer_size: int, adc counts in each adc buffer
+    :param stimulus_period: float, s between the stimuli
+    """
+    rate = data_class.SAMPLE_RATE
+    adc_counts = make_plant_signal(recording_time, number_channels)
+    frames = adc_counts.reshape(-1, number_channels)
+    response = (300 * np.exp(-np.arange(int(0.5 * rate)) / (0.1 * rate))).astype(np.int16)
+    stimulus_samples = np.arange(int(stimulus_period * rate), len(frames) - len(response), int(stimulus_period * rate))
+    for sample in stimulus_samples:
+        frames[sample:sample + len(response)] += response[:, np.newaxis]
+    engine = epochs.EpochEngine(number_channels, rate)
+    next_stimulus = 0
+    start = time.perf_counter()
+    for buffer_start in range(0, len(adc_counts), buffer_size):
+        buffer_end = buffer_start + buffer_size
+        # the stimuli in this buffer are given before it is read, so part of their window is in the ring and part
+        # is still to come
+        while (next_stimulus < len(stimulus_samples) and
+               stimulus_samples[next_stimulus] * number_channels < buffer_end):
+            engine.add_stimulus(stimulus_samples[next_stimulus])
+            next_stimulus += 1
+        engine.process(adc_counts[buffer_start:buffer_end])
+    run_time = time.perf_counter() - start
+    start = time.perf_counter()
+    average = engine.average()
+    average_time = time.perf_counter() - start
+    stimuli, epoch_counts = engine.get_epochs()
+    windows = [frames[sample - engine.pre_frames:sample - engine.pre_frames + engine.window_frames]
+               for sample in stimulus_samples]
+    complete = [window for window in windows if len(window) == engine.window_frames]
+    print('epochs {0} channels: {1} stimuli, {2} averaged, {3:.3f} ms per buffer, {4:.3f} ms to get the average'
+          .format(number_channels, len(stimulus_samples), engine.trials, 1000 * run_time * buffer_size /
+                  len(adc_counts), 1000 * average_time))
+    assert engine.trials == len(complete)
+    assert np.array_equal(stimuli, stimulus_samples[len(complete) - len(stimuli):len(complete)])
+    assert np.array_equal(epoch_counts, complete[len(complete) - len(stimuli):])
+    assert np.allclose(average, np.mean(complete, axis=0))
+
+
+def legacy_split_channels(adc_counts, number_channels):
+    """ The nested loop StreamingData.call_save used to separate the channels before pickling them
+    :param adc_counts: sequence of int16 adc counts interleaved by channel
+    :param number_channels: int, number of channels interleaved
+    :return: dict of array('h') for each channel
+    """
+    len_channel = int(len(adc_counts) / number_channels)
+    channel_data = dict()
+    for i in range(number_channels):
+        channel_data["channel {0}".format(i)] = array.array('h')
+    data_ptr = 0
+    for i in range(len_channel):
+        for j in range(number_channels):
+            channel_data["channel {0}".format(j)].append(adc_counts[data_ptr])
+            data_ptr += 1
+    return channel_data
+
+
+def benchmark_save(recording_time=60, number_channels=3):
+    """ Time separating the channels with the old nested loop against writing them to a .npz file with a
+    SaveThread
+    :param recording_time: float, seconds of data to save
+    :param number_channels: int, number of channels in the recording
+    """
+    adc_counts = np.random.RandomState(1).randint(-8192, 8192, int(recording_time * data_class.SAMPLE_RATE *
+                                                                   number_channels)).astype(np.int16)
+    start = time.perf_counter()
+    legacy_split_channels(array.array('h', adc_counts.tobytes()), number_channels)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    save_thread = data_class.SaveThread('benchmark.npz', adc_counts, number_channels, 1.0)
+    save_thread.start()
+    save_thread.join()
+    save_time = time.perf_counter() - start
+    os.remove('benchmark.npz')
+    print('save {0} s of {1} channels: split loop {2:.3f} s, SaveThread to .npz {3:.3f} s'
+          .format(recording_time, number_channels, loop_time, save_time))
+
+
+def make_plant_signal(recording_time, number_channels=3, sample_rate=data_class.SAMPLE_RATE, seed=3):
+    """ Make adc counts that look like a plant recording: a drifting baseline, 50 Hz mains pickup, noise and an
+    action potential (a slow ~2 s wave) every ~30 s on each channel
+    :param recording_time: float, seconds of signal to make
+    :param number_channels: int, number of channels to interleave
+    :param sample_rate: float, Hz
+    :param seed: int, random seed
+    :return: numpy array of int16 adc counts interleaved by channel
+    """
+    random_state = np.random.RandomState(seed)
+    number_samples = int(recording_time * sample_rate)
+    sample_time = np.arange(number_samples) / sample_rate
+    channels = []
+    for channel in range(number_channels):
+        signal = np.cumsum(random_state.normal(0, 0.5, number_samples))  # baseline drift
+        signal += 40 * np.sin(2 * np.pi * 50 * sample_time + channel)  # mains pickup
+        signal += random_state.normal(0, 8, number_samples)
+        for spike_time in np.arange(random_state.uniform(0, 30), recording_time, 30):
+            signal -= 800 * np.exp(-((sample_time - spike_time) / 0.5) ** 2)
+        channels.append(signal)
+    signals = np.clip(np.stack(channels, axis=1), -8192, 8191)
+    return signals.astype(np.int16).ravel()
+
+
+def load_recording(filename):
+    """ Load the adc counts of a .raw or .npz recording to benchmark with
+    :param filename: str, path of the recording
+    :return: numpy array of int16 adc counts interleaved by channel, number of channels
+    """
+    if filename.endswith('.npz'):
+        npz_file = np.load(filename)
+        channels = [npz_file[key] for key in sorted(npz_file.keys()) if key.startswith('channel')]
+        return np.stack(channels, axis=1).ravel(), len(channels)
+    header, adc_counts = raw_recorder.open_recording(filename)
+    return np.array(adc_counts), header['number channels']
+
+
+def benchmark_recording_format(filename=None, recording_time=600, reads=200):
+    """ Time writing and reading a .plant file and check its compression ratio, for each zlib compression level
+    :param filename: str, path of a .raw or .npz recording to use, None to use a made up plant signal
+    :param recording_time: float, seconds of made up signal to use if no filename is given
+    :param reads: int, number of random 1 second windows to read
+    """
+    if filename:
+        adc_counts, number_channels = load_recording(filename)
+    else:
+        number_channels = 3
+        adc_counts = make_plant_signal(recording_time, number_channels)
+    megabytes = adc_counts.nbytes / 2 ** 20
+    channel_length = len(adc_counts) // number_channels
+    window_length = int(data_class.SAMPLE_RATE)  # samples in a 1 s window
+    random_state = np.random.RandomState(0)
+    for compression_level in [1, 6]:
+        start = time.perf_counter()
+        writer = recording_format.ChunkedRecordingWriter('benchmark.plant', data_class.SAMPLE_RATE, number_channels,
+                                                         1.0, compression_level=compression_level)
+        for buffer_start in range(0, len(adc_counts), 4082):
+            writer.append(adc_counts[buffer_start:buffer_start + 4082])
+        writer.close()
+        write_time = time.perf_counter() - start
+        reader = recording_format.ChunkedRecordingReader('benchmark.plant')
+        start = time.perf_counter()
+        for channel in range(number_channels):
+            reader.read(channel)
+        read_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(reads):
+            window_start = random_state.randint(0, max(channel_length - window_length, 1))
+            reader.read(random_state.randint(number_channels), window_start, window_start + window_length)
+        window_time = (time.perf_counter() - start) / reads
+        reader.close()
+        print('.plant level {0}: write {1:6.1f} MB/s, read {2:6.1f} MB/s, 1 s window {3:.3f} ms, '
+              'compression ratio {4:.2f}'.format(compression_level, megabytes / write_time, megabytes / read_time,
+                                                 1000 * window_time, writer.compression_ratio()))
+    os.remove('benchmark.plant')
+
+
+class BenchmarkMaster(object):
+    """ Stands in for the tk root that PlantUSB needs to get the data class from """
+    def __init__(self):
+        self.data = data_class.StreamingData()
+
+
+def make_simulated_device(**device_settings):
+    """ Make a PlantUSB connected to a usb_mock.SimulatedPSoC
+    :param device_settings: keyword arguments for the SimulatedPSoC
+    :return: usb_comm.PlantUSB
+    """
+    device = usb_comm.PlantUSB(BenchmarkMaster(), usb_backend=usb_mock.SimulatedUSBBackend(**device_settings))
+    assert device.connected
+    return device
+
+
+def benchmark_adc_buffer_reads(number_buffers=NUMBER_BUFFERS):
+    """ Time reading adc buffers from a simulated device one usb packet at a time against reading them
+    in one bulk transfer.  The simulated device runs fast enough that a buffer is always ready """
+    device = make_simulated_device(speed=1000)
+    for read_mode in ['packet', 'bulk']:
+        data_queue = queue.Queue()
+        collector = usb_comm.ThreadedUSBDataCollector(device, 1, data_queue, threading.Event(),
+                                                      read_mode=read_mode)
+        device.usb_write('R')
+        read_time = 0
+        for _ in range(number_buffers):
+            message = device.usb_read_info()
+            start = time.perf_counter()
+            device.usb_write('F{0}'.format(chr(message[4])))
+            collector.get_adc_buffer(number_packets=PACKETS_PER_CHANNEL)
+            read_time += time.perf_counter() - start
+            assert len(data_queue.get(0)) == device._device.buffer_size
+        device.usb_write('E')
+        counts_per_second = number_buffers * device._device.buffer_size / read_time
+        print('adc buffer read {0:>6}: {1:8.3f} ms per buffer, {2:10.0f} adc counts per second'
+              .format(read_mode, 1000 * read_time / number_buffers, counts_per_second))
+
+
+def benchmark_acquisition(speeds=(1, 5, 10, 20), run_time=2.0, number_channels=3, acquisition_mode='pipelined',
+                          read_mode='bulk'):
+    """ Run the usb threads against a simulated device faster than real time and check how many adc counts
+    get to the data class and how many adc buffers the device lost because the host did not export them in time
+    :param speeds: list of how many times faster than real time to run the simulated device
+    :param run_time: float, seconds to run at each speed
+    :param number_channels: int, adc channels to read
+    :param acquisition_mode: 'pipelined' to use ThreadedUSBAcquisition, 'threaded' to use ThreadedUSBDataCollector
+    :param read_mode: 'bulk' or 'packet', how the adc buffers are read
+    """
+    for speed in speeds:
+        device = make_simulated_device(speed=speed)
+        device.set_number_channels(number_channels)
+        data = device.data
+        data_queue = queue.Queue()
+        if acquisition_mode == 'pipelined':
+            acquisition = usb_comm.ThreadedUSBAcquisition(device, data_queue, threading.Event(), read_mode=read_mode)
+        else:
+            acquisition = usb_comm.ThreadedUSBDataCollector(device, number_channels, data_queue, threading.Event(),
+                                                            read_mode=read_mode)
+        device.usb_write('R')
+        acquisition.start()
+        adc_counts_read = 0
+        end_time = time.perf_counter() + run_time
+        while time.perf_counter() < end_time:
+            try:
+                adc_buffer = data_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            data.sample_signal(adc_buffer, data_class.SAMPLING_RATIO)
+            adc_counts_read += len(adc_buffer)
+        acquisition.stop_running()
+        acquisition.join(timeout=2)
+        simulated_psoc = device._device
+        expected_counts = simulated_psoc.sample_rate * number_channels * speed * run_time
+        print('acquisition {0:>9} {1:>6} at {2:>3}x real time: {3:6.1%} of adc counts read, '
+              '{4} device buffer overruns'.format(acquisition_mode, read_mode, speed,
+                                                  adc_counts_read / expected_counts, simulated_psoc.overruns))
+        if acquisition_mode == 'pipelined':
+            print('    device waited {0:.3f} ms per buffer for the host'
+                  .format(1000 * acquisition.stats()['device wait per buffer']))
+
+
+def benchmark_stimulation_protocol(number_channels=3, pulses=10, pulse_interval=0.25, trains=2, train_interval=3.0,
+                                   main_thread_load=0.015):
+    """ Give a protocol to a simulated device from a ProtocolScheduler while the main thread moves the adc buffers
+    into the data class (and is kept busy for main_thread_load s every 20 ms tick like a display update), check
+    the device got the settings and pulses in order and report the jitter against the timer and the sample clock
+    :param number_channels: int, adc channels to read
+    :param pulses: int, pulses in each train
+    :param pulse_interval: float, s between the pulses of a train
+    :param trains: int, number of trains, the current goes up 10 for each one and the channel rotates every pulse
+    :param train_interval: float, s between the trains
+    :param main_thread_load: float, s the main thread is busy each tick
+    """
+    device = make_simulated_device()
+    device.set_number_channels(number_channels)
+    data = device.data
+    data_queue = queue.Queue()
+    acquisition = usb_comm.ThreadedUSBAcquisition(device, data_queue, threading.Event())
+    device.usb_write('R')
+    acquisition.start()
+    protocol = stimulation_protocol.make_protocol(100, 50, pulses=pulses, pulse_interval=pulse_interval,
+                                                  trains=trains, train_interval=train_interval, current_step=10,
+                                                  channels=(1, 2, 3))
+    scheduler = stimulation_protocol.ProtocolScheduler(device, protocol, start_delay=0.5)
+    scheduler.start()
+    while scheduler.is_alive():
+        tick_end = time.perf_counter() + 0.02
+        while True:
+            try:
+                data.extend(data_queue.get(0))
+            except queue.Empty:
+                break
+        while time.perf_counter() < tick_end - 0.02 + main_thread_load:  # stands in for drawing the plot
+            pass
+        time.sleep(max(tick_end - time.perf_counter(), 0))
+    acquisition.stop_running()
+    acquisition.join(timeout=2)
+    expected = []
+    for stimulus in protocol:
+        expected.extend([usb_comm.stimulator_message(stimulus.duration, stimulus.current, stimulus.channel,
+                                                     stimulus.polarity), 'G'])
+    assert device._device.other_messages == expected
+    stats = scheduler.stats()
+    print('stimulation protocol {0} pulses: timer error {1:.3f} +- {2:.3f} ms (max {3:.3f} ms), sample clock '
+          'error {4:.2f} ms std (max {5:.2f} ms), priority raised: {6}'
+          .format(stats['pulses'], stats['timer mean'], stats['timer std'], stats['timer max'],
+                  stats['sample clock std'], stats['sample clock max'], stats['priority raised']))
+    assert stats['pulses'] == len(protocol)
+
+
+def benchmark_command_writer(speed=5, run_time=2.0, number_channels=3, setting_rate=1000.0, write_time=0.001):
+    """ Read a simulated device faster than real time while another thread changes the offset voltage setting_rate
+    times a second, like dragging the spinbox, with every message written straight from the thread that sends it
+    and with the command writer.  Check the device gets the last setting and report how long the device waited for
+    each adc buffer to be requested
+    :param speed: float, how many times faster than real time to run the simulated device
+    :param run_time: float, seconds to run each way
+    :param number_channels: int, adc channels to read
+    :param setting_rate: float, offset voltage settings per second
+    :param write_time: float, s each usb write takes
+    """
+    for mode in ['direct', 'queued']:
+        device = make_simulated_device(speed=speed, write_time=write_time)
+        if mode == 'direct':
+            device.command_writer.stop_running()
+            device.command_writer.join()
+        device.set_number_channels(number_channels)
+        data_queue = queue.Queue()
+        acquisition = usb_comm.ThreadedUSBAcquisition(device, data_queue, threading.Event())
+        device.usb_write('R')
+        acquisition.start()
+        settings_sent = 0
+        setting_time = 0.0  # s the sending thread was held up by the writes
+        end_time = time.perf_counter() + run_time
+        while time.perf_counter() < end_time:
+            start = time.perf_counter()
+            device.set_offset_vdac(settings_sent % 1024)
+            setting_time += time.perf_counter() - start
+            settings_sent += 1
+            time.sleep(1 / setting_rate)
+        last_setting = (settings_sent - 1) % 1024
+        acquisition.stop_running()
+        acquisition.join(timeout=2)
+        time.sleep(0.1)  # let the command writer write the last messages
+        simulated_psoc = device._device
+        # the acquisition thread only waits to put the 'F#' in the queue, the device waits until it is written
+        device_wait = acquisition.stats()['device wait per buffer']
+        if mode == 'queued':
+            device_wait += device.command_writer.stats()['F']['latency']
+        print('command writer {0:>6}: device waited {1:.3f} ms per buffer, {2} buffer overruns, {3} offset '
+              'settings taking {4:.3f} ms each to send'.format(mode, 1000 * device_wait, simulated_psoc.overruns,
+                                                               settings_sent, 1000 * setting_time / settings_sent))
+        if mode == 'queued':
+            for kind, stats in sorted(device.command_writer.stats().items()):
+                print('    {0}: {1} written, {2} coalesced, {3:.3f} ms latency ({4:.3f} ms longest), {5:.3f} ms '
+                      'in the queue'.format(kind, stats['written'], stats['coalesced'], 1000 * stats['latency'],
+                                            1000 * stats['max latency'], 1000 * stats['queue wait']))
+        assert simulated_psoc.vdac_setting == last_setting
+
+
+def benchmark_daemon(speed=5, run_time=3.0, number_channels=3):
+    """ Run the acquisition daemon on a simulated device and control it through its socket the way the command line
+    client does, check the recording has every adc count the data class got and report the cpu time and memory
+    :param speed: how many times faster than real time to run the simulated device
+    :param run_time: float, s to record for
+    :param number_channels: int, adc channels to read
+    """
+    control_address = os.path.join(tempfile.mkdtemp(), 'daemon.sock')
+    daemon = acquisition_daemon.AcquisitionDaemon(number_channels, 'daemon_data', control_address,
+                                                  usb_mock.SimulatedUSBBackend(speed=speed))
+    daemon_thread = threading.Thread(target=daemon.mainloop, daemon=True)
+    daemon_thread.start()
+    while not os.path.exists(control_address):
+        time.sleep(0.01)
+    cpu_start = time.process_time()
+    filename = acquisition_daemon.send_command('start', control_address)['status']['devices'][0]['recording']
+    time.sleep(run_time)
+    status = acquisition_daemon.send_command('status', control_address)['status']['devices'][0]
+    stopped = acquisition_daemon.send_command('quit', control_address)['status']
+    daemon_thread.join(timeout=5)
+    cpu_time = time.process_time() - cpu_start
+    header, adc_counts = raw_recorder.open_recording(filename)
+    assert header['number channels'] == number_channels
+    assert len(adc_counts) == daemon.pipelines[0].data.adc_counts_read
+    simulated_psoc = daemon.pipelines[0].device._device
+    expected_counts = simulated_psoc.sample_rate * number_channels * speed * run_time
+    print('daemon at {0}x real time: {1:.1f} s recorded while running, {2:6.1%} of adc counts recorded, {3} device '
+          'buffer overruns, {4:.1%} cpu, {5:.0f} MB resident'.format(speed, status['seconds recorded'],
+                                                                     len(adc_counts) / expected_counts,
+                                                                     simulated_psoc.overruns, cpu_time / run_time,
+                                                                     stopped['memory MB'] or 0))
+
+
+def benchmark_process_acquisition(speed=5, run_time=3.0, number_channels=3, start_method='spawn'):
+    """ Read a simulated device from an acquisition process (acquisition_mode='process') in the acquisition daemon
+    and report the adc counts read, the adc buffers the shared ring buffer dropped and how much data waits in the
+    ring for the daemon to drain it, in ms of the time it took the device to sample it
+    :param speed: how many times faster than real time to run the simulated device
+    :param run_time: float, s to record for
+    :param number_channels: int, adc channels to read
+    :param start_method: multiprocessing start method to start the acquisition process with
+    """
+    old_start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method(start_method, force=True)
+    try:
+        daemon = acquisition_daemon.AcquisitionDaemon(number_channels, 'process_data', None,
+                                                      usb_mock.SimulatedUSBBackend(speed=speed),
+                                                      acquisition_mode='process')
+        pipeline = daemon.pipelines[0]
+        daemon.start('process.raw')
+        ring_buffer = pipeline.device.threaded_data_stream.ring_buffer
+        unread = []
+        end_time = time.perf_counter() + run_time
+        while time.perf_counter() < end_time:
+            unread.append(ring_buffer.unread())
+            time.sleep(daemon.run_timers() or 0.01)
+        overruns = ring_buffer.overruns
+        daemon.stop()
+    finally:
+        multiprocessing.set_start_method(old_start_method, force=True)
+    counts_per_ms = data_class.SAMPLE_RATE * number_channels * speed / 1000.
+    expected_counts = counts_per_ms * 1000 * run_time
+    print('process acquisition ({0}) at {1}x real time: {2:6.1%} of adc counts read, {3} ring buffer overruns, '
+          '{4:.2f} ms of data waiting in the ring on average ({5:.2f} ms most)'
+          .format(start_method, speed, pipeline.data.adc_counts_read / expected_counts, overruns,
+                  np.mean(unread) / counts_per_ms, np.max(unread) / counts_per_ms))
+
+
+def benchmark_multi_device(drifts=(0.0, 800.0, -500.0), run_time=10.0, number_channels=2, jitter=0.0005):
+    """ Read several simulated devices, each with its sample clock off by a drift, from one daemon and check the
+    drift each device is found to have, how close the fits put each sample to when the simulated device took it
+    and that the merged recording has the nearest sample of each device at every time
+    :param drifts: list of how fast each simulated device samples, in parts per million
+    :param run_time: float, s to record for, the devices run in real time
+    :param number_channels: int, adc channels to read from each device
+    :param jitter: float, s, standard deviation of the extra usb latency of each 'Done#'
+    """
+    usb_backend = usb_mock.SimulatedUSBBackend(number_devices=len(drifts), jitter=jitter)
+    for simulated_psoc, drift in zip(usb_backend.devices, drifts):
+        simulated_psoc.sample_rate = data_class.SAMPLE_RATE * (1 + drift / 1e6)
+    daemon = acquisition_daemon.AcquisitionDaemon(number_channels, 'multi_device_data', None, usb_backend,
+                                                  all_devices=True)
+    daemon.start('multi_device.raw')
+    end_time = time.perf_counter() + run_time
+    while time.perf_counter() < end_time:
+        time.sleep(daemon.run_timers() or 0.01)
+    merge_start = time.perf_counter()
+    merged = daemon.stop()['merged']
+    merge_time = time.perf_counter() - merge_start
+    reader = recording_format.ChunkedRecordingReader(daemon.merged_filename)
+    merged_start = max(pipeline.clock.host_time(0) for pipeline in daemon.pipelines)
+    sample_times = merged_start + np.arange(reader.number_samples) / reader.sample_rate
+    for pipeline, device in zip(daemon.pipelines, merged['devices']):
+        clock = pipeline.clock
+        simulated_psoc = pipeline.device._device
+        header, adc_counts = raw_recorder.open_recording(device['raw recording'])
+        frames = adc_counts[:len(adc_counts) // number_channels * number_channels].reshape(-1, number_channels)
+        # the 'Done#' of the buffer ending at sample n is sent when sample n + 1 would start
+        samples = np.arange(len(frames))
+        true_times = simulated_psoc.start_time + (samples + 1) / simulated_psoc.sample_rate
+        alignment_error = 1000 * (clock.host_time(samples) - true_times)
+        nearest = np.clip(np.rint(clock.sample_at(sample_times)).astype(np.int64), 0, len(frames) - 1)
+        for channel in range(number_channels):
+            assert np.array_equal(reader.read(device['first channel'] + channel), frames[nearest, channel])
+        print('multi device: {0:7.1f} ppm drift found {1:7.1f} ppm, sample times off by {2:.3f} ms (spread '
+              '{3:.3f} ms), {4} overruns'.format((simulated_psoc.sample_rate / data_class.SAMPLE_RATE - 1) * 1e6,
+                                                 device['drift ppm'], np.mean(alignment_error),
+                                                 np.ptp(alignment_error), simulated_psoc.overruns))
+    reader.close()
+    print('    {0} devices merged into {1:.2f} s of {2} channels in {3:.3f} s'.format(
+        len(daemon.pipelines), reader.number_samples / reader.sample_rate, reader.number_channels, merge_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the data acquisition and display pipeline")
+    # a .raw or .npz recording can be given to benchmark the recording format with real plant signals
+    parser.add_argument('recording', nargs='?', help="raw or npz recording to benchmark the recording format with")
+    parser.add_argument('--soak', type=float, default=SOAK_HOURS, metavar='HOURS',
+                        help="hours of data to stream in the soak test")
+    arguments = parser.parse_args()
+    recording_filename = os.path.abspath(arguments.recording) if arguments.recording else None
+    os.chdir(tempfile.mkdtemp())  # PlantUSB makes a settings file in the working directory
+    benchmark_sample_signal(number_channels=1)
+    benchmark_sample_signal(number_channels=2)
+    benchmark_envelope()
+    benchmark_pyramid()
+    benchmark_filter()
+    benchmark_event_detector()
+    benchmark_running_stats()
+    benchmark_calibration()
+    benchmark_epochs()
+    benchmark_soak(hours=arguments.soak)
+    benchmark_plotter()
+    benchmark_save()
+    benchmark_recording_format(recording_filename)
+    benchmark_adc_buffer_reads()
+    benchmark_acquisition(acquisition_mode='threaded', read_mode='packet')
+    benchmark_acquisition(acquisition_mode='threaded', read_mode='bulk')
+    benchmark_acquisition(acquisition_mode='pipelined', read_mode='bulk')
+    benchmark_acquisition(acquisition_mode='pipelined', speeds=(20,), number_channels=4)
+    benchmark_stimulation_protocol()
+    benchmark_command_writer()
+    benchmark_daemon()
+    benchmark_process_acquisition()
+    benchmark_multi_device()
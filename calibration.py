@@ -0,0 +1,237 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Find the gain and zero level of the device from its calibration square wave, as the raw adc counts are read.
+
+After a 'C' the device puts a square wave of CALIBRATION_RANGE mV on the amplifier input.  Each adc buffer of the
+calibration channel is split into the samples on the lower and upper level with a 2 means split (the threshold is
+moved to halfway between the means of the 2 levels until it stops moving), the samples within guard_time of a step
+are left out.  The signal is settled when the levels of 2 adc buffers in a row agree, after that the count, sum and
+sum of squares of each level are added up until the standard error of the step between the levels is small enough,
+or max_time runs out.  Only the raw adc counts are used, so the display settings do not change the result.
+
+The gain and zero level are saved in a json file that is written to a temporary file and then renamed over the old
+one, so a crash while saving leaves the old settings.
+"""
+# standard libraries
+import json
+import logging
+import os
+import shelve
+import tempfile
+import time
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+SETTINGS_FILENAME = 'usb_settings.json'
+OLD_SETTINGS_FILENAME = 'usb_settings.db'  # shelve the settings were kept in before
+
+SETTLE_TIME = 0.1  # s, always dropped at the start while the square wave starts
+SETTLE_TOLERANCE = 0.01  # fraction of the step the levels of 2 adc buffers in a row can differ by to be settled
+GUARD_TIME = 0.002  # s, samples this close to a step of the square wave are not part of either level
+STEP_TO_NOISE = 6.0  # least step between the levels, in standard deviations of the levels, to be a square wave
+CONVERGED_ERROR = 0.001  # fraction of the step the standard error of the step has to be under to finish
+MIN_STEPS = 4  # steps of the square wave to see after settling before finishing
+MAX_CALIBRATION_TIME = 4.0  # s, give up if the step has not converged by then
+
+
+def split_levels(values, threshold=None, max_iterations=20):
+    """ Find the threshold between the 2 levels of a square wave with a 2 means split
+    :param values: numpy array of the samples
+    :param threshold: float, threshold to start from, None to start halfway between the minimum and maximum
+    :param max_iterations: int, most times to move the threshold
+    :return: float, threshold halfway between the means of the lower and upper level
+    """
+    if threshold is None:
+        threshold = (values.min() + values.max()) / 2.
+    for _ in range(max_iterations):
+        upper = values >= threshold
+        number_upper = np.count_nonzero(upper)
+        if number_upper in (0, len(values)):
+            break
+        upper_sum = values[upper].sum()
+        new_threshold = (upper_sum / number_upper + (values.sum() - upper_sum) / (len(values) - number_upper)) / 2.
+        if abs(new_threshold - threshold) < 0.5:  # adc counts
+            return new_threshold
+        threshold = new_threshold
+    return threshold
+
+
+class StreamingCalibration(object):
+    """ Estimates the levels of the calibration square wave from interleaved adc buffers as they are read """
+
+    def __init__(self, number_channels, sample_rate, channel=0, settle_time=SETTLE_TIME, guard_time=GUARD_TIME,
+                 converged_error=CONVERGED_ERROR, max_time=MAX_CALIBRATION_TIME):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param channel: int, channel the square wave is on
+        :param settle_time: float, s, dropped at the start
+        :param guard_time: float, s, samples this close to a step are not used
+        :param converged_error: float, fraction of the step the standard error of the step has to be under
+        :param max_time: float, s, longest to calibrate for
+        """
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        self.channel = channel
+        self.settle_samples = int(settle_time * sample_rate)
+        self.guard_samples = max(int(guard_time * sample_rate), 1)
+        self.converged_error = converged_error
+        self.max_samples = int(max_time * sample_rate)
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+        self.samples = 0  # samples of the channel read
+        self.threshold = None  # adc counts between the levels, found from the first settled adc buffer
+        self.last_levels = None  # (lower, upper) means of the last adc buffer while settling
+        self.last_upper = None  # bool, level of the last sample of the last adc buffer
+        self.settled = False
+        self.steps = 0  # steps of the square wave seen after settling
+        # count, sum and sum of squares of the lower and upper level samples after settling
+        self.counts = np.zeros(2)
+        self.sums = np.zeros(2)
+        self.squares = np.zeros(2)
+        self.finished = False
+        self.converged = False
+        self.cpu_time = 0.0  # s
+
+    def process(self, adc_counts):
+        """ Add an adc buffer to the estimate, sets finished when the estimate has converged or the time is up
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        """
+        if self.finished:
+            return
+        process_start = time.process_time()
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        values = adc_counts[self.channel:whole_frames * self.number_channels:self.number_channels]
+        start = max(self.settle_samples - self.samples, 0)
+        self.samples += len(values)
+        if start < len(values):
+            self.add_levels(values[start:].astype(np.float64))
+        if self.samples >= self.max_samples:
+            self.finished = True
+        self.cpu_time += time.process_time() - process_start
+
+    def add_levels(self, values):
+        """ Split the samples of an adc buffer of the calibration channel into the 2 levels, and add them to the
+        estimate once the signal has settled
+        :param values: numpy array of the samples
+        """
+        threshold = split_levels(values, self.threshold)
+        upper = values >= threshold
+        # leave out the samples near a step, including one between the last adc buffer and this one
+        last_upper = upper[0] if self.last_upper is None else self.last_upper
+        steps = np.diff(upper.astype(np.int8), prepend=np.int8(last_upper)) != 0
+        self.last_upper = upper[-1]
+        near_step = np.convolve(steps, np.ones(2 * self.guard_samples + 1), 'same') > 0
+        levels = [values[~upper & ~near_step], values[upper & ~near_step]]
+        if not self.settled:
+            self.settled = self.check_settled(levels)
+            if not self.settled:
+                return
+            self.threshold = threshold
+        self.steps += int(np.count_nonzero(steps))
+        self.counts += [len(level) for level in levels]
+        self.sums += [level.sum() for level in levels]
+        self.squares += [np.square(level).sum() for level in levels]
+        if self.steps >= MIN_STEPS and self.step_error() < self.converged_error * self.step():
+            self.finished = self.converged = True
+
+    def check_settled(self, levels):
+        """ Check if the square wave has settled, the levels of 2 adc buffers in a row have to agree
+        :param levels: list of numpy arrays of the lower and upper level samples of an adc buffer
+        :return: bool
+        """
+        if not (len(levels[0]) > 1 and len(levels[1]) > 1):
+            self.last_levels = None
+            return False
+        means = np.array([level.mean() for level in levels])
+        noise = np.sqrt(max(levels[0].var(), levels[1].var()))
+        step = means[1] - means[0]
+        if step < STEP_TO_NOISE * noise:  # not a square wave yet
+            self.last_levels = None
+            return False
+        settled = self.last_levels is not None and np.all(np.abs(means - self.last_levels) < SETTLE_TOLERANCE * step)
+        self.last_levels = means
+        return settled
+
+    def levels(self):
+        """ Get the means of the lower and upper levels since the signal settled
+        :return: numpy array of [lower, upper] adc counts
+        """
+        return self.sums / np.maximum(self.counts, 1)
+
+    def step(self):
+        lower, upper = self.levels()
+        return upper - lower
+
+    def step_error(self):
+        """ Get the standard error of the step between the levels
+        :return: float, adc counts
+        """
+        means = self.levels()
+        variances = np.maximum(self.squares / np.maximum(self.counts, 1) - means ** 2, 0)
+        return np.sqrt(np.sum(variances / np.maximum(self.counts, 1)))
+
+    def result(self):
+        """ Get the result of the calibration
+        :return: dict of if the estimate converged, the lower and upper level and the step between them in adc
+        counts, the standard error of the step, the seconds of data read and the CPU time used in seconds
+        """
+        lower, upper = self.levels()
+        return {'converged': self.converged,
+                'lower': lower,
+                'upper': upper,
+                'step': upper - lower,
+                'error': self.step_error(),
+                'time': self.samples / self.sample_rate,
+                'cpu time': self.cpu_time}
+
+
+def load_settings(filename=SETTINGS_FILENAME, old_filename=OLD_SETTINGS_FILENAME):
+    """ Read the saved gain and zero level of the device, from the shelve they used to be kept in if there is no
+    settings file yet
+    :param filename: str, json settings file
+    :param old_filename: str, shelve the settings used to be kept in
+    :return: dict with 'gain' and 'zero level', or None if the device has not been calibrated
+    """
+    try:
+        with open(filename) as settings_file:
+            return json.load(settings_file)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as error:
+        logging.error("Could not read the settings in {0}: {1}".format(filename, error))
+        return None
+    if not any(os.path.exists(old_filename + extension) for extension in ('', '.db', '.dat', '.dir')):
+        return None  # do not let shelve make an empty one
+    try:
+        with shelve.open(old_filename, flag='r') as settings:
+            if 'gain' in settings and 'zero level' in settings:
+                return {'gain': settings['gain'], 'zero level': settings['zero level']}
+    except Exception as error:  # dbm raises its own error types
+        logging.error("Could not read the settings in {0}: {1}".format(old_filename, error))
+    return None
+
+
+def save_settings(settings, filename=SETTINGS_FILENAME):
+    """ Save the settings so the file always has either the old or the new settings in it, even if the program
+    stops while it is being written
+    :param settings: dict that can be written as json
+    :param filename: str, json settings file
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    file_descriptor, temporary_filename = tempfile.mkstemp(dir=directory, prefix='.usb_settings', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as settings_file:
+            json.dump(settings, settings_file)
+            settings_file.flush()
+            os.fsync(settings_file.fileno())
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
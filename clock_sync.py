@@ -0,0 +1,170 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Put the adc counts of several devices read at the same time on one time base, the host's time.perf_counter clock.
+
+Each device samples on its own crystal, which runs a little fast or slow (its drift, in parts per million), and
+each device is started by its own 'R' message, so sample n of one device is not taken at the same time as sample n
+of another.  A ClockSync is given the host time each adc buffer of a device was finished (when its 'Done#' message
+was read) and fits a line from the device's samples to the host time by least squares, updated with each buffer so
+the fit is always ready and no time stamps are kept.  The slope of the line is the device's drift and the rest of
+the time stamps is the usb latency, which is averaged out.  The latency that all the devices have in common is left
+in the offset, so the devices are aligned to each other better than to the host clock.
+
+merge_recordings uses the fits to resample the raw recording of each device onto the same sample times, taking the
+nearest sample, so a device that runs fast has a sample dropped now and then and one that runs slow has one
+repeated.  The merged recording is a .plant file (see recording_format.py) with the channels of every device and
+the fit of each device in its metadata.  An adc buffer the device wrote over before it was exported (an overrun)
+shifts the rest of that device's samples, which shows up as a large residual in the fit.
+"""
+# standard libraries
+import time
+# installed libraries
+import numpy as np
+# local files
+import raw_recorder
+import recording_format
+
+__author__ = 'Kyle Vitautas Lopin'
+
+MERGE_CHUNK_SIZE = 2 ** 16  # samples of each channel to resample at a time when merging
+
+
+class ClockSync(object):
+    """ Running least squares fit of the host time each sample of a device was taken at """
+
+    def __init__(self, number_channels, sample_rate):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel the device is set to
+        """
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self, number_channels=None):
+        """ Clear the fit, call when a new data stream is started
+        :param number_channels: int, number of channels in the new data stream, None if it is the same
+        """
+        if number_channels:
+            self.number_channels = number_channels
+        self.adc_counts = 0  # adc counts in the buffers time stamped so far
+        self.first_time = None  # s, host time of the first time stamp, the fit is made relative to it
+        # Welford sums of the samples and of the host time less the time the samples would take at sample_rate
+        self.buffers = 0
+        self.mean_samples = 0.0
+        self.mean_error = 0.0
+        self.samples_variance = 0.0  # sums of squares of the differences from the means
+        self.error_variance = 0.0
+        self.covariance = 0.0
+        self.fit = (0.0, 0.0)  # host time of sample 0 less first_time, s per sample more than 1 / sample_rate
+
+    def add_buffer(self, adc_counts, host_time):
+        """ Add the time stamp of an adc buffer, called from the acquisition thread
+        :param adc_counts: int, number of adc counts in the buffer
+        :param host_time: float, time.perf_counter() the buffer was finished
+        """
+        self.adc_counts += adc_counts
+        if self.first_time is None:
+            self.first_time = host_time
+        samples = self.adc_counts / self.number_channels - 1  # the last sample of the buffer
+        error = host_time - self.first_time - samples / self.sample_rate
+        self.buffers += 1
+        samples_difference = samples - self.mean_samples
+        error_difference = error - self.mean_error
+        self.mean_samples += samples_difference / self.buffers
+        self.mean_error += error_difference / self.buffers
+        self.samples_variance += samples_difference * (samples - self.mean_samples)
+        self.error_variance += error_difference * (error - self.mean_error)
+        self.covariance += samples_difference * (error - self.mean_error)
+        slope = self.covariance / self.samples_variance if self.samples_variance else 0.0
+        # one tuple so other threads never see a half updated fit
+        self.fit = (self.mean_error - slope * self.mean_samples, slope)
+
+    def host_time(self, samples):
+        """ Get the host time samples were taken at
+        :param samples: int or numpy array of the sample numbers, from the start of the data stream
+        :return: float or numpy array of time.perf_counter() times
+        """
+        intercept, slope = self.fit
+        return self.first_time + intercept + samples * (1. / self.sample_rate + slope)
+
+    def sample_at(self, host_time):
+        """ Get the sample taken at a host time, the inverse of host_time
+        :param host_time: float or numpy array of time.perf_counter() times
+        :return: float or numpy array of sample numbers, not rounded
+        """
+        intercept, slope = self.fit
+        return (host_time - self.first_time - intercept) / (1. / self.sample_rate + slope)
+
+    def drift(self):
+        """ Get how much faster the device samples than its sample rate
+        :return: float, parts per million
+        """
+        slope = self.fit[1]
+        return 1e6 * (1. / (1. + slope * self.sample_rate) - 1.)
+
+    def residual(self):
+        """ Get the standard deviation of the time stamps around the fit, the usb latency jitter
+        :return: float, s
+        """
+        if self.buffers < 3 or not self.samples_variance:
+            return 0.0
+        residuals = self.error_variance - self.covariance ** 2 / self.samples_variance
+        return float(np.sqrt(max(residuals, 0.0) / (self.buffers - 2)))
+
+    def stats(self):
+        return {'buffers': self.buffers,
+                'drift ppm': self.drift(),
+                'residual ms': 1000 * self.residual()}
+
+
+def merge_recordings(recordings, filename, sample_rate, chunk_size=MERGE_CHUNK_SIZE):
+    """ Resample the raw recordings of several devices onto the same sample times and write them as one .plant file,
+    only the time all the devices were recording is kept
+    :param recordings: list of (str of the raw recording filename, ClockSync of the device it was recorded from)
+    :param filename: str, path of the .plant file to write
+    :param sample_rate: float, Hz, samples per second of the merged recording
+    :param chunk_size: int, samples of each channel to resample at a time
+    :return: dict of the metadata of the merged recording
+    """
+    sources = []
+    for raw_filename, clock in recordings:
+        if not clock.buffers:
+            raise ValueError("{0} has no time stamps to align it with".format(raw_filename))
+        header, adc_counts = raw_recorder.open_recording(raw_filename)
+        number_channels = header['number channels']
+        frames = adc_counts[:len(adc_counts) // number_channels * number_channels].reshape(-1, number_channels)
+        sources.append((header, frames, clock))
+    # the devices that started last and stopped first set the merged recording's times
+    start_time = max(clock.host_time(0) for _, _, clock in sources)
+    end_time = min(clock.host_time(len(frames) - 1) for _, frames, clock in sources)
+    number_samples = max(int((end_time - start_time) * sample_rate) + 1, 0)
+    devices = []
+    first_channel = 0
+    for (header, frames, clock), (raw_filename, _) in zip(sources, recordings):
+        devices.append({'raw recording': raw_filename,
+                        'first channel': first_channel,
+                        'number channels': header['number channels'],
+                        'counts to mVs': header['counts to mVs'],
+                        'voltage shift': header['voltage shift'],
+                        'filter': header['filter'],
+                        'first sample': int(round(clock.sample_at(start_time))),
+                        'drift ppm': clock.drift(),
+                        'residual ms': 1000 * clock.residual()})
+        first_channel += header['number channels']
+    wall_start_time = start_time + time.time() - time.perf_counter()
+    writer = recording_format.ChunkedRecordingWriter(filename, sample_rate, first_channel,
+                                                     sources[0][0]['counts to mVs'], chunk_size=chunk_size,
+                                                     devices=devices, **{'start time': wall_start_time})
+    merged = np.empty((chunk_size, first_channel), dtype=np.int16)
+    for chunk_start in range(0, number_samples, chunk_size):
+        length = min(chunk_size, number_samples - chunk_start)
+        sample_times = start_time + np.arange(chunk_start, chunk_start + length) / sample_rate
+        for (header, frames, clock), device in zip(sources, devices):
+            nearest = np.clip(np.rint(clock.sample_at(sample_times)).astype(np.int64), 0, len(frames) - 1)
+            channels = slice(device['first channel'], device['first channel'] + device['number channels'])
+            merged[:length, channels] = frames[nearest]
+        writer.append(merged[:length].ravel())
+    writer.close()
+    return writer.metadata
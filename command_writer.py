@@ -0,0 +1,184 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" One thread that writes every message to the OUT endpoint of the device, so messages from the tk thread, the
+acquisition threads and the stimulation protocol thread are never written at the same time.
+
+Messages are written in 2 priorities.  The data stream messages ('F#' to export an adc buffer and 'E' to stop)
+are written first, so changing a setting never holds up an adc buffer.  All the other messages are written in the
+order they are put.  A setting ('V####' offset voltage, 'S#' number of channels or 's|...' stimulator settings)
+that is put while a setting of the same kind is still waiting replaces the waiting one, so dragging a spinbox only
+sends the last value.  A setting is held until setting_interval after the last setting of its kind was written if
+nothing else is waiting, so a stream of settings takes the endpoint no more than every setting_interval and an 'F#'
+does not have to wait for them.  A setting never replaces one put before another kind of message (e.g. a 'G'), so
+the stimulator is always set before the stimulation it is for.
+
+A message that has to go out at an exact time (the 'G' that gives a stimulation) is not queued, write_now writes it
+from the calling thread as soon as the write in progress, if there is one, is done and returns when it was written.
+A stimulator setting still waiting in the queue is written just before it, so the stimulator is still set before
+the stimulation.  Every write holds write_lock, so the device still only gets one message at a time.
+"""
+# standard libraries
+import heapq
+import threading
+import time
+# local files
+from usb_constants import OUT_ENDPOINT
+
+__author__ = 'Kyle Vitautas Lopin'
+
+DATA_PRIORITY = 0
+CONTROL_PRIORITY = 1
+DATA_COMMANDS = ('F', 'E')  # first letter of the data stream messages
+SETTING_COMMANDS = ('V', 'S', 's')  # first letter of the messages only the newest of need to be sent
+STIMULATOR_COMMANDS = ('s',)  # first letter of the messages write_now writes first if they are waiting
+SETTING_INTERVAL = 0.02  # s, least time between writing 2 settings of the same kind if nothing else is waiting
+
+
+class CommandWriter(threading.Thread):
+    """ Thread that writes the messages put in its queue with write_function, in priority order """
+
+    def __init__(self, write_function, setting_interval=SETTING_INTERVAL):
+        """
+        :param write_function: function(message, endpoint) that writes a message to the device
+        :param setting_interval: float, s, least time between writing 2 settings of the same kind
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.write_function = write_function
+        self.setting_interval = setting_interval
+        self.last_setting_times = {}  # first letter: time.perf_counter() the last setting of that kind was written
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()  # held while a message is being written to the device
+        self.queue = []  # heap of [priority, sequence number, time put, message, endpoint]
+        self.sequence = 0
+        self.waiting_settings = {}  # first letter: queue entry of the setting of that kind that can still be replaced
+        self.running = True
+        # first letter: [messages written, total s from put to written, longest s, total s waiting in the queue]
+        self.latencies = {}
+        self.coalesced = {}  # first letter: messages replaced by a newer one before they were written
+
+    def put(self, message, endpoint=OUT_ENDPOINT):
+        """ Queue a message to write to the device
+        :param message: str to write
+        :param endpoint: OUT endpoint to write it to
+        """
+        kind = message[:1]
+        priority = DATA_PRIORITY if kind in DATA_COMMANDS else CONTROL_PRIORITY
+        with self.condition:
+            if kind in SETTING_COMMANDS and kind in self.waiting_settings:
+                entry = self.waiting_settings[kind]
+                entry[2:] = [time.perf_counter(), message, endpoint]
+                self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+                return
+            if priority == CONTROL_PRIORITY:
+                # a setting put after this message can not be moved in front of it
+                self.waiting_settings.clear()
+            entry = [priority, self.sequence, time.perf_counter(), message, endpoint]
+            self.sequence += 1
+            heapq.heappush(self.queue, entry)
+            if kind in SETTING_COMMANDS:
+                self.waiting_settings[kind] = entry
+            self.condition.notify()
+
+    def write_now(self, message, endpoint=OUT_ENDPOINT):
+        """ Write a message from the calling thread, ahead of every message waiting in the queue except the
+        stimulator settings
+        :param message: str to write
+        :param endpoint: OUT endpoint to write it to
+        :return: float, time.perf_counter() the write finished
+        """
+        put_time = time.perf_counter()
+        with self.write_lock:
+            with self.condition:
+                stimulator_entries = [entry for entry in self.queue if entry[3][:1] in STIMULATOR_COMMANDS]
+                if stimulator_entries:
+                    self.queue = [entry for entry in self.queue if entry[3][:1] not in STIMULATOR_COMMANDS]
+                    heapq.heapify(self.queue)
+                    for entry in stimulator_entries:
+                        if self.waiting_settings.get(entry[3][:1]) is entry:
+                            del self.waiting_settings[entry[3][:1]]
+            for entry in sorted(stimulator_entries):
+                entry_start = time.perf_counter()
+                self.write_function(entry[3], entry[4])
+                self.add_latency(entry[3][:1], entry[2], entry_start, time.perf_counter())
+                self.last_setting_times[entry[3][:1]] = time.perf_counter()
+            write_start = time.perf_counter()
+            self.write_function(message, endpoint)
+            written_time = time.perf_counter()
+            self.add_latency(message[:1], put_time, write_start, written_time)
+        return written_time
+
+    def stop_running(self):
+        """ Stop the thread after the messages already put are written """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.wait_for_entry():
+                    return
+            # the message is taken from the queue and written under write_lock, so write_now can not write in
+            # between and miss a stimulator setting that was taken but not written yet
+            with self.write_lock:
+                with self.condition:
+                    if not self.queue or self.hold_time() > 0:  # write_now took the message that was ready
+                        continue
+                    entry = heapq.heappop(self.queue)
+                    kind = entry[3][:1]
+                    if self.waiting_settings.get(kind) is entry:
+                        del self.waiting_settings[kind]
+                    put_time, message, endpoint = entry[2:]
+                write_start = time.perf_counter()
+                self.write_function(message, endpoint)
+                written_time = time.perf_counter()
+                self.add_latency(kind, put_time, write_start, written_time)
+                if kind in SETTING_COMMANDS:
+                    self.last_setting_times[kind] = written_time
+
+    def add_latency(self, kind, put_time, write_start, written_time):
+        """ Add a written message to the statistics, hold write_lock when calling this """
+        latencies = self.latencies.setdefault(kind, [0, 0.0, 0.0, 0.0])
+        latencies[0] += 1
+        latencies[1] += written_time - put_time
+        latencies[2] = max(latencies[2], written_time - put_time)
+        latencies[3] += write_start - put_time
+
+    def wait_for_entry(self):
+        """ Wait until the message at the front of the queue can be written, hold self.condition when calling this
+        :return: bool, False if the thread was stopped and every message is written
+        """
+        while True:
+            if not self.queue:
+                if not self.running:
+                    return False
+                self.condition.wait()
+                continue
+            hold_time = self.hold_time()
+            if hold_time <= 0:
+                return True
+            self.condition.wait(hold_time)
+
+    def hold_time(self):
+        """ Get how long to hold the message at the front of the queue, a setting is held when nothing else is
+        waiting so newer ones replace it, hold self.condition when calling this
+        :return: float, s until it can be written, 0 or less if it can be written now
+        """
+        kind = self.queue[0][3][:1]
+        if kind in SETTING_COMMANDS and len(self.queue) == 1 and self.running:
+            return self.last_setting_times.get(kind, 0) + self.setting_interval - time.perf_counter()
+        return 0
+
+    def stats(self):
+        """ Get the statistics of each kind of message
+        :return: dict of the first letter of the messages: dict of the messages written, the average and longest
+        time from when they were put to when they were written and the average time they waited in the queue before
+        being written in seconds, and the messages replaced by newer ones
+        """
+        return {kind: {'written': written,
+                       'latency': total / max(written, 1),
+                       'max latency': longest,
+                       'queue wait': waiting / max(written, 1),
+                       'coalesced': self.coalesced.get(kind, 0)}
+                for kind, (written, total, longest, waiting) in self.latencies.items()}
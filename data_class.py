@@ -4,14 +4,22 @@
 """ Data class that will be updated from the USB and then call the graph to be updated
 """
 #standard libraries
-import array
+import bisect
 import datetime
 import logging
 import os
-import pickle
+import threading
 import tkinter as tk
+import zipfile
 from tkinter import filedialog
+# installed libraries
+import numpy as np
 # local files
+import epochs
+import min_max_pyramid
+import raw_recorder
+import recording_format
+import running_stats
 import save_toplevel
 
 
@@ -19,10 +27,12 @@ __author__ = 'Kyle V. Lopin'
 
 # constants
 SAMPLE_RATE = 5000.0  # Hz
-MAX_READING_TIME = 200  # s
+MAX_READING_TIME = 200  # s, longest time the live display can show, older display points are written over
 RATE_TO_DISPLAY = 500.0 # Hz
 DISPLAY_BUFFER_SIZE = int(MAX_READING_TIME * RATE_TO_DISPLAY)  # s/s - unitless
 SAMPLING_RATIO = int(SAMPLE_RATE / RATE_TO_DISPLAY)
+SAVE_CHUNK_SIZE = 2 ** 20  # samples of a channel to copy at a time when saving
+MAX_MEMORY_COUNTS = 2 ** 23  # adc counts kept in memory when there is no recorder, the oldest buffers are dropped
 
 class StreamingData(object):
     def __init__(self):
@@ -31,17 +41,41 @@ class StreamingData(object):
         self.end_time = 0
         self.graph = None
         self.save_state = SaveState()
-        # self.t_data = array.array('f')
-        self.t_data = array.array('f')
-        for i in range(DISPLAY_BUFFER_SIZE):
-            self.t_data.append(i*self.sampling_period)
-        logging.debug('t data: {0}'.format(self.t_data[0:10]))
+        # the display buffers are rings that every point is written to twice, at display_data_ptr %
+        # DISPLAY_BUFFER_SIZE and DISPLAY_BUFFER_SIZE after that, so the newest points are always in one slice
+        self.t_data = np.zeros(2 * DISPLAY_BUFFER_SIZE)
         self.raw_data_ptr = 0
-        self.display_data_ptr = 0
+        self.display_data_ptr = 0  # display points written since the data was cleared
+        self.display_start_ptr = 0  # display point the rings were last started from (see set_display_mode)
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 packets
+        # 'stride' displays every SAMPLING_RATIO-th sample, 'envelope' the min and max of every 2*SAMPLING_RATIO,
+        # 'off' does not fill the display buffers, for when there is no display
+        self.display_mode = 'stride'  # type: str
         self.counts_to_volts = 1
         self.voltage_shift = 0
-        self.adc_counts = [array.array('h')]
-        self.y_data_to_display = [array.array('f', [0] * DISPLAY_BUFFER_SIZE)
+        # the stored adc counts are numbered from when the data was cleared, the newest are kept in memory when there
+        # is no recorder and the ones from recording_start on are in the recorder when there is one
+        self.adc_counts_stored = 0  # adc counts stored since the data was cleared
+        self.adc_counts = []  # adc buffers kept in memory when there is no recorder, no more than MAX_MEMORY_COUNTS
+        self.adc_counts_ends = []  # stored adc counts by the end of each buffer in adc_counts
+        self.memory_start = 0  # stored adc count the first buffer in adc_counts starts at
+        self.memory_dropped = False  # adc counts were dropped from memory since it took over from the recorder
+        self.recorder = None  # type: raw_recorder.RawRecorder
+        self.recording_start = 0  # stored adc count the recorder starts at
+        self.scratch_recording = False  # the recorder's file was made for unsaved data and is deleted if not saved
+        self.pyramid = min_max_pyramid.MinMaxPyramid(self.number_channels)
+        # stream_filter.StreamingFilters for the adc counts that are displayed and that are stored, None for raw
+        self.display_filter = None
+        self.storage_filter = None
+        self.event_detector = None  # type: event_detector.EventDetector  finds events in the stored adc counts
+        self.statistics = running_stats.RunningStatistics(self.number_channels, SAMPLE_RATE)
+        self.statistics_display = None  # panel that shows the running statistics, updated with the plot
+        self.calibration = None  # type: calibration.StreamingCalibration  gets the raw adc counts while calibrating
+        self.adc_counts_read = 0  # raw adc counts given to extend since the data was cleared
+        self.stimuli = epochs.StimulusTable()  # raw sample each stimulation was given at
+        self.stimulus_lock = threading.Lock()  # stimulations can be marked from a stimulation protocol thread
+        self.epoch_engine = None  # type: epochs.EpochEngine  cuts and averages the response to each stimulation
+        self.y_data_to_display = [np.zeros(2 * DISPLAY_BUFFER_SIZE, dtype=np.float32)
                                   for _ in range(self.number_channels)]
 
         # to save the data use the format of 'AXXYYZZ' where A is a letter, A, B, C..
@@ -54,94 +88,536 @@ class StreamingData(object):
     def set_count_to_volts(self, counts_to_volts, voltage_shift):
         self.counts_to_volts = counts_to_volts
         self.voltage_shift = voltage_shift
+        if self.recorder:
+            self.recorder.set_count_to_volts(counts_to_volts, voltage_shift)
 
     def add_display_area(self, graph):
         self.graph = graph
 
+    def add_statistics_display(self, statistics_display):
+        """ Set a panel to update with the running statistics every time the plot is updated
+        :param statistics_display: object with an update_statistics(statistics) method
+        """
+        self.statistics_display = statistics_display
+
     def extend(self, data):
-        """ Take in an array of int16 and add it to the data so far
+        """ Take in an array of int16 and add it to the data so far, the data is written to the recording file if
+        one is open, else the last MAX_MEMORY_COUNTS are kept in memory.  The stored and displayed data go through the
+        storage and display filters if they are set
         :param data:
         :return:
         """
-        self.adc_counts.extend(data)
-        self.sample_signal(data, SAMPLING_RATIO)
+        if self.calibration:
+            self.calibration.process(data)
+        with self.stimulus_lock:
+            self.adc_counts_read += len(data)
+            if self.epoch_engine:
+                self.epoch_engine.process(data)
+        stored_data = self.storage_filter.process(data) if self.storage_filter else data
+        if self.display_filter is self.storage_filter:
+            display_data = stored_data
+        else:
+            display_data = self.display_filter.process(data) if self.display_filter else data
+        self.adc_counts_stored += len(stored_data)
+        if self.recorder:
+            self.recorder.append(stored_data)
+        else:
+            self.adc_counts.append(np.array(stored_data, dtype=np.int16))
+            self.adc_counts_ends.append(self.adc_counts_stored)
+            # drop the oldest buffers, the pyramid still has them for the display
+            drop = bisect.bisect_left(self.adc_counts_ends, self.adc_counts_stored - MAX_MEMORY_COUNTS)
+            if drop:
+                if not self.memory_dropped:
+                    logging.warning('no recording is open, only the last {0} adc counts are kept from now on'.format(
+                        MAX_MEMORY_COUNTS))
+                    self.memory_dropped = True
+                self.memory_start = self.adc_counts_ends[drop - 1]
+                del self.adc_counts[:drop], self.adc_counts_ends[:drop]
+        self.pyramid.append(stored_data)
+        self.statistics.update(stored_data)
+        if self.event_detector:
+            self.event_detector.process(stored_data)
+        if self.display_mode == 'envelope':
+            self.envelope_signal(display_data, SAMPLING_RATIO)
+        elif self.display_mode == 'stride':
+            self.sample_signal(display_data, SAMPLING_RATIO)
+
+    def set_filters(self, display_filter=None, storage_filter=None):
+        """ Set the filters of the displayed and stored data, the same filter can be used for both
+        :param display_filter: stream_filter.StreamingFilter or None to display the raw adc counts
+        :param storage_filter: stream_filter.StreamingFilter or None to store the raw adc counts
+        """
+        self.display_filter = display_filter
+        self.storage_filter = storage_filter
+        if self.recorder:
+            self.recorder.set_filter(self.storage_filter_settings())
+
+    def storage_filter_settings(self):
+        """ Get the settings of the filter the stored adc counts go through, to record with them
+        :return: dict of the filter settings (see stream_filter.StreamingFilter.settings), None if they are raw
+        """
+        return self.storage_filter.settings if self.storage_filter else None
+
+    def set_display_mode(self, mode):
+        """ Change how the data is down sampled for the display, the display is cleared (the stored data is not).
+        The display starts again from the next frame a display point falls on, so its times stay those of the
+        recording that the events, stimulations and get_display_range use
+        :param mode: 'stride', 'envelope' or 'off'
+        """
+        self.display_mode = mode
+        counts_per_point = SAMPLING_RATIO * self.number_channels
+        self.display_data_ptr = self.display_start_ptr = -(-self.adc_counts_stored // counts_per_point)
+        # adc counts of the next packet before the frame of the first display point
+        self.raw_data_ptr = self.display_data_ptr * counts_per_point - self.adc_counts_stored
+        self.end_time = max(self.display_data_ptr - 1, 0) * self.sampling_period
+        self.partial_frame = np.empty(0, dtype=np.int16)
+        self.t_data[:] = 0
+        for data_to_display in self.y_data_to_display:
+            data_to_display[:] = 0
+
+    def set_calibration(self, _calibration):
+        """ Set the calibration to give the raw adc counts to as they are read
+        :param _calibration: calibration.StreamingCalibration or None when the calibration is done
+        """
+        self.calibration = _calibration
+
+    def mark_stimulus(self, sample):
+        """ Stamp a stimulation with the raw sample it was given at and start an epoch for it.  The adc buffers reach
+        this class some time after they are sampled, so the device works out the sample from the acquisition side
+        (see PlantUSB.stimulus_sample)
+        :param sample: int, raw sample of the stimulation
+        :return: int, raw sample of the stimulation
+        """
+        with self.stimulus_lock:
+            self.stimuli.append(sample)
+            if self.epoch_engine:
+                self.epoch_engine.add_stimulus(sample)
+        return sample
+
+    def set_epoch_engine(self, engine):
+        """ Set the engine to cut an epoch around each stimulation with, the stimuli already given are not cut
+        :param engine: epochs.EpochEngine or None to stop cutting epochs
+        """
+        self.epoch_engine = engine
+
+    def get_stimuli(self, start_time, end_time):
+        """ Get the stimulations given between 2 times
+        :param start_time: float, s from the start of the recording
+        :param end_time: float, s from the start of the recording
+        :return: numpy array of the raw sample of each stimulation
+        """
+        return self.stimuli.in_range(int(start_time * SAMPLE_RATE), int(end_time * SAMPLE_RATE) + 1)
+
+    def set_event_detector(self, detector):
+        """ Set the detector to find events in the stored adc counts with
+        :param detector: event_detector.EventDetector or None to stop finding events
+        """
+        self.event_detector = detector
+
+    def get_events(self, start_time, end_time):
+        """ Get the events the event detector found between 2 times
+        :param start_time: float, s from the start of the recording
+        :param end_time: float, s from the start of the recording
+        :return: numpy structured array of event_detector.EVENT_DTYPE, or None if there is no event detector
+        """
+        if not self.event_detector:
+            return None
+        return self.event_detector.table.in_range(int(start_time * SAMPLE_RATE), int(end_time * SAMPLE_RATE) + 1)
+
+    def get_statistics(self):
+        """ Get the running statistics of each channel of the stored adc counts
+        :return: dict of numpy arrays, see running_stats.RunningStatistics.statistics, or None before the first block
+        """
+        return self.statistics.statistics(self.counts_to_volts)
+
+    def start_recording(self, filename=None):
+        """ Start writing the adc counts to a raw recording file as they come in.  The file is kept if the program
+        crashes.  A file made in the data folder for unsaved data is deleted by stop_recording, when the data is
+        cleared, a new recording is started or the program is closed, unless the data was saved (see call_save)
+        :param filename: str, path of the file to record to, if None the file is made in the data folder of today
+        """
+        self.stop_recording()
+        # the recorder has the adc counts from here on, the ones in memory are let go
+        self.recording_start = self.memory_start = self.adc_counts_stored
+        self.adc_counts, self.adc_counts_ends = [], []
+        if not filename:
+            data_path = os.path.join(os.getcwd(), 'data', self.save_state.date_str)
+            if not os.path.exists(data_path):
+                os.makedirs(data_path)
+            filename = os.path.join(data_path, 'unsaved_{0}.raw'.format(datetime.datetime.now().strftime('%H%M%S')))
+            self.scratch_recording = True
+        self.recorder = raw_recorder.RawRecorder(filename, SAMPLE_RATE, self.number_channels,
+                                                 self.counts_to_volts, self.voltage_shift,
+                                                 filter_settings=self.storage_filter_settings())
+        logging.info('recording to {0}'.format(filename))
+
+    def stop_recording(self):
+        """ Close the recording file, it is left where it is unless it is an unsaved recording made in the data
+        folder, which is deleted.  The adc counts stored after this are kept in memory """
+        if self.recorder:
+            self.recorder.close()
+            if self.scratch_recording:
+                os.remove(self.recorder.filename)
+                logging.info('deleted unsaved recording {0}'.format(self.recorder.filename))
+            self.recorder = None
+        self.scratch_recording = False
+        self.memory_start = self.adc_counts_stored
+        self.memory_dropped = False
+
+    def flush_recording(self):
+        if self.recorder:
+            self.recorder.flush()
+
+    def get_raw_data(self):
+        """ Get the stored adc counts from first_raw_frame on, served from the recording file if one is open, else
+        from memory
+        :return: numpy array of int16 adc counts interleaved by channel
+        """
+        if self.recorder:
+            return self.recorder.samples()
+        if self.adc_counts:
+            return np.concatenate(self.adc_counts)
+        return np.empty(0, dtype=np.int16)
+
+    def first_raw_frame(self):
+        """ Get the first frame that get_raw_frames can get, the frames before it were saved (see call_save) or
+        dropped from memory, only the pyramid still has them
+        :return: int, frame from when the data was cleared
+        """
+        first_count = self.recording_start if self.recorder else self.memory_start
+        return -(-first_count // self.number_channels)
+
+    def get_raw_frames(self, start_frame, end_frame):
+        """ Get the adc counts of a range of frames, without copying the whole recording, the range is cut to start
+        at first_raw_frame
+        :param start_frame: int, first frame to get
+        :param end_frame: int, frame to stop before
+        :return: numpy array (frames, channels) of int16
+        """
+        number_channels = self.number_channels
+        end_frame = min(end_frame, self.pyramid.frames)
+        start_frame = min(max(start_frame, self.first_raw_frame()), end_frame)
+        start, end = start_frame * number_channels, end_frame * number_channels
+        if self.recorder:
+            adc_counts = self.recorder.read(start - self.recording_start, end - self.recording_start)
+        else:  # only join the buffers the range is in
+            first = bisect.bisect_right(self.adc_counts_ends, start)
+            last = bisect.bisect_left(self.adc_counts_ends, end) + 1
+            buffers_start = self.adc_counts_ends[first - 1] if first else self.memory_start
+            adc_counts = self.adc_counts[first:last]
+            adc_counts = np.concatenate(adc_counts) if adc_counts else np.empty(0, dtype=np.int16)
+            adc_counts = adc_counts[start - buffers_start:end - buffers_start]
+        return adc_counts.reshape(-1, number_channels)
+
+    def get_display_range(self, start_time, end_time, max_points):
+        """ Get the data between 2 times from the level of the min/max pyramid that has about max_points in the
+        range, the raw data is used if it has no more than max_points.  Each bucket of a pyramid level is given as
+        its minimum followed by its maximum, so it can be drawn as a line that goes through every extreme
+        :param start_time: float, s from the start of the recording
+        :param end_time: float, s from the start of the recording
+        :param max_points: int, about how many points to get, e.g. the width of the plot in pixels
+        :return: numpy array of times, list of a numpy array of mV for each channel, the raw data is only used from
+        first_raw_frame on
+        """
+        start_frame = max(int(start_time * SAMPLE_RATE), 0)
+        end_frame = min(int(np.ceil(end_time * SAMPLE_RATE)) + 1, self.pyramid.frames)
+        level_number = self.pyramid.choose_level(start_frame, end_frame, max_points)
+        if level_number == 0:
+            start_frame = max(start_frame, self.first_raw_frame())
+            frames = self.get_raw_frames(start_frame, end_frame)
+            t_data = (start_frame + np.arange(len(frames))) / SAMPLE_RATE
+            return t_data, [frames[:, i] * self.counts_to_volts for i in range(self.number_channels)]
+        bucket_size = self.pyramid.levels[level_number - 1].bucket_size
+        if level_number < self.pyramid.first_stored_level:  # work out the level from the raw data
+            # only whole buckets that the raw data has
+            first = max(start_frame // bucket_size, -(-self.first_raw_frame() // bucket_size))
+            frames = self.get_raw_frames(first * bucket_size, end_frame)
+            mins, maxs = min_max_pyramid.reduce_frames(frames, bucket_size)
+        else:
+            first, mins, maxs = self.pyramid.get_range(level_number, start_frame, end_frame)
+        bucket_starts = (first + np.arange(len(mins))) * bucket_size
+        t_data = np.column_stack((bucket_starts, bucket_starts + bucket_size // 2)).ravel() / SAMPLE_RATE
+        y_data = [np.column_stack((mins[:, i], maxs[:, i])).ravel() * self.counts_to_volts
+                  for i in range(self.number_channels)]
+        return t_data, y_data
+
+    def write_display(self, channel_points):
+        """ Add points to the display rings, after MAX_READING_TIME the oldest points are written over
+        :param channel_points: list of a numpy array of mV for each channel, all the same length
+        """
+        number_points = len(channel_points[0])
+        ring_index = (self.display_data_ptr + np.arange(number_points)) % DISPLAY_BUFFER_SIZE
+        for data_to_display, points in zip(self.y_data_to_display, channel_points):
+            data_to_display[ring_index] = points
+            data_to_display[ring_index + DISPLAY_BUFFER_SIZE] = points
+        times = (self.display_data_ptr + np.arange(number_points)) * self.sampling_period
+        self.t_data[ring_index] = times
+        self.t_data[ring_index + DISPLAY_BUFFER_SIZE] = times
+        self.display_data_ptr += number_points
+        # this will give the time that has been read so far
+        self.end_time = max(self.display_data_ptr - 1, 0) * self.sampling_period
+
+    def display_window(self, time_to_display=MAX_READING_TIME):
+        """ Get the newest display points without copying them
+        :param time_to_display: float, s of data to get, no more than MAX_READING_TIME
+        :return: numpy view of the times, list of a numpy view of the mV of each channel
+        """
+        number_points = min(int(time_to_display / self.sampling_period) + 1,
+                            self.display_data_ptr - self.display_start_ptr, DISPLAY_BUFFER_SIZE)
+        window_end = self.display_data_ptr % DISPLAY_BUFFER_SIZE + DISPLAY_BUFFER_SIZE
+        window_start = window_end - number_points
+        return (self.t_data[window_start:window_end],
+                [data_to_display[window_start:window_end] for data_to_display in self.y_data_to_display])
 
     def display_data(self):
         """ Display the data
         :return:
         """
-        self.graph.display_data()
+        if self.graph:
+            self.graph.display_data()
+        if self.statistics_display:
+            self.statistics_display.update_statistics(self.get_statistics())
 
     def sample_signal(self, data_packet, skip):
+        """ Down sample an interleaved packet of adc counts into the display buffers.  The channels are
+        separated with strided views of the packet and every skip-th frame is kept, where a frame is one
+        adc count from each channel.  raw_data_ptr keeps where the next frame to display starts in the next
+        packet, and a frame split between 2 packets is held in partial_frame until the rest of it arrives
+        :param data_packet: array of int16 adc counts, interleaved by channel
+        :param skip: int, how many frames to advance between displayed points
+        """
+        data_packet = np.asarray(data_packet, dtype=np.int16)
+        if self.partial_frame.size:
+            data_packet = np.concatenate((self.partial_frame, data_packet))
+            self.partial_frame = self.partial_frame[:0]
         _len = len(data_packet)
         number_channels = self.number_channels
-        while self.raw_data_ptr < _len:
-            for data_to_display in self.y_data_to_display:
-                data_to_display[self.display_data_ptr] = (data_packet[self.raw_data_ptr]
-                                                          * self.counts_to_volts)
-                                                          # + self.voltage_shift)
-                self.raw_data_ptr += 1
-            self.raw_data_ptr += (skip * number_channels) - number_channels
-            self.display_data_ptr += 1
-
-        self.raw_data_ptr -= _len
-        # this will give the time that has been read so far
-        self.end_time = self.t_data[self.display_data_ptr-1]
-        # print('end time: {0}'.format(self.end_time))
+        stride = skip * number_channels
+        # number of complete frames to display that start in this packet
+        number_points = 0
+        if self.raw_data_ptr + number_channels <= _len:
+            number_points = (_len - number_channels - self.raw_data_ptr) // stride + 1
+        last_point = self.raw_data_ptr + (number_points - 1) * stride + 1
+        self.write_display([data_packet[self.raw_data_ptr + i:last_point + i:stride] * self.counts_to_volts
+                            for i in range(number_channels)])
+        # + self.voltage_shift)
+
+        self.raw_data_ptr += number_points * stride
+        if self.raw_data_ptr < _len:  # the next frame to display was cut off at the end of the packet
+            self.partial_frame = data_packet[self.raw_data_ptr:].copy()
+            self.raw_data_ptr = 0
+        else:
+            self.raw_data_ptr -= _len
+
+    def envelope_signal(self, data_packet, skip):
+        """ Down sample an interleaved packet of adc counts into the display buffers by keeping the minimum and
+        maximum of each channel in every bucket of 2*skip frames, in the order they happened.  This gives as many
+        display points as sample_signal but no spike between the displayed points is lost.  The frames of a bucket
+        that is not full at the end of the packet are held in partial_frame until the rest of it arrives
+        :param data_packet: array of int16 adc counts, interleaved by channel
+        :param skip: int, frames for each displayed point
+        """
+        data_packet = np.asarray(data_packet, dtype=np.int16)
+        if self.raw_data_ptr:  # the display was started part way into the packet (see set_display_mode)
+            skipped = min(self.raw_data_ptr, len(data_packet))
+            data_packet = data_packet[skipped:]
+            self.raw_data_ptr -= skipped
+        if self.partial_frame.size:
+            data_packet = np.concatenate((self.partial_frame, data_packet))
+        number_channels = self.number_channels
+        bucket_size = 2 * skip * number_channels  # adc counts in a bucket
+        number_buckets = len(data_packet) // bucket_size
+        self.partial_frame = data_packet[number_buckets * bucket_size:].copy()
+        buckets = data_packet[:number_buckets * bucket_size].reshape(number_buckets, 2 * skip, number_channels)
+        first_index = np.arange(number_buckets)[:, np.newaxis]
+        min_index = buckets.argmin(axis=1)
+        max_index = buckets.argmax(axis=1)
+        min_first = min_index <= max_index
+        bucket_range = np.empty((number_buckets, 2, number_channels), dtype=np.int16)
+        bucket_range[:, 0, :] = np.where(min_first, buckets[first_index, min_index, np.arange(number_channels)],
+                                         buckets[first_index, max_index, np.arange(number_channels)])
+        bucket_range[:, 1, :] = np.where(min_first, buckets[first_index, max_index, np.arange(number_channels)],
+                                         buckets[first_index, min_index, np.arange(number_channels)])
+        self.write_display([bucket_range[:, :, i].ravel() * self.counts_to_volts for i in range(number_channels)])
 
     def clear(self):
-        self.adc_counts = [array.array('h')]
+        """ Clear the data, a recording that was open is closed and a new one for unsaved data is started, so the
+        adc counts read from now on are not only kept in memory """
+        was_recording = bool(self.recorder)
+        self.stop_recording()
+        self.adc_counts_stored = 0
+        self.adc_counts = []
+        self.adc_counts_ends = []
+        self.memory_start = 0
+        self.recording_start = 0
+        self.pyramid = min_max_pyramid.MinMaxPyramid(self.number_channels)
+        for _filter in (self.display_filter, self.storage_filter):
+            if _filter:
+                _filter.reset(self.number_channels)
+        if self.event_detector:
+            self.event_detector.reset(self.number_channels)
+        self.statistics.reset(self.number_channels)
+        if self.epoch_engine:
+            self.epoch_engine.reset(self.number_channels)
+        self.adc_counts_read = 0
+        self.stimuli = epochs.StimulusTable()
         self.end_time = 0
         self.raw_data_ptr = 0
         self.display_data_ptr = 0
-        self.y_data_to_display = [array.array('f', [0] * DISPLAY_BUFFER_SIZE)
+        self.display_start_ptr = 0
+        self.partial_frame = np.empty(0, dtype=np.int16)
+        self.t_data = np.zeros(2 * DISPLAY_BUFFER_SIZE)
+        self.y_data_to_display = [np.zeros(2 * DISPLAY_BUFFER_SIZE, dtype=np.float32)
                                   for _ in range(self.number_channels)]
         logging.debug('ydisplay: {0}'.format(len(self.y_data_to_display)))
+        if was_recording:
+            self.start_recording()
 
     def set_number_channels(self, num):
         self.number_channels = num
         self.clear()
         if self.graph:
-            self.graph.draw_new_data(self.t_data, self.y_data_to_display)
+            self.graph.draw_new_data(*self.display_window())
 
     def get_time_series(self):
-        return self.t_data
+        return self.display_window()[0]
 
     def get_voltage_data(self):
-        return self.y_data_to_display
+        return self.display_window()[1]
 
     def call_save(self):
-        # SaveTopLevel(self)
+        """ Ask the user for a file name and save the data.  A .raw file is the recording file moved to the new name,
+        a .plant (see recording_format.py) or .npz file has each channel separately and is written by a SaveThread
+        so the GUI keeps running
+        :return: SaveThread writing the file, or None if nothing is left to write
+        """
         file_opts = {}
         file_opts['initialdir'] = os.getcwd()+'\data\{0}'.format(self.save_state.date_str)
-        file_opts['filetypes'] = [("Pickle File", "*.pkl")]
+        file_opts['filetypes'] = [("Compressed recording", "*.plant"), ("NumPy channel file", "*.npz"),
+                                  ("Raw recording", "*.raw")]
+        file_opts['defaultextension'] = '.plant'
         filename = filedialog.asksaveasfilename(**file_opts)
-        filename += '.pkl'
-        # print('save as file: {0}'.format(filename))
-        # print("len raw data: {0}; number channels: {1}".format(len(self.adc_counts), self.number_channels))
-        # print('last adc count: {0}; first adc count: {1}'.format(self.adc_counts[-1], self.adc_counts[0]))
-        len_channel = int(len(self.adc_counts) / self.number_channels)
-        # print('len channel: {0}'.format(len_channel))
-        channel_data = dict()
-        for i in range(self.number_channels):
-            channel_data["channel {0}".format(i)] = array.array('h')
-        data_ptr = 1
-        # print('channel data: {0}'.format(channel_data))
-        for i in range(len_channel-1):
-            for j in range(self.number_channels):
-                # print('j: {0}; i: {1}; data_ptr: {2}'.format(j, i, data_ptr))
-                channel_data["channel {0}".format(j)].append(self.adc_counts[data_ptr])
-                data_ptr += 1
-        # for ch in channel_data:
-            # print(channel_data[ch])
-        data_struct = dict()
-        data_struct['sample rate'] = SAMPLE_RATE
-        data_struct['counts to mVs'] = self.counts_to_volts
-        for _data_ch in channel_data:
-            data_struct[_data_ch] = channel_data[_data_ch]
-
-        with open(filename, 'wb') as f:
-            pickle.dump(data_struct, f, pickle.HIGHEST_PROTOCOL)
+        if not filename:
+            return None
+        base_filename, extension = os.path.splitext(filename)
+        recorded = bool(self.recorder)
+        if recorded:  # the data is already on the disk, finish the recording file and read it back from there
+            raw_filename = self.recorder.finalize(base_filename + '.raw')
+            self.recorder = None
+            self.scratch_recording = False
+            self.memory_start = self.adc_counts_stored  # the adc counts read from now on are kept in memory
+            header, adc_counts = raw_recorder.open_recording(raw_filename)
+            filter_settings = header['filter']
+        else:
+            adc_counts = self.get_raw_data()
+            filter_settings = self.storage_filter_settings()
+            if self.memory_dropped:
+                logging.warning('only the last {0:.1f} s are saved, the adc counts before were dropped from '
+                                'memory'.format(len(adc_counts) / self.number_channels / SAMPLE_RATE))
+        if extension == '.raw':
+            if not recorded:  # there was no recording file, write the raw adc counts
+                recorder = raw_recorder.RawRecorder(filename, SAMPLE_RATE, self.number_channels,
+                                                    self.counts_to_volts, self.voltage_shift, len(adc_counts) + 1,
+                                                    filter_settings=filter_settings)
+                recorder.append(adc_counts)
+                recorder.close()
+            return None
+        if extension != '.npz':
+            extension = '.plant'
+        save_thread = SaveThread(base_filename + extension, adc_counts, self.number_channels, self.counts_to_volts,
+                                 filter_settings)
+        save_thread.start()
+        return save_thread
+
+
+def split_channels(adc_counts, number_channels):
+    """ Separate interleaved adc counts into each channel without copying them
+    :param adc_counts: numpy array of int16 adc counts interleaved by channel
+    :param number_channels: int, number of channels interleaved
+    :return: list of strided numpy views, one for each channel, only whole frames are included
+    """
+    len_channel = len(adc_counts) // number_channels
+    return [adc_counts[i:len_channel * number_channels:number_channels] for i in range(number_channels)]
+
+
+class SaveThread(threading.Thread):
+    """ Write each channel to a .plant file (see recording_format.py) or a .npz file (that numpy.load can read) in a
+    separate thread.  The adc counts are copied out SAVE_CHUNK_SIZE samples of each channel at a time so the memory
+    used stays the same no matter how long the recording is.  progress goes from 0 to 1 as the file is written.
+    """
+
+    def __init__(self, filename, adc_counts, number_channels, counts_to_volts, filter_settings=None):
+        """
+        :param filename: str, path of the .plant or .npz file to write
+        :param adc_counts: numpy array (or memmap) of int16 adc counts interleaved by channel
+        :param number_channels: int, number of channels interleaved
+        :param counts_to_volts: float, mV per adc count
+        :param filter_settings: dict of the settings of the filter the adc counts went through, None if they are raw,
+        kept in the metadata of a .plant file
+        """
+        threading.Thread.__init__(self)
+        self.filename = filename
+        self.adc_counts = adc_counts
+        self.number_channels = number_channels
+        self.counts_to_volts = counts_to_volts
+        self.filter_settings = filter_settings
+        self.progress = 0.0  # type: float
+        self.error = None  # type: Exception
+
+    def run(self):
+        try:
+            self.save()
+        except Exception as error:
+            logging.error("Saving {0} failed: {1}".format(self.filename, error))
+            self.error = error
+
+    def save(self):
+        if self.filename.endswith('.npz'):
+            self.save_npz()
+        else:
+            self.save_chunked()
+        self.progress = 1.0
+        logging.info("Saved data in {0}".format(self.filename))
+
+    def save_chunked(self):
+        writer = recording_format.ChunkedRecordingWriter(self.filename, SAMPLE_RATE, self.number_channels,
+                                                         self.counts_to_volts, filter=self.filter_settings)
+        step = SAVE_CHUNK_SIZE * self.number_channels
+        total_counts = max(len(self.adc_counts), 1)
+        try:
+            for start in range(0, len(self.adc_counts), step):
+                writer.append(self.adc_counts[start:start + step])
+                self.progress = min(start + step, total_counts) / total_counts
+        finally:
+            writer.close()
+        logging.info("compression ratio: {0:.2f}".format(writer.compression_ratio()))
+
+    def save_npz(self):
+        channels = split_channels(self.adc_counts, self.number_channels)
+        total_samples = max(sum(len(channel) for channel in channels), 1)
+        samples_saved = 0
+        with zipfile.ZipFile(self.filename, 'w', allowZip64=True) as npz_file:
+            write_npz_array(npz_file, 'sample rate', np.array(SAMPLE_RATE))
+            write_npz_array(npz_file, 'counts to mVs', np.array(self.counts_to_volts))
+            for i, channel in enumerate(channels):
+                with npz_file.open('channel {0}.npy'.format(i), 'w', force_zip64=True) as npy_file:
+                    np.lib.format.write_array_header_2_0(npy_file, {'descr': np.lib.format.dtype_to_descr(
+                        np.dtype(np.int16)), 'fortran_order': False, 'shape': (len(channel),)})
+                    for start in range(0, len(channel), SAVE_CHUNK_SIZE):
+                        chunk = np.ascontiguousarray(channel[start:start + SAVE_CHUNK_SIZE])
+                        npy_file.write(chunk.tobytes())
+                        samples_saved += len(chunk)
+                        self.progress = samples_saved / total_samples
+
+
+def write_npz_array(npz_file, name, _array):
+    """ Write a small array into an open .npz file
+    :param npz_file: zipfile.ZipFile opened for writing
+    :param name: str, name numpy.load will give the array
+    :param _array: numpy array to write
+    """
+    with npz_file.open(name + '.npy', 'w') as npy_file:
+        np.lib.format.write_array(npy_file, _array)
 
 
 class SaveTopLevel(tk.Toplevel):
@@ -17,8 +17,12 @@ import tkinter as tk
 # installed libraries
 # local files
 import data_class
+import epochs
+import event_detector
 import plotter
+import statistics_panel
 import stimulation_window
+import stream_filter
 import usb_comm
 
 
@@ -51,6 +55,12 @@ class DataStreamingViewer(tk.Tk):
         self.time_var = tk.IntVar()
         self.vdac_var = tk.IntVar()
         self.gain_var = tk.IntVar()
+        self.envelope_var = tk.BooleanVar()
+        self.render_worker_var = tk.BooleanVar()
+        self.filter_display_var = tk.BooleanVar()
+        self.filter_storage_var = tk.BooleanVar()
+        self.detect_events_var = tk.BooleanVar()
+        self.average_stimuli_var = tk.BooleanVar()
 
         # make directory and start logging file
         date = str(datetime.date.today())
@@ -64,6 +74,9 @@ class DataStreamingViewer(tk.Tk):
         # time_frame = tk.Frame(self)
         self.create_time_frame(control_frame)
         control_frame.pack(side='top')
+        filter_frame = tk.Frame(self)
+        self.create_filter_frame(filter_frame)
+        filter_frame.pack(side='top')
         offset_frame = tk.Frame(self)
         self.create_offset_frame(offset_frame)
         self.create_gain_frame(offset_frame)
@@ -77,21 +90,43 @@ class DataStreamingViewer(tk.Tk):
         self.clear_button = tk.Button(button_frame1, text='Clear Data', command=self.data.clear)
         self.clear_button.pack(side='left')
         self.calibrate_button = tk.Button(button_frame1, text='Calibrate', command=self.calibrate)
+        tk.Checkbutton(button_frame1, text='Show min/max', variable=self.envelope_var,
+                       command=self.set_display_mode).pack(side='left')
+        tk.Checkbutton(button_frame1, text='Draw in background', variable=self.render_worker_var,
+                       command=self.set_render_worker).pack(side='left')
         # self.calibrate_button.pack(side='left')
 
         self.data_plot = plotter.Plotter(self, self.data)
         self.data_plot.pack(side='top', fill=tk.BOTH, expand=True)
         self.data.add_display_area(self.data_plot)
-        tk.Button(self, text='Save all data', command=self.save_data).pack(side='left')
+        self.statistics_panel = statistics_panel.StatisticsPanel(self)
+        self.statistics_panel.pack(side='top')
+        self.data.add_statistics_display(self.statistics_panel)
+        self.save_button = tk.Button(self, text='Save all data', command=self.save_data)
+        self.save_button.pack(side='left')
         self.connected_button = tk.Button(self, command=self.connection_handler)
         self.connected_button.pack(side='right')
         self.update_connection_button()
 
         tk.Button(self, text="Stimulate", command=self.open_stimulation_window).pack(side='left')
+        self.protocol("WM_DELETE_WINDOW", self.close)
 
     def save_data(self):
         # self.data_saved = save_toplevel.SaveTopLevel(self, self.data.x_data, self.data.y_data_to_display)
-        self.data.call_save()
+        save_thread = self.data.call_save()
+        if save_thread:
+            self.save_button.config(state='disabled')
+            self.show_save_progress(save_thread)
+
+    def show_save_progress(self, save_thread):
+        """ Show how much of the file the save thread has written on the save button until it is done """
+        if save_thread.is_alive():
+            self.save_button.config(text='Saving {0:.0%}'.format(save_thread.progress))
+            self.after(100, self.show_save_progress, save_thread)
+        else:
+            self.save_button.config(text='Save all data', state='normal')
+            if save_thread.error:
+                logging.error("Data was not saved: {0}".format(save_thread.error))
 
     def update_connection_button(self):
         if self.device.connected:
@@ -126,6 +161,43 @@ class DataStreamingViewer(tk.Tk):
         tk.Spinbox(_frame, values=gain_list, textvariable=self.gain_var, width=6).pack(side='left')
         self.gain_var.trace("w", self.set_gain)
 
+    def create_filter_frame(self, _frame):
+        tk.Label(_frame, text="{0:.0f} Hz notch, {1}-{2} Hz band-pass: ".format(
+            stream_filter.MAINS_FREQUENCY, *stream_filter.BAND_PASS)).pack(side='left')
+        tk.Checkbutton(_frame, text='Filter display', variable=self.filter_display_var,
+                       command=self.set_filters).pack(side='left')
+        tk.Checkbutton(_frame, text='Filter recording', variable=self.filter_storage_var,
+                       command=self.set_filters).pack(side='left')
+        tk.Checkbutton(_frame, text='Detect events', variable=self.detect_events_var,
+                       command=self.set_event_detector).pack(side='left')
+        tk.Checkbutton(_frame, text='Average stimuli', variable=self.average_stimuli_var,
+                       command=self.set_epoch_engine).pack(side='left')
+
+    def set_event_detector(self):
+        if self.detect_events_var.get():
+            self.data.set_event_detector(event_detector.EventDetector(self.data.number_channels,
+                                                                      data_class.SAMPLE_RATE))
+        else:
+            self.data.set_event_detector(None)
+
+    def set_epoch_engine(self):
+        if self.average_stimuli_var.get():
+            self.data.set_epoch_engine(epochs.EpochEngine(self.data.number_channels, data_class.SAMPLE_RATE))
+        else:
+            self.data.set_epoch_engine(None)
+
+    def set_filters(self, *args):
+        """ Make the filters the user picked, one filter is used if the display and recording are both filtered """
+        try:
+            _filter = stream_filter.StreamingFilter(self.data.number_channels, data_class.SAMPLE_RATE)
+        except ImportError as error:
+            logging.error("Can not filter the data: {0}".format(error))
+            self.filter_display_var.set(False)
+            self.filter_storage_var.set(False)
+            return
+        self.data.set_filters(_filter if self.filter_display_var.get() else None,
+                              _filter if self.filter_storage_var.get() else None)
+
     def create_control_panel(self, _frame):
         tk.Label(_frame, text="ADC channels from device: ").pack(side="left")
         channels_var = tk.IntVar()
@@ -145,12 +217,22 @@ class DataStreamingViewer(tk.Tk):
 
     def start_reading(self):
         self.data.clear()
+        self.data.start_recording()
 
         # disable the run and calibrate buttons to prevent their use
         self.read_button.config(state='disabled')
         # self.calibrate_button.config(state='disabled')
         self.device.start_reading()
 
+    def set_display_mode(self):
+        """ Show the min and max of every display point, so spikes between them are not lost, or every
+        SAMPLING_RATIO-th sample """
+        self.data.set_display_mode('envelope' if self.envelope_var.get() else 'stride')
+
+    def set_render_worker(self):
+        """ Draw the plot in a background thread (see render_worker.py) or in the tk thread """
+        self.data_plot.set_render_worker(self.render_worker_var.get())
+
     def set_channels(self, *args):
         self.device.set_number_channels(args[0])
 
@@ -198,9 +280,25 @@ class DataStreamingViewer(tk.Tk):
 
     def cancel_read(self):
         self.device.stop_reading()
+        self.data.flush_recording()
+        logging.info('plot stats: {0}'.format(self.data_plot.render_stats()))
+        if self.data.event_detector:
+            logging.info('event detector stats: {0}'.format(self.data.event_detector.stats()))
+        if self.data.epoch_engine:
+            logging.info('epoch stats: {0}'.format(self.data.epoch_engine.stats()))
+        if self.device.command_writer:
+            logging.info('usb command stats: {0}'.format(self.device.command_writer.stats()))
         self.read_button.config(state='active')
         self.calibrate_button.config(state='active')
 
+    def close(self):
+        """ Stop reading the device if it is running, close the recording (an unsaved one is deleted) and close the
+        window """
+        if self.read_button['state'] == 'disabled':
+            self.device.stop_reading()
+        self.data.stop_recording()
+        self.destroy()
+
     def data_logging_handler(self, date):
         path = os.getcwd()
         _log_path = '%s/data/%s' % (path, date)
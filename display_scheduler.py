@@ -0,0 +1,127 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Schedule when the main thread drains the data queue and updates the display, without ever blocking the
+tk event loop
+"""
+# standard libraries
+import queue
+import time
+
+__author__ = 'Kyle Vitautas Lopin'
+
+MIN_REFRESH_DELAY = 20  # ms, shortest time between display updates
+MAX_REFRESH_DELAY = 200  # ms, longest time between display updates, the old fixed refresh delay
+DRAIN_BUDGET = 0.020  # s, longest time to spend moving adc buffers from the queue to the data class each tick
+TARGET_LOAD = 0.5  # fraction of the main thread to spend updating the display
+
+
+class DisplayScheduler(object):
+    """ Keeps track of the cost of each display update and works out when the next one should be.  Each tick the
+    data queue is drained for at most drain_budget seconds.  If adc buffers are still in the queue after that the
+    display update is skipped (counted as a dropped frame) so the data class catches up, and the next tick comes
+    as soon as possible, but the display is still updated once max_delay has passed since the last update so it
+    does not freeze while the data class can not catch up.  Otherwise the refresh delay is set so display updates
+    take about target_load of the main thread.  A tick that starts more than a refresh delay later than it was
+    scheduled is counted as a late frame.
+    """
+
+    def __init__(self, min_delay=MIN_REFRESH_DELAY, max_delay=MAX_REFRESH_DELAY, drain_budget=DRAIN_BUDGET,
+                 target_load=TARGET_LOAD):
+        """
+        :param min_delay: int, ms, shortest time between display updates
+        :param max_delay: int, ms, longest time between display updates
+        :param drain_budget: float, s, longest time to drain the data queue in a tick
+        :param target_load: float, 0 to 1, fraction of the main thread to use for the display updates
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.drain_budget = drain_budget
+        self.target_load = target_load
+        self.render_time = 0.0  # s, smoothed time to update the display
+        self.reset()
+
+    def reset(self):
+        """ Clear the statistics and the schedule, call when a new data stream is started """
+        self.refresh_delay = self.max_delay  # type: int  ms, delay until the next tick
+        self.scheduled_time = None  # type: float  time the next tick should start
+        self.behind = False  # type: bool  the last tick did not empty the data queue
+        self.last_render = time.perf_counter()  # type: float  time the display was last updated
+        self.frames = 0
+        self.dropped_frames = 0
+        self.late_frames = 0
+        self.buffers_drained = 0
+        self.total_render_time = 0.0
+
+    def drain(self, data_queue: queue.Queue, consume):
+        """ Get adc buffers from the data queue, without waiting for new ones, and pass them to consume until the
+        queue is empty or the drain budget runs out
+        :param data_queue: queue of adc buffers
+        :param consume: function to call with each adc buffer
+        :return: int, number of adc buffers drained
+        """
+        tick_start = time.perf_counter()
+        if self.scheduled_time and tick_start - self.scheduled_time > self.refresh_delay / 1000.:
+            self.late_frames += 1
+        deadline = tick_start + self.drain_budget
+        buffers_drained = 0
+        while True:
+            try:
+                adc_buffer = data_queue.get_nowait()
+            except queue.Empty:
+                self.behind = False
+                break
+            consume(adc_buffer)
+            buffers_drained += 1
+            if time.perf_counter() > deadline:
+                self.behind = not data_queue.empty()
+                break
+        self.buffers_drained += buffers_drained
+        return buffers_drained
+
+    def should_render(self, buffers_drained):
+        """ Decide if the display should be updated this tick
+        :param buffers_drained: int, adc buffers added to the data class this tick
+        :return: True if the display should be updated
+        """
+        now = time.perf_counter()
+        if self.behind and now - self.last_render < self.max_delay / 1000.:
+            self.dropped_frames += 1
+            return False
+        if buffers_drained > 0:
+            self.last_render = now
+            return True
+        return False
+
+    def add_render_time(self, render_time):
+        """ Record how long a display update took
+        :param render_time: float, s
+        """
+        self.frames += 1
+        self.total_render_time += render_time
+        # smooth the render time so one slow draw does not throw off the refresh delay
+        self.render_time = 0.8 * self.render_time + 0.2 * render_time if self.frames > 1 else render_time
+
+    def next_delay(self):
+        """ Work out the delay until the next tick from the render time and if the data queue is backed up
+        :return: int, ms to pass to tk's after method
+        """
+        if self.behind:
+            self.refresh_delay = self.min_delay
+        else:
+            delay = 1000 * self.render_time * (1 - self.target_load) / self.target_load
+            self.refresh_delay = int(min(max(delay, self.min_delay), self.max_delay))
+        self.scheduled_time = time.perf_counter() + self.refresh_delay / 1000.
+        return self.refresh_delay
+
+    def stats(self):
+        """ Get the statistics of the display updates
+        :return: dict of the frames rendered, dropped and late, adc buffers drained, average render time in
+        seconds and the current refresh delay in ms
+        """
+        return {'frames': self.frames,
+                'dropped frames': self.dropped_frames,
+                'late frames': self.late_frames,
+                'buffers drained': self.buffers_drained,
+                'render time': self.total_render_time / max(self.frames, 1),
+                'refresh delay': self.refresh_delay}
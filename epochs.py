@@ -0,0 +1,178 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Cut the response to each stimulation out of the raw adc counts as they are read, and average the responses.
+
+Every stimulation is stamped with the raw sample it was given at (see StreamingData.mark_stimulus) and kept in a
+StimulusTable.  The EpochEngine cuts a window of pre_time before to post_time after each stimulus into one of
+max_epochs preallocated epochs, the newest epochs are kept and the oldest written over.  The part of the window
+that was read before the stimulus is copied from a ring of the last pre_time of adc counts, the rest is copied from
+each adc buffer as it is read.  When a window is full the epoch is added to a running sum, so the average of all the
+trials is always ready without going over the recording.
+"""
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+PRE_TIME = 0.5  # s, before the stimulus in each epoch
+POST_TIME = 2.0  # s, after the stimulus in each epoch
+MAX_EPOCHS = 100  # newest epochs that are kept, ~7.5 MB for 3 channels at 5 kHz, the average has all of them
+INITIAL_CAPACITY = 256  # stimuli, the table is doubled when it is full
+
+
+class StimulusTable(object):
+    """ Growable numpy array of the raw sample each stimulation was given at """
+
+    def __init__(self):
+        self.length = 0
+        self.table = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, sample):
+        if self.length == len(self.table):
+            grown = np.empty(2 * len(self.table), dtype=np.int64)
+            grown[:self.length] = self.table
+            self.table = grown
+        self.table[self.length] = sample
+        self.length += 1
+
+    def samples(self):
+        """ Get all the stimulus samples without copying them, the view is only valid until the next append
+        :return: numpy array of int64
+        """
+        return self.table[:self.length]
+
+    def in_range(self, start_sample, end_sample):
+        """ Get the stimuli between 2 samples
+        :param start_sample: int, first sample
+        :param end_sample: int, sample to stop before
+        :return: numpy array of int64
+        """
+        samples = self.samples()
+        return samples[np.searchsorted(samples, start_sample):np.searchsorted(samples, end_sample)]
+
+
+class EpochEngine(object):
+    """ Cuts a window of interleaved adc counts around each stimulus as it is read and keeps a running average """
+
+    def __init__(self, number_channels, sample_rate, pre_time=PRE_TIME, post_time=POST_TIME, max_epochs=MAX_EPOCHS):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param pre_time: float, s, before the stimulus in each epoch
+        :param post_time: float, s, after the stimulus in each epoch
+        :param max_epochs: int, newest epochs to keep
+        """
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        self.pre_frames = int(pre_time * sample_rate)
+        self.window_frames = self.pre_frames + int(post_time * sample_rate)
+        self.max_epochs = max_epochs
+        self.reset()
+
+    def reset(self, number_channels=None):
+        """ Clear the epochs and the average, call when a new data stream is started
+        :param number_channels: int, number of channels in the new data stream, None if it is the same
+        """
+        if number_channels:
+            self.number_channels = number_channels
+        self.epochs = np.zeros((self.max_epochs, self.window_frames, self.number_channels), dtype=np.int16)
+        self.epoch_stimuli = np.full(self.max_epochs, -1, dtype=np.int64)  # stimulus sample of each epoch
+        self.complete = np.zeros(self.max_epochs, dtype=bool)  # epochs with a full window
+        self.total = np.zeros((self.window_frames, self.number_channels))  # sum of the complete epochs
+        self.trials = 0  # epochs in the total
+        self.stimuli = 0  # stimuli added
+        self.started = 0  # stimuli given an epoch
+        self.missed = 0  # stimuli too far in the past to cut a window for, or written over before they were full
+        self.pending = []  # [epoch, first frame of the window] of the epochs that are not full yet
+        self.frames = 0  # frames read
+        self.history = np.zeros((max(self.pre_frames, 1), self.number_channels), dtype=np.int16)  # ring of frames
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+
+    def add_stimulus(self, sample):
+        """ Start an epoch for a stimulus, the part of its window that has already been read is copied in now
+        :param sample: int, raw sample the stimulus was given at
+        """
+        self.stimuli += 1
+        window_start = sample - self.pre_frames
+        if window_start < self.frames - len(self.history):  # the start of the window is not in the ring any more
+            self.missed += 1
+            return
+        epoch = self.started % self.max_epochs
+        self.started += 1
+        if any(pending[0] == epoch for pending in self.pending):  # more stimuli waiting than there are epochs
+            self.pending = [pending for pending in self.pending if pending[0] != epoch]
+            self.missed += 1
+        self.epoch_stimuli[epoch] = sample
+        self.complete[epoch] = False
+        read_end = min(self.frames, window_start + self.window_frames)
+        if window_start < read_end:
+            self.epochs[epoch, :read_end - window_start] = self.history[np.arange(window_start, read_end) %
+                                                                        len(self.history)]
+        if window_start + self.window_frames <= self.frames:
+            self.finish(epoch)
+        else:
+            self.pending.append([epoch, window_start])
+
+    def process(self, adc_counts):
+        """ Copy an adc buffer into the windows it overlaps, and add the epochs it fills to the average
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        buffer_end = self.frames + whole_frames
+        still_pending = []
+        for epoch, window_start in self.pending:
+            start = max(window_start, self.frames)
+            end = min(window_start + self.window_frames, buffer_end)
+            if start < end:
+                self.epochs[epoch, start - window_start:end - window_start] = frames[start - self.frames:
+                                                                                     end - self.frames]
+            if end == window_start + self.window_frames:
+                self.finish(epoch)
+            else:
+                still_pending.append([epoch, window_start])
+        self.pending = still_pending
+        kept = frames[-len(self.history):]  # only the newest frames go in the ring
+        self.history[np.arange(buffer_end - len(kept), buffer_end) % len(self.history)] = kept
+        self.frames = buffer_end
+
+    def finish(self, epoch):
+        self.complete[epoch] = True
+        self.total += self.epochs[epoch]
+        self.trials += 1
+
+    def average(self, counts_to_volts=1.0):
+        """ Get the average of all the complete epochs
+        :param counts_to_volts: float, mV per adc count
+        :return: numpy array (window frames, channels), zeros if no epoch is complete
+        """
+        return self.total * (counts_to_volts / max(self.trials, 1))
+
+    def get_epochs(self):
+        """ Get the complete epochs that are still kept, oldest first
+        :return: numpy array of the stimulus samples and numpy array (epochs, window frames, channels) of int16
+        adc counts, the epochs are a copy
+        """
+        order = np.argsort(self.epoch_stimuli)
+        order = order[self.complete[order]]
+        return self.epoch_stimuli[order], self.epochs[order]
+
+    def time_axis(self):
+        """ Get the time of each frame of a window from the stimulus
+        :return: numpy array of s
+        """
+        return (np.arange(self.window_frames) - self.pre_frames) / self.sample_rate
+
+    def stats(self):
+        return {'stimuli': self.stimuli,
+                'trials averaged': self.trials,
+                'pending': len(self.pending),
+                'missed': self.missed}
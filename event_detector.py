@@ -0,0 +1,218 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Find action potentials and other events in the adc counts as they are read, at the full sample rate.
+
+Each channel has a baseline and a noise level that follow the signal slowly, they are updated once per adc buffer
+from the samples that are not part of an event.  A sample is part of an event if it is more than
+threshold * noise away from the baseline.  Each run of those samples is an event, with the sample it is furthest
+from the baseline at, that distance (the amplitude, in adc counts) and how many samples it lasted (the width).
+Runs less than merge_time apart are one event, so the noise on the slopes of an event does not split it up.
+An event that starts within refractory_time of the end of the last event of the channel is not counted.
+An event that could still be going on at the end of an adc buffer is finished in the next one.
+"""
+# standard libraries
+import time
+import warnings
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+EVENT_DTYPE = np.dtype([('channel', '<u2'), ('sample', '<i8'), ('amplitude', '<f4'), ('width', '<i4')])
+THRESHOLD = 6.0  # noise levels from the baseline to be part of an event
+BASELINE_TIME = 5.0  # s, time constant the baseline follows the signal with
+NOISE_TIME = 10.0  # s, time constant the noise level follows the signal with
+REFRACTORY_TIME = 1.0  # s, time after an event that another event on the channel is not counted
+MERGE_TIME = 0.01  # s, runs of samples past the threshold closer than this are one event
+MIN_WIDTH = 5  # samples, shortest event
+MIN_NOISE = 1.0  # adc counts, lowest the noise level can go so a flat signal does not make every sample an event
+LATENCY_BUDGET = 0.005  # s, longest the detector should take to process an adc buffer
+INITIAL_CAPACITY = 1024  # events, the table is doubled when it is full
+
+
+class EventTable(object):
+    """ Growable numpy structured array of events, ordered by when they ended """
+
+    def __init__(self):
+        self.length = 0
+        self.table = np.empty(INITIAL_CAPACITY, dtype=EVENT_DTYPE)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, channel, sample, amplitude, width):
+        if self.length == len(self.table):
+            grown = np.empty(2 * len(self.table), dtype=EVENT_DTYPE)
+            grown[:self.length] = self.table
+            self.table = grown
+        self.table[self.length] = (channel, sample, amplitude, width)
+        self.length += 1
+
+    def events(self):
+        """ Get all the events without copying them, the view is only valid until the next append
+        :return: numpy structured array of EVENT_DTYPE
+        """
+        return self.table[:self.length]
+
+    def in_range(self, start_sample, end_sample):
+        """ Get the events that peaked between 2 samples
+        :param start_sample: int, first sample
+        :param end_sample: int, sample to stop before
+        :return: numpy structured array of EVENT_DTYPE
+        """
+        events = self.events()
+        return events[(events['sample'] >= start_sample) & (events['sample'] < end_sample)]
+
+
+class EventDetector(object):
+    """ Adaptive threshold event detector of interleaved adc counts, processes a whole adc buffer at a time """
+
+    def __init__(self, number_channels, sample_rate, threshold=THRESHOLD, baseline_time=BASELINE_TIME,
+                 noise_time=NOISE_TIME, refractory_time=REFRACTORY_TIME, merge_time=MERGE_TIME,
+                 min_width=MIN_WIDTH, latency_budget=LATENCY_BUDGET):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param threshold: float, noise levels from the baseline to be part of an event
+        :param baseline_time: float, s, time constant of the baseline
+        :param noise_time: float, s, time constant of the noise level
+        :param refractory_time: float, s, time after an event that another event on the channel is not counted
+        :param merge_time: float, s, runs of samples past the threshold closer than this are one event
+        :param min_width: int, samples, shortest event to count
+        :param latency_budget: float, s, longest time processing an adc buffer should take
+        """
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.baseline_time = baseline_time
+        self.noise_time = noise_time
+        self.refractory_samples = int(refractory_time * sample_rate)
+        self.merge_samples = max(int(merge_time * sample_rate), 1)
+        self.min_width = min_width
+        self.latency_budget = latency_budget
+        self.reset()
+
+    def reset(self, number_channels=None):
+        """ Start over with no events, call when a new data stream is started
+        :param number_channels: int, number of channels in the new data stream, None if it is the same
+        """
+        if number_channels:
+            self.number_channels = number_channels
+        self.table = EventTable()
+        self.samples = 0  # samples of each channel processed
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+        self.baseline = None  # type: np.ndarray  adc counts of each channel, None until the first adc buffer
+        self.noise = None  # type: np.ndarray  adc counts of each channel
+        # an event that could still be going on at the end of the last adc buffer,
+        # (start sample, end sample, peak sample, amplitude)
+        self.open_events = [None] * self.number_channels
+        self.refractory_end = np.zeros(self.number_channels, dtype=np.int64)  # first sample a new event can start
+        self.buffers = 0
+        self.total_latency = 0.0  # s
+        self.max_latency = 0.0  # s
+        self.over_budget = 0  # adc buffers that took longer than the latency budget
+
+    def process(self, adc_counts):
+        """ Find the events in an adc buffer and add the ones that have finished to the event table
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        """
+        process_start = time.perf_counter()
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        if not whole_frames:
+            return
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        if self.baseline is None:  # start from the first adc buffer
+            self.baseline = np.median(frames, axis=0).astype(np.float64)
+            self.noise = np.maximum(robust_noise(frames - self.baseline), MIN_NOISE)
+        deviation = frames - self.baseline
+        above = np.abs(deviation) > self.threshold * self.noise
+        for channel in range(self.number_channels):
+            self.find_events(channel, deviation[:, channel], above[:, channel])
+        self.update_baseline(deviation, above)
+        self.samples += whole_frames
+        latency = time.perf_counter() - process_start
+        self.buffers += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if latency > self.latency_budget:
+            self.over_budget += 1
+
+    def find_events(self, channel, deviation, above):
+        """ Find the runs of samples past the threshold of a channel in an adc buffer
+        :param channel: int, channel number
+        :param deviation: numpy array of the adc counts minus the baseline of the channel
+        :param above: numpy array of bool, True for the samples past the threshold
+        """
+        edges = np.flatnonzero(np.diff(above.astype(np.int8), prepend=0, append=0))
+        starts, ends = edges[0::2], edges[1::2]  # ends are the first sample after each run
+        if len(starts) > 1:  # join runs that are close together
+            separate = starts[1:] - ends[:-1] >= self.merge_samples
+            starts, ends = starts[np.append(True, separate)], ends[np.append(separate, True)]
+        open_event = self.open_events[channel]
+        self.open_events[channel] = None
+        if open_event and not (len(starts) and self.samples + starts[0] - open_event[1] < self.merge_samples):
+            self.add_event(channel, *open_event)  # the open event ended in the last adc buffer
+            open_event = None
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            peak = start + np.argmax(np.abs(deviation[start:end]))
+            event_start, peak_sample, amplitude = self.samples + start, self.samples + peak, deviation[peak]
+            if i == 0 and open_event:  # this run carries on the event from the last adc buffer
+                event_start = open_event[0]
+                if abs(open_event[3]) >= abs(amplitude):
+                    peak_sample, amplitude = open_event[2], open_event[3]
+            if end > len(deviation) - self.merge_samples:  # could still be going on, finish it with the next one
+                self.open_events[channel] = (event_start, self.samples + end, peak_sample, amplitude)
+            else:
+                self.add_event(channel, event_start, self.samples + end, peak_sample, amplitude)
+
+    def add_event(self, channel, start, end, peak_sample, amplitude):
+        if end - start < self.min_width or start < self.refractory_end[channel]:
+            return
+        self.table.append(channel, peak_sample, amplitude, end - start)
+        self.refractory_end[channel] = end + self.refractory_samples
+
+    def update_baseline(self, deviation, above):
+        """ Move the baseline and noise level of each channel towards the samples of the adc buffer that are not
+        part of an event
+        :param deviation: numpy array (samples, channels) of the adc counts minus the baseline
+        :param above: numpy array (samples, channels) of bool, True for the samples past the threshold
+        """
+        buffer_time = len(deviation) / self.sample_rate
+        quiet = np.where(above, np.nan, deviation)
+        quiet_channels = np.sum(~above, axis=0) > len(deviation) // 2  # only update from mostly quiet buffers
+        if not np.any(quiet_channels):
+            return
+        with warnings.catch_warnings():  # channels that are all events give nan, they are not used
+            warnings.simplefilter('ignore', RuntimeWarning)
+            shift = np.nanmean(quiet, axis=0)
+            noise = robust_noise(quiet - shift)
+        baseline_weight = min(buffer_time / self.baseline_time, 1.0)
+        noise_weight = min(buffer_time / self.noise_time, 1.0)
+        self.baseline += np.where(quiet_channels, baseline_weight * shift, 0)
+        noise = np.where(quiet_channels, noise, self.noise)
+        self.noise = np.maximum((1 - noise_weight) * self.noise + noise_weight * noise, MIN_NOISE)
+
+    def stats(self):
+        """ Get the statistics of the detector
+        :return: dict of the events found, adc buffers processed, the average and longest time to process an adc
+        buffer in seconds and how many adc buffers took longer than the latency budget
+        """
+        return {'events': len(self.table),
+                'buffers': self.buffers,
+                'latency': self.total_latency / max(self.buffers, 1),
+                'max latency': self.max_latency,
+                'over budget': self.over_budget}
+
+
+def robust_noise(deviation):
+    """ Estimate the standard deviation of the noise of each channel from the median absolute deviation, so a
+    few large samples do not raise it
+    :param deviation: numpy array (samples, channels), nan for samples to leave out
+    :return: numpy array of the noise of each channel
+    """
+    return 1.4826 * np.nanmedian(np.abs(deviation - np.nanmedian(deviation, axis=0)), axis=0)
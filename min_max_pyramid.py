@@ -0,0 +1,165 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Multi-resolution min/max summary of a whole recording, so any time range of it can be drawn with about as many
+points as there are pixels no matter how long the recording is.
+
+Level k holds the minimum and maximum adc count of each channel over every bucket of factor**k frames (level 0 is
+the raw recording, which is not kept here).  Each level is built from the one below it as the adc buffers come in,
+a bucket that is not full yet is held until the frames for the rest of it arrive.
+
+The lowest levels would take a large part of the memory the raw recording does (level 1 is a fifth of it), so
+levels below first_stored_level are only worked out to build the levels above them.  When a range of one of them
+is needed it is made from the raw recording with reduce_frames, which is no more than factor**first_stored_level
+frames for each point asked for.
+"""
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+PYRAMID_FACTOR = 10  # frames in a bucket of level 1, and buckets of a level in a bucket of the level above it
+PYRAMID_LEVELS = 6  # levels above the raw data, the top level has a bucket every 200 s at 5 kHz
+FIRST_STORED_LEVEL = 3  # lowest level kept in memory, ~5 MB for 24 hours of 3 channels at 5 kHz
+INITIAL_CAPACITY = 1024  # buckets of each level, the arrays are doubled when they are full
+
+
+class PyramidLevel(object):
+    """ Growable arrays of the minimum and maximum of each channel for every bucket of a level """
+
+    def __init__(self, number_channels, bucket_size, stored=True):
+        """
+        :param number_channels: int, number of channels
+        :param bucket_size: int, frames of the recording in each bucket
+        :param stored: bool, keep the buckets, if False only the number of them is counted
+        """
+        self.bucket_size = bucket_size
+        self.stored = stored
+        self.length = 0  # buckets filled
+        capacity = INITIAL_CAPACITY if stored else 0
+        self.mins = np.empty((capacity, number_channels), dtype=np.int16)
+        self.maxs = np.empty((capacity, number_channels), dtype=np.int16)
+
+    def append(self, mins, maxs):
+        """ Add full buckets to the end of the level
+        :param mins: numpy array (buckets, channels) of int16
+        :param maxs: numpy array (buckets, channels) of int16
+        """
+        end = self.length + len(mins)
+        if not self.stored:
+            self.length = end
+            return
+        if end > len(self.mins):
+            capacity = max(end, 2 * len(self.mins))
+            for name in ('mins', 'maxs'):
+                grown = np.empty((capacity, self.mins.shape[1]), dtype=np.int16)
+                grown[:self.length] = getattr(self, name)[:self.length]
+                setattr(self, name, grown)
+        self.mins[self.length:end] = mins
+        self.maxs[self.length:end] = maxs
+        self.length = end
+
+    def nbytes(self):
+        return self.mins.nbytes + self.maxs.nbytes
+
+
+def reduce_buckets(values, bucket_size, ufunc):
+    """ Reduce every full bucket of rows with np.minimum or np.maximum.  The rows at the same place in each bucket
+    are done together, which is a lot faster for small buckets than reducing a (buckets, bucket_size, channels)
+    view along its middle axis
+    :param values: numpy array (rows, channels)
+    :param bucket_size: int, rows in each bucket
+    :param ufunc: np.minimum or np.maximum
+    :return: numpy array (buckets, channels)
+    """
+    end = len(values) // bucket_size * bucket_size
+    result = values[0:end:bucket_size].copy()
+    for i in range(1, bucket_size):
+        ufunc(result, values[i:end:bucket_size], out=result)
+    return result
+
+
+def reduce_frames(frames, bucket_size):
+    """ Get the minimum and maximum of each channel over every full bucket of frames
+    :param frames: numpy array (frames, channels)
+    :param bucket_size: int, frames in each bucket
+    :return: numpy arrays (buckets, channels) of the minimums and maximums
+    """
+    return reduce_buckets(frames, bucket_size, np.minimum), reduce_buckets(frames, bucket_size, np.maximum)
+
+
+class MinMaxPyramid(object):
+    """ Min/max levels of a recording at factor, factor**2, ... frames per bucket, updated with each adc buffer """
+
+    def __init__(self, number_channels, factor=PYRAMID_FACTOR, number_levels=PYRAMID_LEVELS,
+                 first_stored_level=FIRST_STORED_LEVEL):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param factor: int, how many buckets of a level go in a bucket of the level above it
+        :param number_levels: int, number of levels above the raw data
+        :param first_stored_level: int, lowest level to keep the buckets of
+        """
+        self.number_channels = number_channels
+        self.factor = factor
+        self.first_stored_level = first_stored_level
+        self.levels = [PyramidLevel(number_channels, factor ** k, k >= first_stored_level)
+                       for k in range(1, number_levels + 1)]
+        self.frames = 0  # whole frames added
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+        # frames (for level 1) or buckets of the level below (for the others) not making a full bucket yet
+        self.pending_mins = [np.empty((0, number_channels), dtype=np.int16) for _ in self.levels]
+        self.pending_maxs = [np.empty((0, number_channels), dtype=np.int16) for _ in self.levels]
+
+    def append(self, adc_counts):
+        """ Add an adc buffer to the pyramid
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        self.frames += whole_frames
+        mins = maxs = frames
+        for k, level in enumerate(self.levels):
+            if self.pending_mins[k].size:
+                mins = np.concatenate((self.pending_mins[k], mins))
+                maxs = np.concatenate((self.pending_maxs[k], maxs))
+            number_buckets = len(mins) // self.factor
+            full = number_buckets * self.factor
+            self.pending_mins[k] = mins[full:].copy()
+            self.pending_maxs[k] = maxs[full:].copy()
+            if not number_buckets:
+                break
+            mins = reduce_buckets(mins[:full], self.factor, np.minimum)
+            maxs = reduce_buckets(maxs[:full], self.factor, np.maximum)
+            level.append(mins, maxs)
+
+    def choose_level(self, start_frame, end_frame, max_points):
+        """ Find the finest level that has no more than max_points buckets between 2 frames
+        :param start_frame: int, first frame of the range
+        :param end_frame: int, frame the range ends before
+        :param max_points: int, most buckets to use
+        :return: int, 0 for the raw data, else the level number
+        """
+        frames = max(end_frame - start_frame, 1)
+        for k in range(len(self.levels) + 1):
+            if frames // self.factor ** k <= max_points:
+                return k
+        return len(self.levels)
+
+    def get_range(self, level_number, start_frame, end_frame):
+        """ Get the minimums and maximums of the buckets of a level that are filled and cover a range of frames
+        :param level_number: int, first_stored_level or more
+        :param start_frame: int, first frame of the range
+        :param end_frame: int, frame the range ends before
+        :return: index of the first bucket, numpy views (buckets, channels) of the minimums and maximums
+        """
+        level = self.levels[level_number - 1]
+        first = min(max(start_frame // level.bucket_size, 0), level.length)
+        last = min(max(-(-end_frame // level.bucket_size), first), level.length)
+        return first, level.mins[first:last], level.maxs[first:last]
+
+    def nbytes(self):
+        return sum(level.nbytes() for level in self.levels)
@@ -1,11 +1,30 @@
+import collections
+import time
 import tkinter as tk
 import tkinter.constants
 import numpy as np
 import matplotlib
 matplotlib.use("TkAgg")
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+try:
+    from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
+except ImportError:  # matplotlib before 2.2
+    from matplotlib.backends.backend_tkagg import NavigationToolbar2TkAgg as NavigationToolbar2Tk
 from matplotlib import pyplot as plt
 import matplotlib.animation as animation
+try:  # matplotlib before 3.0
+    from matplotlib.backends.tkagg import blit as tkagg_blit
+
+    def blit_rgba(photo, image):
+        tkagg_blit(photo, image, colormode=2)
+except ImportError:
+    from matplotlib.backends._backend_tk import blit as backend_tk_blit
+
+    def blit_rgba(photo, image):
+        backend_tk_blit(photo, image, (0, 1, 2, 3))
+
+import data_class
+import render_worker
 
 __author__ = 'Kyle Vitautas Lopin'
 
@@ -13,6 +32,11 @@ sample_rate = 5000  # Hz
 sample_period = 1. / sample_rate  # seconds
 
 COLORS = ['black', 'blue', 'red', 'green']
+# when blitting the axes are only redrawn when the data goes past these limits
+X_MARGIN = 0.2  # fraction of the time frame left empty after the newest data when the x axis is moved
+Y_MARGIN = 0.1  # fraction of the data's range added above and below it when the y axis is changed
+Y_SHRINK = 0.5  # change the y axis if the data's range is less than this fraction of it
+FPS_FRAMES = 50  # frames to work out the frames per second over
 
 class Plotter(tk.Frame):
     def __init__(self, parent, data, _size=(6, 3)):
@@ -21,6 +45,17 @@ class Plotter(tk.Frame):
         self.time_to_display = 5
         self.lines = []
         self.base_canvas = tk.Canvas(self)
+        # blit mode keeps an image of the axes without the lines and only draws the lines over it each frame
+        self.blit = True  # type: bool
+        self.background = None  # image of the axes without the lines
+        self.frames = 0
+        self.full_redraws = 0
+        self.total_frame_time = 0.0  # s
+        self.frame_start_times = collections.deque(maxlen=FPS_FRAMES)
+        # a render worker draws the live plot in another thread, the tk thread only shows its images
+        self.render_worker = None  # type: render_worker.RenderWorker
+        self.frame_shown = 0  # number of the last render worker frame shown
+        self.frames_shown = 0
 
         self.figure_bed = plt.figure(figsize=_size)
         self.axis = self.figure_bed.add_subplot(111)
@@ -29,12 +64,18 @@ class Plotter(tk.Frame):
         self.canvas = FigureCanvasTkAgg(self.figure_bed, self)
         self.canvas._tkcanvas.config(highlightthickness=0)
 
-        toolbar = NavigationToolbar2TkAgg(self.canvas, self)
+        toolbar = NavigationToolbar2Tk(self.canvas, self)
         toolbar.update()
 
         self.canvas._tkcanvas.pack(side='top', fill=tk.BOTH, expand=True)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        # markers at the events the data's event detector found
+        self.event_markers, = self.axis.plot([], [], 'v', c='orange', animated=self.blit)
         self.draw_new_data([0], [[0]], self.time_to_display)
         self.canvas.draw()
+        # when the user zooms or pans with the toolbar, redraw the new range from the data's min/max pyramid
+        self.setting_limits = False  # type: bool  the x limits are being set by the live display
+        self.axis.callbacks.connect('xlim_changed', self.on_xlim_changed)
 
     def set_time_frame(self, time):
         self.time_to_display = time
@@ -50,7 +91,7 @@ class Plotter(tk.Frame):
         if not time_display:
             time_display = self.time_to_display
         for i, y in enumerate(y_array):
-            _line, = self.axis.plot(x, y, label='channel %d' % (i+1), c=COLORS[i])
+            _line, = self.axis.plot(x, y, label='channel %d' % (i+1), c=COLORS[i], animated=self.blit)
             self.lines.append(_line)
         self.axis.set_xlim([self.data.end_time-time_display, self.data.end_time])  # hackish
         self.axis.legend(loc=1)
@@ -58,19 +99,188 @@ class Plotter(tk.Frame):
 
     def display_data(self):
         # self.axis.clear()
-        y_data = self.data.y_data_to_display
-        x = self.data.t_data
+        frame_start = time.perf_counter()
         t_end = self.data.end_time
+        if self.render_worker:
+            self.show_rendered_frame(t_end)
+        elif self.blit:
+            self.blit_lines(t_end)
+        else:
+            # only give the lines the points in the time frame, as views of the display buffers
+            y_data = self.set_line_data(self.time_to_display)
+            self.setting_limits = True
+            self.axis.set_xlim([t_end - self.time_to_display, t_end])
+            self.setting_limits = False
+            # self.axis.legend(loc=1)
+            y_limits = self.get_y_limits(y_data)
+            if y_limits:
+                self.axis.set_ylim(y_limits)
+            self.canvas.draw()
+        self.add_frame(frame_start)
+
+    def set_line_data(self, time_to_display):
+        """ Set the lines to the newest time_to_display seconds of the display buffers, without copying them
+        :param time_to_display: float, s
+        :return: list of the numpy view of each channel the lines were set to
+        """
+        x, y_data = self.data.display_window(time_to_display)
         for i, y in enumerate(y_data):
             # self.axis.plot(x, y, label='channel %d' % (i+1))
             self.lines[i].set_data(x, y)
-            # print('y data: ', y[:500])
-        self.axis.set_xlim([t_end - self.time_to_display, t_end])
-        # self.axis.legend(loc=1)
-        self.axis.relim()
-        self.axis.autoscale_view(True, True, True)
+        self.set_event_markers(x, y_data)
+        return y_data
+
+    def set_event_markers(self, x, y_data):
+        """ Put a marker on the line of each event in the data being displayed
+        :param x: numpy array of the times displayed
+        :param y_data: list of the numpy array of each channel displayed
+        """
+        events = self.data.get_events(x[0], x[-1]) if len(x) else None
+        if events is None or not len(events):
+            self.event_markers.set_data([], [])
+            return
+        events = events[events['channel'] < len(y_data)]
+        event_times = events['sample'] / data_class.SAMPLE_RATE
+        marker_y = [np.interp(event_time, x, y_data[channel])
+                    for event_time, channel in zip(event_times, events['channel'])]
+        self.event_markers.set_data(event_times, marker_y)
+
+    @staticmethod
+    def get_y_limits(y_data):
+        """ Get y limits that fit the data with Y_MARGIN of its range above and below it
+        :param y_data: list of numpy arrays, the data of each line
+        :return: [bottom, top] or None if there is no data
+        """
+        if not len(y_data) or not len(y_data[0]):
+            return None
+        data_min = min(np.min(y) for y in y_data)
+        data_max = max(np.max(y) for y in y_data)
+        margin = max(data_max - data_min, 1e-3) * Y_MARGIN
+        return [data_min - margin, data_max + margin]
+
+    def blit_lines(self, t_end):
+        """ Draw the lines over the saved image of the axes.  The whole figure is only drawn again when the newest
+        data goes past the x axis or the data goes out of, or takes up much less than, the y axis
+        :param t_end: float, s, time of the newest data
+        """
+        full_redraw = self.background is None
+        x_min, x_max = self.axis.get_xlim()
+        window_width = self.time_to_display * (1 + X_MARGIN)
+        if (t_end > x_max or t_end < x_max - self.time_to_display * X_MARGIN
+                or abs((x_max - x_min) - window_width) > 1e-6 * window_width):
+            self.setting_limits = True
+            self.axis.set_xlim([t_end - self.time_to_display, t_end + self.time_to_display * X_MARGIN])
+            self.setting_limits = False
+            full_redraw = True
+        # the lines get the points from the left side of the x axis to the newest
+        visible_data = self.set_line_data(t_end - self.axis.get_xlim()[0])
+        y_limits = self.get_y_limits(visible_data)
+        if y_limits:
+            y_min, y_max = self.axis.get_ylim()
+            data_min, data_max = y_limits
+            if data_min < y_min or data_max > y_max or data_max - data_min < Y_SHRINK * (y_max - y_min):
+                self.axis.set_ylim(y_limits)
+                full_redraw = True
+        if full_redraw:
+            self.full_redraws += 1
+            self.canvas.draw()  # on_draw saves the new background and draws the lines
+        else:
+            self.canvas.restore_region(self.background)
+            for line in self.lines + [self.event_markers]:
+                self.axis.draw_artist(line)
+            self.canvas.blit(self.axis.bbox)
+
+    def show_rendered_frame(self, t_end):
+        """ Give the render worker a copy of the data in the time frame to draw and show the newest image it has
+        finished, if it has a new one
+        :param t_end: float, s, time of the newest data
+        """
+        x, y_data = self.data.display_window(self.time_to_display)
+        width, height = self.canvas.get_width_height()
+        self.render_worker.submit(render_worker.PlotSnapshot(
+            x.copy(), [y.copy() for y in y_data], [t_end - self.time_to_display, t_end], (width, height),
+            self.figure_bed.dpi))
+        with self.render_worker.condition:
+            frame_number, image = self.render_worker.get_frame()
+            if frame_number == self.frame_shown or image.shape[:2] != (height, width):
+                return  # no new frame yet, or it was drawn before the window changed size
+            blit_rgba(self.canvas._tkphoto, image)
+        self.frame_shown = frame_number
+        self.frames_shown += 1
+
+    def set_render_worker(self, use_worker):
+        """ Start or stop drawing the live plot in a render worker thread
+        :param use_worker: bool
+        """
+        if use_worker and not self.render_worker:
+            self.render_worker = render_worker.RenderWorker(COLORS)
+            self.render_worker.start()
+            self.frame_shown = 0
+        elif not use_worker and self.render_worker:
+            self.render_worker.stop_running()
+            self.render_worker = None
+            self.canvas.draw()
+
+    def on_draw(self, event):
+        """ After the whole figure is drawn save the axes without the lines as the background to blit the lines
+        over, then draw the lines as they are animated and not drawn with the figure """
+        if not self.blit:
+            return
+        self.background = self.canvas.copy_from_bbox(self.axis.bbox)
+        for line in self.lines + [self.event_markers]:
+            self.axis.draw_artist(line)
+
+    def set_blit(self, blit):
+        """ Turn blitting on or off, the lines are drawn with the figure when it is off
+        :param blit: bool
+        """
+        self.blit = blit
+        self.background = None
+        for line in self.lines + [self.event_markers]:
+            line.set_animated(blit)
         self.canvas.draw()
 
+    def add_frame(self, frame_start):
+        self.frames += 1
+        self.total_frame_time += time.perf_counter() - frame_start
+        self.frame_start_times.append(frame_start)
+
+    def render_stats(self):
+        """ Get the statistics of the frames drawn
+        :return: dict of the frames drawn, how many needed the whole figure drawn, the average time to draw a
+        frame in seconds and the frames per second over the last FPS_FRAMES frames, with the render worker's
+        statistics and how many of its images were shown if one is used
+        """
+        fps = 0.0
+        if len(self.frame_start_times) > 1:
+            fps = (len(self.frame_start_times) - 1) / (self.frame_start_times[-1] - self.frame_start_times[0])
+        stats = {'frames': self.frames,
+                 'full redraws': self.full_redraws,
+                 'frame time': self.total_frame_time / max(self.frames, 1),
+                 'fps': fps}
+        if self.render_worker:
+            stats.update(self.render_worker.stats())
+            stats['frames shown'] = self.frames_shown
+        return stats
+
+    def on_xlim_changed(self, axis):
+        if not self.setting_limits:
+            self.display_range(*axis.get_xlim())
+
+    def display_range(self, start_time, end_time):
+        """ Draw any part of the recording, the data has about one point for each pixel of the plot's width so
+        it takes the same time to draw 5 ms as 2 hours
+        :param start_time: float, s from the start of the recording
+        :param end_time: float, s from the start of the recording
+        """
+        pixel_width = max(int(self.axis.get_window_extent().width), 1)
+        x, y_data = self.data.get_display_range(start_time, end_time, pixel_width)
+        for line, y in zip(self.lines, y_data):
+            line.set_data(x, y)
+        self.axis.relim()
+        self.axis.autoscale_view(True, False, True)
+        self.canvas.draw_idle()
+
     def set_num_channels(self, num_channels):
         diff_channels = len(self.lines) - num_channels
         if diff_channels < 0:  # there are more lines currently displayed than the user chose
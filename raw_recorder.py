@@ -0,0 +1,254 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Write the raw adc counts to a memory mapped file while they are being read, so a crash or a long recording
+does not lose the data or fill up the memory.
+
+The file is a HEADER_SIZE byte header followed by the int16 adc counts, interleaved by channel, as they were stored
+(raw from the device, or through the storage filter).  The header has the sample rate, number of channels, counts
+to volts conversion, the filter the adc counts went through (from version 2) and how many adc counts have been
+written, which is updated after every adc buffer so the file can be read after a crash.  The
+file is made larger by chunk_size adc counts at a time and cut down to the adc counts written when finalized.
+
+Only the chunk being written is memory mapped.  When it is full it is unmapped and the next chunk is mapped, so
+the recorded adc counts are left to the operating system to keep on the disk and the memory used stays the same
+however long the recording is.
+"""
+# standard libraries
+import mmap
+import os
+import struct
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+MAGIC = b'PLANTRAW'
+VERSION = 2
+HEADER_FORMAT = '<8sHHdddQ'  # magic, version, number channels, sample rate, counts to volts, voltage shift, count
+# notch frequency, notch quality, low and high band-pass Hz (0 for none), band-pass order, filter kind
+FILTER_FORMAT = '<ffffHH'
+FILTER_OFFSET = struct.calcsize(HEADER_FORMAT)  # the filter is after the version 1 header
+FILTER_NONE, FILTER_SETTINGS, FILTER_CUSTOM = 0, 1, 2  # filter kinds, raw adc counts, made by make_sos, custom
+HEADER_SIZE = 64  # bytes, the header is padded to this size
+COUNT_OFFSET = struct.calcsize(HEADER_FORMAT) - 8  # where the number of adc counts written is in the header
+RECORDING_CHUNK_SIZE = 2 ** 23  # adc counts to grow the file by, 16 MB
+
+
+class RawRecorder(object):
+    """ Append adc buffers to a raw recording file through a memory map """
+
+    def __init__(self, filename, sample_rate, number_channels, counts_to_volts, voltage_shift=0,
+                 chunk_size=RECORDING_CHUNK_SIZE, filter_settings=None):
+        """ Make the recording file and map the first chunk of it
+        :param filename: str, path of the file to record to
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param counts_to_volts: float, mV per adc count
+        :param voltage_shift: float, mV to add after converting the adc counts
+        :param chunk_size: int, adc counts to make the file larger by each time it is full
+        :param filter_settings: dict of the settings of the filter the adc counts go through (see
+        stream_filter.StreamingFilter.settings), None if they are raw
+        """
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.number_channels = number_channels
+        self.counts_to_volts = counts_to_volts
+        self.voltage_shift = voltage_shift
+        self.filter_settings = filter_settings
+        self.chunk_size = chunk_size
+        self.sample_count = 0  # adc counts written
+        self.capacity = 0  # adc counts the file can hold before it has to be made larger
+        self.file = open(filename, 'w+b')
+        self.reader = None  # unbuffered file to read back parts of the recording, opened when first needed
+        self.grow(chunk_size)
+        self.header_mmap = mmap.mmap(self.file.fileno(), HEADER_SIZE)
+        self.mmap = None  # memory map of the chunk being written
+        self.window_start = 0  # adc count the mapped chunk starts at
+        self.adc_counts = None  # numpy view of the adc counts of the mapped chunk
+        self.map_window(0)
+        self.write_header()
+
+    def grow(self, min_capacity):
+        """ Make the file larger, by whole chunks, so it holds at least min_capacity adc counts
+        :param min_capacity: int, adc counts the file needs to hold
+        """
+        new_capacity = self.capacity
+        while new_capacity < min_capacity:
+            new_capacity += self.chunk_size
+        self.file.truncate(HEADER_SIZE + 2 * new_capacity)
+        self.capacity = new_capacity
+
+    def map_window(self, window_start):
+        """ Unmap the chunk being written and map the chunk starting at window_start, making the file larger if
+        it does not hold the chunk yet
+        :param window_start: int, adc count the chunk starts at, a multiple of chunk_size
+        """
+        self.unmap_window()
+        self.grow(window_start + self.chunk_size)
+        # the memory map has to start at a multiple of the allocation granularity
+        byte_start = HEADER_SIZE + 2 * window_start
+        map_start = byte_start - byte_start % mmap.ALLOCATIONGRANULARITY
+        self.mmap = mmap.mmap(self.file.fileno(), byte_start - map_start + 2 * self.chunk_size, offset=map_start)
+        self.adc_counts = np.ndarray(self.chunk_size, dtype=np.int16, buffer=self.mmap,
+                                     offset=byte_start - map_start)
+        self.window_start = window_start
+
+    def unmap_window(self):
+        if self.mmap:
+            self.mmap.flush()
+            self.adc_counts = None  # the view has to be let go before the memory map can be closed
+            self.mmap.close()
+            self.mmap = None
+
+    def write_header(self):
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.number_channels, self.sample_rate,
+                             self.counts_to_volts, self.voltage_shift, self.sample_count)
+        self.header_mmap[:len(header)] = header
+        filter_header = pack_filter(self.filter_settings)
+        self.header_mmap[FILTER_OFFSET:FILTER_OFFSET + len(filter_header)] = filter_header
+
+    def set_count_to_volts(self, counts_to_volts, voltage_shift):
+        self.counts_to_volts = counts_to_volts
+        self.voltage_shift = voltage_shift
+        self.write_header()
+
+    def set_filter(self, filter_settings):
+        """ Set the filter the adc counts are stored through, only the last filter set is in the header
+        :param filter_settings: dict of the filter settings, None if the adc counts are raw
+        """
+        self.filter_settings = filter_settings
+        self.write_header()
+
+    def append(self, adc_counts):
+        """ Copy an adc buffer to the end of the recording
+        :param adc_counts: array of int16 adc counts
+        """
+        length = len(adc_counts)
+        written = 0
+        while written < length:
+            if self.sample_count == self.window_start + self.chunk_size:
+                self.map_window(self.sample_count)
+            window_ptr = self.sample_count - self.window_start
+            part = min(length - written, self.chunk_size - window_ptr)
+            self.adc_counts[window_ptr:window_ptr + part] = adc_counts[written:written + part]
+            written += part
+            self.sample_count += part
+        # update the count after the adc counts are in the file, so the header never counts unwritten data
+        self.header_mmap[COUNT_OFFSET:COUNT_OFFSET + 8] = struct.pack('<Q', self.sample_count)
+
+    def samples(self):
+        """ Get the adc counts recorded so far without reading them into memory, the operating system reads the
+        parts that are used from the disk.  Adc counts appended later are not in it
+        :return: read only numpy memmap of int16, interleaved by channel
+        """
+        if not self.sample_count:
+            return np.empty(0, dtype=np.int16)
+        return np.memmap(self.filename, dtype=np.int16, mode='r', offset=HEADER_SIZE, shape=(self.sample_count,))
+
+    def read(self, start, stop):
+        """ Read a range of the adc counts recorded so far
+        :param start: int, first adc count to read
+        :param stop: int, adc count to stop before
+        :return: numpy array of int16
+        """
+        stop = min(stop, self.sample_count)
+        start = min(max(start, 0), stop)
+        if not self.reader:
+            self.reader = open(self.filename, 'rb', buffering=0)
+        adc_counts = np.empty(stop - start, dtype=np.int16)
+        self.reader.seek(HEADER_SIZE + 2 * start)
+        self.reader.readinto(memoryview(adc_counts).cast('B'))
+        return adc_counts
+
+    def flush(self):
+        """ Make sure everything written so far is on the disk """
+        self.mmap.flush()
+        self.header_mmap.flush()
+
+    def close(self):
+        """ Write the header, cut the file down to the adc counts written and close it """
+        if self.file.closed:
+            return
+        self.write_header()
+        self.unmap_window()
+        self.header_mmap.flush()
+        self.header_mmap.close()
+        if self.reader:
+            self.reader.close()
+        self.file.truncate(HEADER_SIZE + 2 * self.sample_count)
+        self.file.close()
+
+    def finalize(self, filename=None):
+        """ Close the recording and move it to filename
+        :param filename: str, path to save the recording as, None to leave it where it is
+        :return: str, path of the recording
+        """
+        self.close()
+        if filename and filename != self.filename:
+            os.replace(self.filename, filename)
+            self.filename = filename
+        return self.filename
+
+
+def pack_filter(filter_settings):
+    """ Pack the settings of a filter into the filter part of the header
+    :param filter_settings: dict of the filter settings (see stream_filter.StreamingFilter.settings) or None
+    :return: bytes
+    """
+    if not filter_settings:
+        return struct.pack(FILTER_FORMAT, 0, 0, 0, 0, 0, FILTER_NONE)
+    if filter_settings.get('custom'):
+        return struct.pack(FILTER_FORMAT, 0, 0, 0, 0, 0, FILTER_CUSTOM)
+    low, high = filter_settings['band'] or (None, None)
+    return struct.pack(FILTER_FORMAT, filter_settings['notch frequency'] or 0, filter_settings['notch quality'],
+                       low or 0, high or 0, filter_settings['order'], FILTER_SETTINGS)
+
+
+def unpack_filter(filter_header):
+    """ Unpack the filter part of the header
+    :param filter_header: bytes
+    :return: dict of the filter settings, {'custom': True} for second order sections that are not in the header,
+    or None if the adc counts are raw
+    """
+    values = struct.unpack(FILTER_FORMAT, filter_header)
+    # the frequencies are kept as float32, round off the digits float32 does not have
+    notch_frequency, notch_quality, low, high = [float('{0:.7g}'.format(value)) for value in values[:4]]
+    order, kind = values[4:]
+    if kind == FILTER_NONE:
+        return None
+    if kind == FILTER_CUSTOM:
+        return {'custom': True}
+    return {'notch frequency': notch_frequency or None, 'notch quality': notch_quality,
+            'band': [low or None, high or None] if low or high else None, 'order': order}
+
+
+def read_header(filename):
+    """ Read the header of a raw recording
+    :param filename: str, path of the recording
+    :return: dict of the header values
+    """
+    with open(filename, 'rb') as _file:
+        header = _file.read(HEADER_SIZE)
+    magic, version, number_channels, sample_rate, counts_to_volts, voltage_shift, sample_count = \
+        struct.unpack(HEADER_FORMAT, header[:FILTER_OFFSET])
+    if magic != MAGIC:
+        raise IOError("{0} is not a raw recording file".format(filename))
+    filter_settings = None  # version 1 headers do not have the filter
+    if version >= 2:
+        filter_settings = unpack_filter(header[FILTER_OFFSET:FILTER_OFFSET + struct.calcsize(FILTER_FORMAT)])
+    return {'version': version, 'number channels': number_channels, 'sample rate': sample_rate,
+            'counts to mVs': counts_to_volts, 'voltage shift': voltage_shift, 'sample count': sample_count,
+            'filter': filter_settings}
+
+
+def open_recording(filename):
+    """ Open a raw recording without reading it into memory
+    :param filename: str, path of the recording
+    :return: header dict, read only numpy memmap of the int16 adc counts interleaved by channel
+    """
+    header = read_header(filename)
+    if not header['sample count']:
+        return header, np.empty(0, dtype=np.int16)
+    adc_counts = np.memmap(filename, dtype=np.int16, mode='r', offset=HEADER_SIZE, shape=(header['sample count'],))
+    return header, adc_counts
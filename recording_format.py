@@ -0,0 +1,206 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Chunked, compressed recording file (.plant) that any part of can be read without reading the whole file.
+
+Each channel is cut into chunks of chunk_size samples.  A chunk is stored as the differences between samples
+(the first sample is kept as is), with the low and high bytes of the differences separated, compressed with zlib
+(deflate, LZ77 and Huffman entropy coding).  This is lossless for int16.  After the chunks comes the index, a
+table with the channel, first sample, number of samples, file offset and compressed size of every chunk, and the
+metadata as json ('sample rate', 'counts to mVs', ...).  The file ends with a footer pointing to the index.
+"""
+# standard libraries
+import json
+import struct
+import zlib
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+MAGIC = b'PLANTCHK'
+VERSION = 1
+FILE_HEADER_FORMAT = '<8sH'  # magic, version
+FOOTER_FORMAT = '<QQQ8s'  # index offset, number of chunks, metadata size, magic
+CHUNK_SIZE = 2 ** 16  # samples of a channel in each chunk, 13 s at 5 kHz
+COMPRESSION_LEVEL = 1  # zlib level, 1 is fastest, 9 compresses most, 1 already gets most of the compression
+INDEX_DTYPE = np.dtype([('channel', '<u2'), ('start', '<u8'), ('length', '<u4'),
+                        ('offset', '<u8'), ('size', '<u4')])
+
+
+def encode_chunk(samples, compression_level=COMPRESSION_LEVEL):
+    """ Delta encode and compress a chunk of int16 samples
+    :param samples: numpy array of int16
+    :param compression_level: int, zlib compression level
+    :return: bytes
+    """
+    samples = np.asarray(samples, dtype='<i2')
+    deltas = np.empty_like(samples)
+    deltas[:1] = samples[:1]
+    np.subtract(samples[1:], samples[:-1], out=deltas[1:])  # int16 wraps around, which the decoding undoes
+    # put the low bytes together and the high bytes together, the high bytes of small differences are mostly the
+    # same so they compress well
+    shuffled = deltas.view(np.uint8).reshape(-1, 2).T.tobytes()
+    return zlib.compress(shuffled, compression_level)
+
+
+def decode_chunk(compressed, length):
+    """ Undo encode_chunk
+    :param compressed: bytes from encode_chunk
+    :param length: int, number of samples in the chunk
+    :return: numpy array of int16
+    """
+    shuffled = np.frombuffer(zlib.decompress(compressed), dtype=np.uint8).reshape(2, length)
+    deltas = np.ascontiguousarray(shuffled.T).view('<i2').ravel()
+    return np.cumsum(deltas, dtype=np.int16)  # the sum wraps around the same way the differences did
+
+
+class ChunkedRecordingWriter(object):
+    """ Write interleaved adc counts to a .plant file.  Each channel is buffered until it has a whole chunk """
+
+    def __init__(self, filename, sample_rate, number_channels, counts_to_volts, chunk_size=CHUNK_SIZE,
+                 compression_level=COMPRESSION_LEVEL, **metadata):
+        """
+        :param filename: str, path of the file to write
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param counts_to_volts: float, mV per adc count
+        :param chunk_size: int, samples of a channel in each chunk
+        :param compression_level: int, zlib compression level
+        :param metadata: any other values to save with the recording, they have to be json serializable
+        """
+        self.filename = filename
+        self.number_channels = number_channels
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.metadata = dict(metadata)
+        self.metadata.update({'sample rate': float(sample_rate), 'counts to mVs': float(counts_to_volts),
+                              'number channels': number_channels, 'chunk size': chunk_size})
+        self.file = open(filename, 'wb')
+        self.file.write(struct.pack(FILE_HEADER_FORMAT, MAGIC, VERSION))
+        self.index = []  # tuples of INDEX_DTYPE
+        self.channel_buffers = [np.empty(chunk_size, dtype=np.int16) for _ in range(number_channels)]
+        self.buffered = 0  # samples of each channel in channel_buffers
+        self.samples_written = 0  # samples of each channel written in chunks
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 appends
+        self.raw_bytes = 0  # bytes the adc counts written would take uncompressed
+        self.compressed_bytes = 0
+
+    def append(self, adc_counts):
+        """ Add adc counts, interleaved by channel, to the recording
+        :param adc_counts: numpy array of int16
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        frame_ptr = 0
+        while frame_ptr < whole_frames:
+            length = min(whole_frames - frame_ptr, self.chunk_size - self.buffered)
+            for channel, channel_buffer in enumerate(self.channel_buffers):
+                channel_buffer[self.buffered:self.buffered + length] = frames[frame_ptr:frame_ptr + length, channel]
+            self.buffered += length
+            frame_ptr += length
+            if self.buffered == self.chunk_size:
+                self.write_chunks()
+
+    def write_chunks(self):
+        """ Compress and write the buffered samples of each channel """
+        if not self.buffered:
+            return
+        for channel, channel_buffer in enumerate(self.channel_buffers):
+            compressed = encode_chunk(channel_buffer[:self.buffered], self.compression_level)
+            self.index.append((channel, self.samples_written, self.buffered, self.file.tell(), len(compressed)))
+            self.file.write(compressed)
+            self.compressed_bytes += len(compressed)
+        self.raw_bytes += 2 * self.buffered * self.number_channels
+        self.samples_written += self.buffered
+        self.buffered = 0
+
+    def close(self):
+        """ Write the last chunks, the index, metadata and footer """
+        if self.file.closed:
+            return
+        self.write_chunks()
+        self.metadata['number samples'] = self.samples_written
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        metadata = json.dumps(self.metadata).encode()
+        self.file.write(metadata)
+        self.file.write(struct.pack(FOOTER_FORMAT, index_offset, len(self.index), len(metadata), MAGIC))
+        self.file.close()
+
+    def compression_ratio(self):
+        """ Uncompressed size over compressed size of the chunks written so far """
+        return self.raw_bytes / max(self.compressed_bytes, 1)
+
+
+class ChunkedRecordingReader(object):
+    """ Read any range of samples of a channel from a .plant file, only the chunks in the range are decompressed """
+
+    def __init__(self, filename):
+        """
+        :param filename: str, path of the .plant file
+        """
+        self.file = open(filename, 'rb')
+        magic, version = struct.unpack(FILE_HEADER_FORMAT, self.file.read(struct.calcsize(FILE_HEADER_FORMAT)))
+        if magic != MAGIC:
+            raise IOError("{0} is not a .plant recording file".format(filename))
+        footer_size = struct.calcsize(FOOTER_FORMAT)
+        self.file.seek(-footer_size, 2)
+        index_offset, number_chunks, metadata_size, magic = struct.unpack(FOOTER_FORMAT, self.file.read(footer_size))
+        if magic != MAGIC:
+            raise IOError("{0} was not closed properly, it has no index".format(filename))
+        self.file.seek(index_offset)
+        self.index = np.frombuffer(self.file.read(number_chunks * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+        self.metadata = json.loads(self.file.read(metadata_size).decode())
+        self.sample_rate = self.metadata['sample rate']
+        self.counts_to_volts = self.metadata['counts to mVs']
+        self.number_channels = self.metadata['number channels']
+        self.number_samples = self.metadata['number samples']
+        # the chunk starts of each channel, in order, to find the chunks of a range with a binary search
+        self.channel_index = [self.index[self.index['channel'] == channel] for channel in range(self.number_channels)]
+
+    def read(self, channel, start=0, stop=None):
+        """ Read the adc counts of a channel from sample start up to sample stop
+        :param channel: int, channel to read
+        :param start: int, first sample to read
+        :param stop: int, sample to stop before, None to read to the end
+        :return: numpy array of int16
+        """
+        if stop is None or stop > self.number_samples:
+            stop = self.number_samples
+        start = max(start, 0)
+        if stop <= start:
+            return np.empty(0, dtype=np.int16)
+        chunks = self.channel_index[channel]
+        first = np.searchsorted(chunks['start'], start, side='right') - 1
+        last = np.searchsorted(chunks['start'], stop, side='left')
+        adc_counts = np.empty(stop - start, dtype=np.int16)
+        for chunk in chunks[first:last]:
+            self.file.seek(int(chunk['offset']))
+            samples = decode_chunk(self.file.read(int(chunk['size'])), int(chunk['length']))
+            chunk_start = int(chunk['start'])
+            copy_start = max(start, chunk_start)
+            copy_stop = min(stop, chunk_start + int(chunk['length']))
+            adc_counts[copy_start - start:copy_stop - start] = \
+                samples[copy_start - chunk_start:copy_stop - chunk_start]
+        return adc_counts
+
+    def read_time(self, channel, start_time, end_time):
+        """ Read the adc counts of a channel between 2 times
+        :param channel: int, channel to read
+        :param start_time: float, seconds from the start of the recording
+        :param end_time: float, seconds from the start of the recording
+        :return: numpy array of int16
+        """
+        return self.read(channel, int(round(start_time * self.sample_rate)), int(round(end_time * self.sample_rate)))
+
+    def read_voltage(self, channel, start_time, end_time):
+        """ Same as read_time but converted to mV """
+        return self.read_time(channel, start_time, end_time) * self.counts_to_volts
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,143 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Draw the live plot in a separate thread so the tk thread only has to copy the finished image to the screen.
+
+The tk thread gives the worker a snapshot of the data to draw (a copy of the visible part of the display buffers
+and the axis limits) with submit.  The worker only keeps the newest snapshot, if the tk thread gives it a new one
+before it starts drawing the last one the last one is dropped.  The worker draws on its own matplotlib figure with
+the Agg backend (no tk) into one of 2 RGBA buffers that are reused for every frame, and get_frame gives the tk
+thread the newest finished buffer.
+"""
+# standard libraries
+import threading
+import time
+# installed libraries
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+Y_MARGIN = 0.1  # fraction of the data's range added above and below it
+
+
+class PlotSnapshot(object):
+    """ Everything the worker needs to draw a frame, the tk thread does not touch it after submitting it """
+    def __init__(self, x, y_data, x_limits, size, dpi):
+        """
+        :param x: numpy array of times
+        :param y_data: list of a numpy array for each channel, copies so the display buffers can be written to
+        :param x_limits: [left, right] s
+        :param size: (width, height) pixels of the image to draw
+        :param dpi: float, dots per inch of the figure
+        """
+        self.x = x
+        self.y_data = y_data
+        self.x_limits = x_limits
+        self.size = size
+        self.dpi = dpi
+
+
+class RenderWorker(threading.Thread):
+    """ Thread that draws PlotSnapshots into reusable RGBA buffers """
+
+    def __init__(self, colors):
+        """
+        :param colors: list of the color of each channel's line
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.colors = colors
+        self.condition = threading.Condition()
+        self.pending = None  # type: PlotSnapshot  newest snapshot the worker has not started drawing
+        self.running = True
+        self.figure = None
+        self.figure_canvas = None
+        self.axis = None
+        self.lines = []
+        self.buffers = [None, None]  # RGBA images, the worker draws into one while the tk thread uses the other
+        self.front = 0  # index of the buffer with the newest finished frame
+        self.frame_number = 0  # frames finished
+        self.frames_dropped = 0
+        self.total_render_time = 0.0  # s
+
+    def submit(self, snapshot: PlotSnapshot):
+        """ Give the worker a new frame to draw, a frame it has not started drawing yet is dropped """
+        with self.condition:
+            if self.pending is not None:
+                self.frames_dropped += 1
+            self.pending = snapshot
+            self.condition.notify()
+
+    def get_frame(self):
+        """ Get the newest finished frame, hold self.condition while using it so the worker does not write over it
+        :return: frame number and RGBA numpy array (height, width, 4) of uint8, or 0 and None if no frame is done
+        """
+        return self.frame_number, self.buffers[self.front]
+
+    def stop_running(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                snapshot, self.pending = self.pending, None
+            render_start = time.perf_counter()
+            back = 1 - self.front
+            self.buffers[back] = self.draw(snapshot, self.buffers[back])
+            with self.condition:
+                self.front = back
+                self.frame_number += 1
+            self.total_render_time += time.perf_counter() - render_start
+
+    def draw(self, snapshot, rgba_buffer):
+        """ Draw a snapshot and copy the image into rgba_buffer, a new buffer is made if it is not the right size
+        :param snapshot: PlotSnapshot to draw
+        :param rgba_buffer: numpy array to put the image in, or None
+        :return: numpy array (height, width, 4) of uint8 with the image
+        """
+        self.make_figure(snapshot)
+        for line, y in zip(self.lines, snapshot.y_data):
+            line.set_data(snapshot.x, y)
+        self.axis.set_xlim(snapshot.x_limits)
+        if len(snapshot.y_data) and len(snapshot.x):
+            data_min = min(np.min(y) for y in snapshot.y_data)
+            data_max = max(np.max(y) for y in snapshot.y_data)
+            margin = max(data_max - data_min, 1e-3) * Y_MARGIN
+            self.axis.set_ylim([data_min - margin, data_max + margin])
+        self.figure_canvas.draw()
+        width, height = self.figure_canvas.get_width_height()
+        image = np.frombuffer(self.figure_canvas.buffer_rgba(), dtype=np.uint8).reshape(height, width, 4)
+        if rgba_buffer is None or rgba_buffer.shape != image.shape:
+            rgba_buffer = np.empty_like(image)
+        rgba_buffer[:] = image
+        return rgba_buffer
+
+    def make_figure(self, snapshot):
+        """ Make the worker's figure, or make it again if the size or number of channels of the snapshot changed """
+        width, height = snapshot.size
+        if (self.figure and self.figure_canvas.get_width_height() == (width, height)
+                and len(self.lines) == len(snapshot.y_data)):
+            return
+        self.figure = Figure(figsize=(width / snapshot.dpi, height / snapshot.dpi), dpi=snapshot.dpi)
+        self.figure_canvas = FigureCanvasAgg(self.figure)
+        self.axis = self.figure.add_subplot(111)
+        self.lines = []
+        for i in range(len(snapshot.y_data)):
+            _line, = self.axis.plot([], [], label='channel %d' % (i+1), c=self.colors[i])
+            self.lines.append(_line)
+        self.axis.legend(loc=1)
+
+    def stats(self):
+        """ Get the statistics of the frames drawn
+        :return: dict of the frames drawn and dropped and the average time to draw a frame in seconds
+        """
+        return {'frames rendered': self.frame_number,
+                'frames dropped': self.frames_dropped,
+                'render time': self.total_render_time / max(self.frame_number, 1)}
@@ -0,0 +1,118 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Running statistics of each channel over the last few seconds, to judge the electrodes while recording.
+
+The adc counts are cut into blocks of block_time and the count, sum, sum of squares, minimum and maximum of each
+block are kept in a ring of the newest blocks.  Adding an adc buffer only reduces its own samples, and getting
+the statistics only reduces the ring, so neither depends on how long the recording is.  The drift is the slope of
+a straight line fit to the block means over drift_time.
+"""
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+BLOCK_TIME = 0.1  # s, samples summed together in the ring
+WINDOW_TIME = 10.0  # s, time the mean, rms, standard deviation, minimum and maximum are over
+DRIFT_TIME = 60.0  # s, time the drift is fit over
+
+
+class RunningStatistics(object):
+    """ Block statistics of interleaved adc counts in a ring, updated with each adc buffer """
+
+    def __init__(self, number_channels, sample_rate, block_time=BLOCK_TIME, window_time=WINDOW_TIME,
+                 drift_time=DRIFT_TIME):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param block_time: float, s, time of each block in the ring
+        :param window_time: float, s, time the statistics are over
+        :param drift_time: float, s, time the drift is fit over
+        """
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        self.block_size = max(int(block_time * sample_rate), 1)  # samples of a channel in a block
+        self.window_blocks = max(int(window_time / block_time), 1)
+        self.ring_size = max(int(drift_time / block_time), self.window_blocks, 2)
+        self.reset()
+
+    def reset(self, number_channels=None):
+        """ Clear the statistics, call when a new data stream is started
+        :param number_channels: int, number of channels in the new data stream, None if it is the same
+        """
+        if number_channels:
+            self.number_channels = number_channels
+        shape = (self.ring_size, self.number_channels)
+        self.sums = np.zeros(shape)
+        self.squares = np.zeros(shape)
+        self.mins = np.zeros(shape)
+        self.maxs = np.zeros(shape)
+        self.blocks = 0  # blocks finished since the reset
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+        self.partial_block = np.empty((0, self.number_channels), dtype=np.int16)  # frames of the unfinished block
+
+    def update(self, adc_counts):
+        """ Add the blocks an adc buffer finishes to the ring
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        if len(self.partial_block):
+            frames = np.concatenate((self.partial_block, frames))
+        number_blocks = len(frames) // self.block_size
+        self.partial_block = frames[number_blocks * self.block_size:].copy()
+        if not number_blocks:
+            return
+        if number_blocks > self.ring_size:  # only the newest blocks fit in the ring
+            skipped = number_blocks - self.ring_size
+            frames = frames[skipped * self.block_size:]
+            self.blocks += skipped
+            number_blocks = self.ring_size
+        blocks = frames[:number_blocks * self.block_size].reshape(number_blocks, self.block_size,
+                                                                  self.number_channels).astype(np.float64)
+        ring_index = (self.blocks + np.arange(number_blocks)) % self.ring_size
+        self.sums[ring_index] = blocks.sum(axis=1)
+        self.squares[ring_index] = np.square(blocks).sum(axis=1)
+        self.mins[ring_index] = blocks.min(axis=1)
+        self.maxs[ring_index] = blocks.max(axis=1)
+        self.blocks += number_blocks
+
+    def statistics(self, counts_to_volts=1.0):
+        """ Get the statistics of each channel over the window and the drift
+        :param counts_to_volts: float, mV per adc count to convert the statistics with
+        :return: dict of numpy arrays with a value for each channel: 'mean', 'rms', 'std', 'min', 'max' in mV and
+        'drift' in mV per minute, or None if no block has finished
+        """
+        if not self.blocks:
+            return None
+        window = self.newest_blocks(self.window_blocks)
+        count = len(window) * self.block_size
+        mean = self.sums[window].sum(axis=0) / count
+        mean_square = self.squares[window].sum(axis=0) / count
+        variance = np.maximum(mean_square - mean ** 2, 0)
+        drift_blocks = self.newest_blocks(self.ring_size)
+        drift = np.zeros(self.number_channels)
+        if len(drift_blocks) > 1:
+            block_times = np.arange(len(drift_blocks)) * self.block_size / self.sample_rate
+            block_means = self.sums[drift_blocks] / self.block_size
+            block_times -= block_times.mean()
+            drift = block_times.dot(block_means - block_means.mean(axis=0)) / block_times.dot(block_times)
+        return {'mean': mean * counts_to_volts,
+                'rms': np.sqrt(mean_square) * abs(counts_to_volts),
+                'std': np.sqrt(variance) * abs(counts_to_volts),
+                'min': self.mins[window].min(axis=0) * counts_to_volts,
+                'max': self.maxs[window].max(axis=0) * counts_to_volts,
+                'drift': 60 * drift * counts_to_volts}
+
+    def newest_blocks(self, number_blocks):
+        """ Get the ring positions of the newest blocks, oldest first
+        :param number_blocks: int, most blocks to get
+        :return: numpy array of int
+        """
+        number_blocks = min(number_blocks, self.blocks, self.ring_size)
+        return (self.blocks - number_blocks + np.arange(number_blocks)) % self.ring_size
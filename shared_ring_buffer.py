@@ -0,0 +1,177 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Ring buffer of int16 adc counts in shared memory, so the usb reading can run in another process than the
+GUI.  There is one writer (the acquisition process) and one reader (the GUI), each only moves its own cursor.
+
+Each adc buffer put in the ring is kept whole as a record, 2 int16 words with the number of adc counts in it and
+then the adc counts, and get_nowait returns a copy of one adc buffer, the same as the data queue of the threaded
+acquisition modes.  The cursors count every int16 word ever written or read, so the position in the ring is
+cursor % capacity and a record can wrap around the end of the ring.  The writer copies a record into the ring
+before it moves the write cursor, and the reader copies it out before it moves the read cursor, the cursors are
+only read and moved while holding lock so the other process never sees a cursor moved before the words it covers.
+
+The writer also shares its fit of the host time each sample was taken at (see clock_sync.ClockSync) after the
+header, so the reader can stamp a stimulation with the sample it was given at without time stamping the adc
+buffers again.  Both processes read time.perf_counter, which is the same system wide monotonic clock on Linux and
+Windows.
+"""
+# standard libraries
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+RING_BUFFER_SIZE = 2 ** 22  # int16 words, ~4.6 minutes of 3 channels at 5 kHz
+RECORD_HEADER_SIZE = 2  # int16 words before the adc counts of each record, the number of adc counts as a uint32
+# positions of the int64 values in the header
+WRITE_CURSOR = 0
+READ_CURSOR = 1
+OVERRUNS = 2  # adc buffers the writer dropped because the reader had not made space for them
+CAPACITY = 3
+COUNTS_WRITTEN = 4  # adc counts in the records written
+COUNTS_READ = 5  # adc counts in the records read
+CLOCK_BUFFERS = 6  # adc buffers in the writer's clock fit
+HEADER_SIZE = 7
+CLOCK_SIZE = 3  # float64 values after the header, the first_time and fit of the writer's clock_sync.ClockSync
+
+
+class SharedRingBuffer(object):
+    """ Single writer, single reader ring buffer of int16 in a multiprocessing.shared_memory block.  The writer
+    calls put with each adc buffer, the reader calls get_nowait to get a copy of the next adc buffer.  put and
+    get_nowait work like a queue.Queue so either can be used as the data queue.
+    """
+
+    def __init__(self, name=None, capacity=RING_BUFFER_SIZE, lock=None):
+        """ Make a new ring buffer, or attach to the ring buffer another process made if name is given
+        :param name: str, name of the shared memory block to attach to, None to make a new one
+        :param capacity: int, int16 words the ring can hold, only used when making a new ring buffer
+        :param lock: multiprocessing.Lock of the ring buffer being attached to (its lock attribute), None when
+        making a new ring buffer
+        """
+        self.owner = name is None
+        if self.owner:
+            self.shared_memory = shared_memory.SharedMemory(create=True,
+                                                            size=8 * (HEADER_SIZE + CLOCK_SIZE) + 2 * capacity)
+            self.lock = lock or multiprocessing.Lock()
+        elif lock is None:
+            raise ValueError("Attaching to a ring buffer needs the lock of the ring buffer")
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+            self.lock = lock
+        self.header = np.ndarray(HEADER_SIZE, dtype=np.int64, buffer=self.shared_memory.buf)
+        self.clock = np.ndarray(CLOCK_SIZE, dtype=np.float64, buffer=self.shared_memory.buf, offset=8 * HEADER_SIZE)
+        if self.owner:
+            self.header[:] = 0
+            self.header[CAPACITY] = capacity
+            self.clock[:] = 0
+        self.capacity = int(self.header[CAPACITY])
+        self.ring = np.ndarray(self.capacity, dtype=np.int16, buffer=self.shared_memory.buf,
+                               offset=8 * (HEADER_SIZE + CLOCK_SIZE))
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    @property
+    def overruns(self):
+        return int(self.header[OVERRUNS])
+
+    @property
+    def counts_written(self):
+        """ Number of adc counts the writer has put in the ring, not counting the dropped adc buffers """
+        return int(self.header[COUNTS_WRITTEN])
+
+    def unread(self):
+        """ Number of adc counts written but not read yet """
+        with self.lock:
+            return int(self.header[COUNTS_WRITTEN] - self.header[COUNTS_READ])
+
+    def empty(self):
+        with self.lock:
+            return self.header[WRITE_CURSOR] == self.header[READ_CURSOR]
+
+    def qsize(self):
+        return self.unread()
+
+    def put(self, adc_counts):
+        """ Writer side: copy an adc buffer into the ring.  If there is not space for all of it the whole buffer is
+        dropped and counted as an overrun, so the reader never sees part of a buffer written over
+        :param adc_counts: array of int16
+        :return: True if the adc counts were written, False if they were dropped
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        length = len(adc_counts)
+        with self.lock:
+            write_cursor = int(self.header[WRITE_CURSOR])
+            free = self.capacity - (write_cursor - int(self.header[READ_CURSOR]))
+            if RECORD_HEADER_SIZE + length > free:
+                self.header[OVERRUNS] += 1
+                return False
+        # the reader does not read past the write cursor, so the record can be copied in without the lock
+        self._write_words(write_cursor, np.array([length], dtype=np.uint32).view(np.int16))
+        self._write_words(write_cursor + RECORD_HEADER_SIZE, adc_counts)
+        with self.lock:
+            self.header[WRITE_CURSOR] = write_cursor + RECORD_HEADER_SIZE + length
+            self.header[COUNTS_WRITTEN] += length
+        return True
+
+    def get_nowait(self):
+        """ Reader side: get a copy of the next adc buffer put in the ring and let the writer use its space
+        :return: numpy array of int16 adc counts
+        :raises queue.Empty: if there are no unread adc buffers
+        """
+        with self.lock:
+            read_cursor = int(self.header[READ_CURSOR])
+            if int(self.header[WRITE_CURSOR]) == read_cursor:
+                raise queue.Empty
+        # the writer does not write over the words past the read cursor, so the record can be copied without the lock
+        length = int(self._read_words(read_cursor, RECORD_HEADER_SIZE).view(np.uint32)[0])
+        adc_counts = self._read_words(read_cursor + RECORD_HEADER_SIZE, length)
+        with self.lock:
+            self.header[READ_CURSOR] = read_cursor + RECORD_HEADER_SIZE + length
+            self.header[COUNTS_READ] += length
+        return adc_counts
+
+    def set_clock(self, clock):
+        """ Writer side: share the fit of the host time each sample was taken at
+        :param clock: clock_sync.ClockSync the writer time stamps the adc buffers in
+        """
+        first_time, (intercept, slope) = clock.first_time, clock.fit
+        with self.lock:
+            self.clock[:] = (first_time or 0.0, intercept, slope)
+            self.header[CLOCK_BUFFERS] = clock.buffers
+
+    def get_clock(self):
+        """ Reader side: get the fit of the host time each sample was taken at the writer shared with set_clock
+        :return: int, adc buffers in the fit, float, host time of the first time stamp, and tuple of the fit
+        (see clock_sync.ClockSync)
+        """
+        with self.lock:
+            return int(self.header[CLOCK_BUFFERS]), float(self.clock[0]), (float(self.clock[1]), float(self.clock[2]))
+
+    def _write_words(self, cursor, words):
+        """ Copy int16 words into the ring starting at a cursor, wrapping around the end of the ring """
+        start = cursor % self.capacity
+        first_part = min(len(words), self.capacity - start)
+        self.ring[start:start + first_part] = words[:first_part]
+        self.ring[:len(words) - first_part] = words[first_part:]
+
+    def _read_words(self, cursor, length):
+        """ Copy length int16 words out of the ring starting at a cursor, wrapping around the end of the ring """
+        start = cursor % self.capacity
+        first_part = min(length, self.capacity - start)
+        words = np.empty(length, dtype=np.int16)
+        words[:first_part] = self.ring[start:start + first_part]
+        words[first_part:] = self.ring[:length - first_part]
+        return words
+
+    def close(self):
+        """ Detach from the shared memory, and free it if this process made it """
+        del self.header, self.clock, self.ring
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
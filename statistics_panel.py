@@ -0,0 +1,48 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Table of the running statistics of each channel, updated by the data class every time the plot is """
+# standard libraries
+import tkinter as tk
+
+__author__ = 'Kyle Vitautas Lopin'
+
+# statistics to show, the heading of their column and how to format them
+COLUMNS = [('mean', 'Mean (mV)', '{0:.2f}'), ('rms', 'RMS (mV)', '{0:.2f}'), ('std', 'Std (mV)', '{0:.2f}'),
+           ('min', 'Min (mV)', '{0:.1f}'), ('max', 'Max (mV)', '{0:.1f}'), ('drift', 'Drift (mV/min)', '{0:+.2f}')]
+
+
+class StatisticsPanel(tk.Frame):
+    def __init__(self, master):
+        tk.Frame.__init__(self, master)
+        for column, (_, heading, _) in enumerate(COLUMNS):
+            tk.Label(self, text=heading, width=13).grid(row=0, column=column + 1)
+        self.rows = []  # list of the labels of each channel
+
+    def update_statistics(self, statistics):
+        """ Show new statistics, there is a row for each channel
+        :param statistics: dict from running_stats.RunningStatistics.statistics, or None to clear the table
+        """
+        if statistics is None:
+            for row in self.rows:
+                for label in row:
+                    label.config(text='')
+            return
+        number_channels = len(statistics['mean'])
+        if len(self.rows) != number_channels:
+            self.make_rows(number_channels)
+        for channel, row in enumerate(self.rows):
+            for label, (name, _, _format) in zip(row[1:], COLUMNS):
+                label.config(text=_format.format(statistics[name][channel]))
+
+    def make_rows(self, number_channels):
+        for row in self.rows:
+            for label in row:
+                label.destroy()
+        self.rows = []
+        for channel in range(number_channels):
+            row = [tk.Label(self, text='channel %d' % (channel + 1))]
+            row.extend(tk.Label(self, width=13) for _ in COLUMNS)
+            for column, label in enumerate(row):
+                label.grid(row=channel + 1, column=column)
+            self.rows.append(row)
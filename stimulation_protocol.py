@@ -0,0 +1,170 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Give a protocol of stimulations (trains of pulses with a set interval, current ramps and channel rotations) at
+set times, from a thread of its own instead of the tk event loop.
+
+The ProtocolScheduler thread sends the 's|...' settings of the next pulse right after the last 'G', so the device
+is ready long before the pulse is due, and then waits for the pulse time on the time.perf_counter clock.  It sleeps
+until spin_time before the pulse and checks the clock in a loop for the rest, so the 'G' is started when it is due
+and not when the operating system wakes the thread.  The 'G' is written from this thread ahead of the messages
+waiting in the command writer (see CommandWriter.write_now), so it only waits for a write already in progress, and
+the time is taken when the write is done.  The thread asks for a higher scheduling priority, which is only given if
+the program is allowed to have it, and python is set to switch threads more often while the protocol runs so the
+thread does not wait long for the GIL.
+
+Each 'G' is stamped with the raw sample it was given at from the acquisition side (see PlantUSB.stimulus_sample).
+The jitter is reported against both clocks: the time each 'G' write finished minus when it was due, and the time
+between the stamped samples minus the time between when the pulses were due.
+"""
+# standard libraries
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+# installed libraries
+import numpy as np
+# local files
+import data_class
+
+__author__ = 'Kyle Vitautas Lopin'
+
+START_DELAY = 0.2  # s, from starting the scheduler to the first pulse, to send the first settings
+SPIN_TIME = 0.002  # s, before each pulse that the thread checks the clock in a loop instead of sleeping
+THREAD_NICENESS = -10  # niceness to ask for, lower runs first
+SWITCH_INTERVAL = 0.0005  # s, how often python switches threads while a protocol runs, the default is 0.005
+MAX_CURRENT = 255
+
+# time: s from the start of the protocol, current: 1-255, duration: ms, channel: 1-3, polarity: 'Source' or 'Sink'
+Stimulus = collections.namedtuple('Stimulus', ['time', 'current', 'duration', 'channel', 'polarity'])
+
+
+def make_protocol(current, duration, pulses=1, pulse_interval=1.0, trains=1, train_interval=10.0, current_step=0,
+                  channels=(1,), polarity='Source'):
+    """ Make the stimuli of a protocol of trains of pulses
+    :param current: int, 1-255, current of the first train
+    :param duration: int, ms, time of each pulse
+    :param pulses: int, pulses in each train
+    :param pulse_interval: float, s, from the start of a pulse to the start of the next one in a train
+    :param trains: int, number of trains
+    :param train_interval: float, s, from the start of a train to the start of the next one
+    :param current_step: int, current added for each train after the first, for a current ramp
+    :param channels: list of int, channels to rotate through, the next one is used for each pulse
+    :param polarity: 'Source' or 'Sink'
+    :return: list of Stimulus in the order they are given
+    """
+    if pulses > 1 and pulse_interval * 1000 <= duration:
+        raise ValueError("The pulses of a train overlap, the interval has to be longer than the pulse time")
+    if trains > 1 and train_interval <= (pulses - 1) * pulse_interval + duration / 1000.:
+        raise ValueError("The trains overlap, the train interval has to be longer than a train")
+    protocol = []
+    for train in range(trains):
+        train_current = int(min(max(current + train * current_step, 1), MAX_CURRENT))
+        for pulse in range(pulses):
+            channel = channels[len(protocol) % len(channels)]
+            protocol.append(Stimulus(train * train_interval + pulse * pulse_interval, train_current, duration,
+                                     channel, polarity))
+    return protocol
+
+
+class ProtocolScheduler(threading.Thread):
+    """ Thread that gives the stimuli of a protocol at their times and measures how close to them it was """
+
+    def __init__(self, device, protocol, start_delay=START_DELAY, spin_time=SPIN_TIME):
+        """
+        :param device: usb_comm.PlantUSB to give the stimuli with
+        :param protocol: list of Stimulus, in time order
+        :param start_delay: float, s from starting the thread to the start of the protocol
+        :param spin_time: float, s before each pulse to check the clock in a loop
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.device = device
+        self.protocol = protocol
+        self.start_delay = start_delay
+        self.spin_time = spin_time
+        self.stop_event = threading.Event()
+        self.due_times = np.full(len(protocol), np.nan)  # s, perf_counter time each pulse was due
+        self.fire_times = np.full(len(protocol), np.nan)  # s, perf_counter time each 'G' write finished
+        self.samples = np.full(len(protocol), -1, dtype=np.int64)  # raw sample each pulse was stamped with
+        self.pulses_given = 0
+        self.priority_raised = False
+
+    def stop_running(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.raise_priority()
+        # the thread needs the GIL to write the 'G', so let the other threads hold it for less time
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(SWITCH_INTERVAL, switch_interval))
+        try:
+            self.give_protocol()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        logging.info('stimulation protocol stats: {0}'.format(self.stats()))
+
+    def give_protocol(self):
+        start_time = time.perf_counter() + self.start_delay
+        settings = None
+        for i, stimulus in enumerate(self.protocol):
+            if settings != stimulus[1:]:  # preload the settings of this pulse as soon as the last one is given
+                settings = stimulus[1:]
+                self.device.set_stimulator(stimulus.duration, stimulus.current, stimulus.channel, stimulus.polarity)
+            due_time = start_time + stimulus.time
+            if not self.wait_until(due_time):
+                break
+            fire_time, sample = self.device.give_stimulation()
+            self.due_times[i] = due_time
+            self.fire_times[i] = fire_time
+            if sample is not None:
+                self.samples[i] = sample
+            self.pulses_given += 1
+
+    def wait_until(self, due_time):
+        """ Sleep until spin_time before due_time, then check the clock in a loop until it is due
+        :param due_time: float, time.perf_counter() to wait for
+        :return: False if the scheduler was stopped while waiting
+        """
+        sleep_time = due_time - self.spin_time - time.perf_counter()
+        if sleep_time > 0 and self.stop_event.wait(sleep_time):
+            return False
+        while time.perf_counter() < due_time:
+            pass
+        return not self.stop_event.is_set()
+
+    def raise_priority(self):
+        """ Ask the operating system to run this thread before the others, on linux the niceness of a thread can be
+        set by its thread id.  Lowering the niceness needs permission, without it the thread keeps its priority """
+        if not (hasattr(os, 'setpriority') and hasattr(threading, 'get_native_id')):
+            return
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), THREAD_NICENESS)
+            self.priority_raised = True
+        except OSError as error:
+            logging.debug('stimulation thread priority not raised: {0}'.format(error))
+
+    def stats(self):
+        """ Get how close to their times the pulses were given
+        :return: dict of the pulses given, the mean, standard deviation and largest (absolute) time from when each
+        'G' was due to when its write finished, and the standard deviation and largest error of the time between the
+        stamped samples against the time between when they were due, in ms.  The sample clock errors are nan if
+        the pulses were not stamped
+        """
+        given = slice(0, self.pulses_given)
+        timer_errors = 1000 * (self.fire_times[given] - self.due_times[given])
+        samples = self.samples[given]
+        stamped = samples >= 0
+        sample_errors = np.array([np.nan])
+        if np.count_nonzero(stamped) > 1:
+            due_times = self.due_times[given][stamped]
+            sample_errors = 1000 * ((samples[stamped] - samples[stamped][0]) / data_class.SAMPLE_RATE -
+                                    (due_times - due_times[0]))
+        return {'pulses': self.pulses_given,
+                'priority raised': self.priority_raised,
+                'timer mean': float(np.mean(timer_errors)) if self.pulses_given else np.nan,
+                'timer std': float(np.std(timer_errors)) if self.pulses_given else np.nan,
+                'timer max': float(np.max(np.abs(timer_errors))) if self.pulses_given else np.nan,
+                'sample clock std': float(np.std(sample_errors)),
+                'sample clock max': float(np.max(np.abs(sample_errors)))}
@@ -2,6 +2,7 @@
 import tkinter as tk
 
 # local files
+import stimulation_protocol
 import usb_comm
 
 __author__ = 'Kyle Vitautas Lopin'
@@ -59,6 +60,30 @@ class Stimulator(tk.Toplevel):
         self.time.set(1000)
         self.polarity.set('Source')
 
+        self.scheduler = None  # type: stimulation_protocol.ProtocolScheduler
+        self.progress_loop = None  # after id of the next show_protocol_progress call
+        self.pulses = tk.IntVar(value=1)
+        self.pulse_interval = tk.DoubleVar(value=2.0)
+        self.trains = tk.IntVar(value=1)
+        self.train_interval = tk.DoubleVar(value=10.0)
+        self.current_step = tk.IntVar(value=0)
+        self.rotate_channels = tk.BooleanVar()
+        protocol_frame = tk.LabelFrame(self, text="Protocol")
+        protocol_frame.grid(row=11, column=0, columnspan=3, pady=10)
+        for row, (text, variable, unit) in enumerate([("Pulses per train", self.pulses, ""),
+                                                      ("Pulse interval", self.pulse_interval, "seconds"),
+                                                      ("Trains", self.trains, ""),
+                                                      ("Train interval", self.train_interval, "seconds"),
+                                                      ("Current step per train", self.current_step, "microamperes")]):
+            tk.Label(protocol_frame, text=text).grid(row=row, column=0)
+            tk.Entry(protocol_frame, textvariable=variable, width=8).grid(row=row, column=1)
+            tk.Label(protocol_frame, text=unit).grid(row=row, column=2)
+        tk.Checkbutton(protocol_frame, text="Rotate channels 1-3", variable=self.rotate_channels).grid(row=5, column=1)
+        self.protocol_button = tk.Button(protocol_frame, text="Run Protocol", command=self.run_protocol)
+        self.protocol_button.grid(row=6, column=1)
+        self.protocol_label = tk.Label(protocol_frame, text="")
+        self.protocol_label.grid(row=7, column=0, columnspan=3)
+
     def variable_changed(self, *args):
         if self.run_button:
             self.prepared = False
@@ -75,6 +100,50 @@ class Stimulator(tk.Toplevel):
     def stimulate(self):
         self.device.give_stimulation()
 
+    def run_protocol(self):
+        """ Give the protocol from a ProtocolScheduler thread, it uses the current, time and polarity above """
+        try:
+            protocol = stimulation_protocol.make_protocol(
+                self.current.get(), self.time.get(), pulses=self.pulses.get(),
+                pulse_interval=self.pulse_interval.get(), trains=self.trains.get(),
+                train_interval=self.train_interval.get(), current_step=self.current_step.get(),
+                channels=(1, 2, 3) if self.rotate_channels.get() else (self.channel.get(),),
+                polarity=self.polarity.get())
+        except (ValueError, tk.TclError) as error:
+            self.protocol_label.config(text=str(error))
+            return
+        self.scheduler = stimulation_protocol.ProtocolScheduler(self.device, protocol)
+        self.scheduler.start()
+        self.prepared = False  # the protocol changes the stimulator settings
+        self.run_button.config(text="Prepare Stimulator", command=self.prepare)
+        self.protocol_button.config(text="Stop Protocol", command=self.stop_protocol)
+        self.show_protocol_progress()
+
+    def stop_protocol(self):
+        if self.scheduler:
+            self.scheduler.stop_running()
+
+    def show_protocol_progress(self):
+        """ Show how many pulses have been given until the protocol is done, then show the jitter """
+        if self.scheduler.is_alive():
+            self.protocol_label.config(text="{0} of {1} pulses given".format(self.scheduler.pulses_given,
+                                                                              len(self.scheduler.protocol)))
+            self.progress_loop = self.after(100, self.show_protocol_progress)
+            return
+        self.progress_loop = None
+        stats = self.scheduler.stats()
+        self.protocol_label.config(text="{0} pulses, timer jitter {1:.3f} ms (max {2:.3f} ms), sample clock jitter "
+                                        "{3:.1f} ms".format(stats['pulses'], stats['timer std'], stats['timer max'],
+                                                            stats['sample clock std']))
+        self.protocol_button.config(text="Run Protocol", command=self.run_protocol)
+
+    def destroy(self):
+        if self.progress_loop:
+            self.after_cancel(self.progress_loop)
+            self.progress_loop = None
+        self.stop_protocol()
+        tk.Toplevel.destroy(self)
+
 
 def update_entries(entry):
     entry.set(entry.get())
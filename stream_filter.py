@@ -0,0 +1,114 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Filter the adc counts as they are read, one adc buffer at a time, to take out the mains pickup and the drift
+of the electrodes without a second pass over the recording.
+
+The filter is a cascade of second order sections (a notch at the mains frequency and a butterworth band-pass)
+run with scipy.signal.sosfilt.  The state of each section for each channel is kept between adc buffers so the
+output is the same as filtering the whole recording at once.  The state starts as the steady state for the first
+frame of each channel held from the start of time (scipy.signal.sosfilt_zi), so the high-pass does not ring from
+the channel's offset after every start.  The output is rounded back to int16 adc counts, so it can go anywhere the
+raw adc counts do.  settings describes the filter, to record with the filtered data.
+"""
+# installed libraries
+import numpy as np
+try:
+    from scipy import signal
+except ImportError:
+    signal = None
+
+__author__ = 'Kyle Vitautas Lopin'
+
+MAINS_FREQUENCY = 50.0  # Hz
+NOTCH_QUALITY = 30.0  # mains frequency / bandwidth of the notch
+BAND_PASS = (0.1, 200.0)  # Hz, keeps the plant signals and the display does not alias at 500 Hz
+BAND_PASS_ORDER = 2  # order of the butterworth high and low pass filters
+
+
+def make_sos(sample_rate, notch_frequency=MAINS_FREQUENCY, notch_quality=NOTCH_QUALITY, band=BAND_PASS,
+             order=BAND_PASS_ORDER):
+    """ Make the second order sections of a notch and band-pass filter
+    :param sample_rate: float, Hz
+    :param notch_frequency: float, Hz, frequency to take out, None for no notch
+    :param notch_quality: float, notch frequency / bandwidth of the notch
+    :param band: (low, high) Hz to pass, either can be None for only a high or low pass, None for no band-pass
+    :param order: int, order of the butterworth band-pass
+    :return: numpy array (sections, 6) of second order sections
+    """
+    if signal is None:
+        raise ImportError("scipy is needed to filter the data")
+    sections = []
+    if notch_frequency:
+        b, a = signal.iirnotch(notch_frequency, notch_quality, fs=sample_rate)
+        sections.append(signal.tf2sos(b, a))
+    if band:
+        low, high = band
+        if low and high:
+            sections.append(signal.butter(order, [low, high], btype='bandpass', fs=sample_rate, output='sos'))
+        elif low:
+            sections.append(signal.butter(order, low, btype='highpass', fs=sample_rate, output='sos'))
+        elif high:
+            sections.append(signal.butter(order, high, btype='lowpass', fs=sample_rate, output='sos'))
+    if not sections:
+        raise ValueError("The filter needs a notch or a band to pass")
+    return np.concatenate(sections)
+
+
+class StreamingFilter(object):
+    """ Second order section filter of interleaved adc counts that keeps its state between adc buffers """
+
+    def __init__(self, number_channels, sample_rate, sos=None, **filter_settings):
+        """
+        :param number_channels: int, number of channels interleaved in the adc counts
+        :param sample_rate: float, Hz, samples per second of each channel
+        :param sos: numpy array (sections, 6) of second order sections, if None they are made with make_sos
+        :param filter_settings: keyword arguments passed to make_sos
+        """
+        if signal is None:
+            raise ImportError("scipy is needed to filter the data")
+        self.number_channels = number_channels
+        self.sample_rate = sample_rate
+        if sos is not None:
+            self.sos = np.asarray(sos)
+            self.settings = {'custom': True, 'second order sections': self.sos.tolist()}
+        else:
+            self.sos = make_sos(sample_rate, **filter_settings)
+            band = filter_settings.get('band', BAND_PASS)
+            self.settings = {'notch frequency': filter_settings.get('notch_frequency', MAINS_FREQUENCY),
+                             'notch quality': filter_settings.get('notch_quality', NOTCH_QUALITY),
+                             'band': list(band) if band else None,
+                             'order': filter_settings.get('order', BAND_PASS_ORDER)}
+        self.state = None  # numpy array (sections, 2, channels), None until the first frame is filtered
+        self.partial_frame = None
+        self.reset()
+
+    def reset(self, number_channels=None):
+        """ Start the filter over, call when a new data stream is started
+        :param number_channels: int, number of channels in the new data stream, None if it is the same
+        """
+        if number_channels:
+            self.number_channels = number_channels
+        self.state = None
+        self.partial_frame = np.empty(0, dtype=np.int16)  # adc counts of a frame split between 2 adc buffers
+
+    def process(self, adc_counts):
+        """ Filter an adc buffer
+        :param adc_counts: array of int16 adc counts, interleaved by channel
+        :return: numpy array of int16 filtered adc counts, interleaved by channel, a frame split between adc buffers
+        is given with the next one
+        """
+        adc_counts = np.asarray(adc_counts, dtype=np.int16)
+        if self.partial_frame.size:
+            adc_counts = np.concatenate((self.partial_frame, adc_counts))
+        whole_frames = len(adc_counts) // self.number_channels
+        self.partial_frame = adc_counts[whole_frames * self.number_channels:].copy()
+        frames = adc_counts[:whole_frames * self.number_channels].reshape(whole_frames, self.number_channels)
+        if self.state is None:
+            if not whole_frames:
+                return np.empty(0, dtype=np.int16)
+            self.state = signal.sosfilt_zi(self.sos)[:, :, np.newaxis] * frames[0]
+        filtered, self.state = signal.sosfilt(self.sos, frames, axis=0, zi=self.state)
+        np.rint(filtered, out=filtered)
+        np.clip(filtered, np.iinfo(np.int16).min, np.iinfo(np.int16).max, out=filtered)
+        return filtered.astype(np.int16).ravel()
@@ -5,29 +5,32 @@
 """
 # standard libraries
 import array
-import ctypes
 import logging
+import multiprocessing
 import os
 import queue
-import shelve
 import threading
 import time
 
 # installed libraries
+import numpy as np
 import usb.core
 import usb.util
 import usb.backend
-# import usb_mock as usb
 
 # local files
+import calibration
+import clock_sync
+import command_writer
+import data_class
+import display_scheduler
+import shared_ring_buffer
+from shared_ring_buffer import RING_BUFFER_SIZE
 from usb_constants import *
 
 __author__ = 'Kyle V. Lopin'
 
 
-REFRESH_DELAY = 200  # type: int    mseconds to delay updating plot after it has been updated, give some time to the other threads
-
-
 class PlantUSB(object):
     """ Class to communicate with a device that can measure a number of different input signals, receives the raw
     adc counts from the device and converts the adc counts to the voltage measured.   Supports a calibration routine
@@ -43,43 +46,61 @@ class PlantUSB(object):
     Constants used in this are found in usb_constants.py
     """
 
-    def __init__(self, master, vendor_id=0x04B4, product_id=0x8051):
+    def __init__(self, master, vendor_id=0x04B4, product_id=0x8051, usb_backend=usb, usb_device=None):
         """ Bind objects, initialize other threads to be used and check if the device has been calibrated recently
-        :param master: root tk.Tk()
+        :param master: root tk.Tk(), None if the data is not processed in this process (see run_acquisition_process)
         :param vendor_id: hexadecimal of USB's vendor id
         :param product_id: hexadecimal of USB's product id
+        :param usb_backend: module used to find the device, the pyusb module or a usb_mock.SimulatedUSBBackend
+        :param usb_device: device from find_devices to use, None to use the first one found
         """
         self.channel_tracker = 0
+        self.usb_backend = usb_backend
         self.master = master  # type: tk.Tk
-        self.data = master.data  # type: data_class.StreamingData
+        self.data = master.data if master else None  # type: data_class.StreamingData
         self.connected = False  # type: bool
         self.found = False
-        self._device = self.connect_usb(vendor_id, product_id)  # Type: pyUSB device
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self._device = self.connect_usb(vendor_id, product_id, usb_device)  # Type: pyUSB device
         self.data_queue = queue.Queue()  # This will store all the raw adc counts of an adc channel, i.e. as many data
         # points as is stored in DC_CHANNEL_DATA_SIZE
+        # the data queue, or the shared ring buffer when acquisition_mode = 'process'
+        self.data_source = self.data_queue
         self.packet_ready_event = threading.Event()
+        self.display_scheduler = display_scheduler.DisplayScheduler()  # sets when the display is updated
         # Placeholder for now, make a new thread everytime a data stream is started
         self.threaded_data_stream = None  # type: threading.thread
-
+        # 'pipelined' uses ThreadedUSBAcquisition, 'threaded' uses ThreadedUSBDataCollector and ThreadedUSBInfo,
+        # 'process' uses ProcessUSBAcquisition
+        self.acquisition_mode = 'pipelined'  # type: str
+        # time stamps the adc buffers against the host clock as they are read, not in the 'process' acquisition mode
+        self.clock_sync = clock_sync.ClockSync(1, data_class.SAMPLE_RATE)
+
+        self.calibration = None  # type: calibration.StreamingCalibration  while the device is being calibrated
+        self.command_writer = None  # type: command_writer.CommandWriter  writes the messages once it is connected
         # check if a usb settings file exists
-        with shelve.open('usb_settings.db') as settings:
-            if settings:
-                self.gain = settings['gain']
-                self.zero_level = settings['zero level']
-                settings.close()
-            else:
-                self.gain = 1.0
-                self.zero_level = 0
+        settings = calibration.load_settings()
+        if settings:
+            self.gain = settings['gain']
+            self.zero_level = settings['zero level']
+        else:
+            self.gain = 1.0
+            self.zero_level = 0
         self.number_channels = 1
         self.counts_to_volts = float(MAX_ADC_VOLTAGE) / MAX_ADC_COUNTS / self.gain  # TODO: is this needed or just pass it to data
         logging.info('starting voltage to count: {0}'.format(self.counts_to_volts))
         # TODO:  delete below to get correct number and fix this part over all
-        self.data.set_count_to_volts(self.counts_to_volts, self.zero_level)
+        if self.data:
+            self.data.set_count_to_volts(self.counts_to_volts, self.zero_level)
 
         if self._device:  # the device has been found, make sure it response to information requests properly
             self.connected = self.connection_test()
+        if self.connected:
+            self.command_writer = command_writer.CommandWriter(self.write_now)
+            self.command_writer.start()
 
-    def connect_usb(self, _vendor_id=0x04B4, _product_id=0xE177):
+    def connect_usb(self, _vendor_id=0x04B4, _product_id=0xE177, device=None):
         """ Use the pyUSB module to find and set the configuration of a USB device
 
         This method uses the pyUSB module, see the tutorial example at:
@@ -89,9 +110,11 @@ class PlantUSB(object):
         :param _vendor_id:  the USB vendor id, used to identify the proper device connected to
         sthe computer
         :param _product_id: the USB product id
+        :param device: USB device already found to connect to, None to find the first one
         :return: USB device that can use the pyUSB API if found, else returns None if not found
         """
-        device = usb.core.find(idVendor=_vendor_id, idProduct=_product_id)
+        if device is None:
+            device = self.usb_backend.core.find(idVendor=_vendor_id, idProduct=_product_id)
         # if no device is found, print a warning to the output
         if device is None:
             logging.info("Device not found")
@@ -125,7 +148,7 @@ class PlantUSB(object):
             return False
 
     def usb_write(self, message, endpoint=OUT_ENDPOINT):
-        """ Write a message to the device
+        """ Write a message to the device, it is put in the command writer's queue if it is running
         :param message: message, in bytes, to send
         :param endpoint: which OUT_ENDPOINT to use to send the message in the case there are more
         than 1 OUT_ENDPOINTS
@@ -135,13 +158,26 @@ class PlantUSB(object):
             logging.info("Device not connected")
         elif len(message) > 32:
             logging.error("Message is too long")
+        elif isinstance(self.threaded_data_stream, ProcessUSBAcquisition) and self.threaded_data_stream.is_alive():
+            # the acquisition process owns the device while it runs
+            self.threaded_data_stream.write(message)
+        elif self.command_writer and self.command_writer.is_alive():
+            self.command_writer.put(message, endpoint)
         else:
-            logging.debug("writing message: %s", message)
-            try:
-                self._device.write(endpoint, message)
-            except Exception as error:
-                logging.error("No OUT ENDPOINT: %s", error)
-                self.connected = False
+            self.write_now(message, endpoint)
+
+    def write_now(self, message, endpoint=OUT_ENDPOINT):
+        """ Write a message to the device from this thread, only the command writer should call this once it is
+        running
+        :param message: str to send
+        :param endpoint: OUT endpoint to write to
+        """
+        logging.debug("writing message: %s", message)
+        try:
+            self._device.write(endpoint, message)
+        except Exception as error:
+            logging.error("No OUT ENDPOINT: %s", error)
+            self.connected = False
 
     def usb_read_info(self, endpoint=INFO_IN_ENDPOINT, num_usb_bytes=USB_INFO_BYTES_SIZE):
         """ Read the information endpoint of the device and return it as a string if the device responded, else
@@ -178,49 +214,67 @@ class PlantUSB(object):
         elif encoding == "signed int16":
             return convert_uint8_to_signed_int16(usb_input)
         elif encoding == 'string':
-            return usb_input.tostring()  # remove the 0x00 end of string
+            return usb_input.tobytes()  # remove the 0x00 end of string
         else:  # no encoding so just return raw data
             return usb_input
 
+    def usb_read_into(self, usb_buffer, endpoint=DATA_STREAM_ENDPOINT):
+        """ Read as many bytes as the device sends, up to the size of usb_buffer, in one bulk transfer into
+        usb_buffer.  If the read fails, log the miss and return None
+        :param usb_buffer: array.array('B') to put the bytes read into, it is reused between reads
+        :param endpoint: hexidecimal of endpoint to read, has to be formatted as 0x8n where
+        n is the hex of the encpoint number
+        :return: int of the number of bytes read
+        """
+        if not self.connected:
+            logging.info("not working")
+            return None
+        try:
+            return self._device.read(endpoint, usb_buffer)
+        except Exception as error:
+            logging.error("Failed bulk data read")
+            logging.error("No IN ENDPOINT: %s", error)
+            return None
+
     def start_reading(self):
         """ Read a stream of data in a seperate thread.  Clears any previeous data queues, send the start message to 
         the device, start data reading thread and start data processing loop
         """
         while self.data_queue.qsize():  # clear the data queue of any previously added data
             _ = self.data_queue.get(0)
-        # moved
-        # self.threaded_data_stream = ThreadedUSBDataCollector(self, self.data_queue)
-        self.usb_write('R')  # signal for the device to start
-        self.threaded_data_stream = ThreadedUSBDataCollector(self, self.number_channels,
-                                                             self.data_queue,
-                                                             self.packet_ready_event)
+        self.display_scheduler.reset()
+        self.data_source = self.data_queue
+        self.clock_sync.reset(self.number_channels)
+        if self.acquisition_mode == 'process':
+            self.threaded_data_stream = ProcessUSBAcquisition(self)
+            self.data_source = self.threaded_data_stream.ring_buffer
+        elif self.acquisition_mode == 'pipelined':
+            self.threaded_data_stream = ThreadedUSBAcquisition(self, self.data_queue, self.packet_ready_event)
+        else:
+            self.threaded_data_stream = ThreadedUSBDataCollector(self, self.number_channels,
+                                                                 self.data_queue,
+                                                                 self.packet_ready_event)
         self.threaded_data_stream.start()  # thread to handle the I/O
+        self.usb_write('R')  # signal for the device to start
         print("Start reading4")
         self.process_data_stream()  # reads data from data_queue and
         print("Start reading5")
 
     def process_data_stream(self):
-        """ Wait for the data azquisition thread the laod a packet, then load it into the data class and recall this
-        method
+        """ Move the adc buffers the data acquisition thread has loaded into the data class, update the display and
+        recall this method.  This never waits for the data acquisition thread, display_scheduler limits how long
+        the data queue is drained and sets how long until this is called again
         """
-        # print('data queu size = {0}'.format(self.data_queue.qsize()))
-        data_added = False
-        # wait for the data acquisition thread to signal an adc channel has been loaded
-        self.packet_ready_event.wait()
         self.packet_ready_event.clear()
-        while self.data_queue.qsize():
-            try:
-                self.data.extend(self.data_queue.get(0))
-                data_added = True
-                # print('data in queu: {0}'.format(data))
-                # voltage = self.convert_data(data)
-                # logging.debug('data: {0}'.format(data))
-
-            except queue.Empty:
-                pass  # should not happen
-        if data_added:
+        buffers_added = self.display_scheduler.drain(self.data_source, self.data.extend)
+        if self.display_scheduler.should_render(buffers_added):
+            render_start = time.perf_counter()
             self.data.display_data()
-        self.display_loop = self.master.after(200, self.process_data_stream)
+            self.display_scheduler.add_render_time(time.perf_counter() - render_start)
+        if self.calibration and self.calibration.finished:
+            self.calibrate_finish()
+            return
+        self.display_loop = self.master.after(self.display_scheduler.next_delay(), self.process_data_stream)
 
     # def convert_data(self, adc_counts):
     #     # logging.debug('processing data: {0}'.format(adc_counts))
@@ -232,6 +286,15 @@ class PlantUSB(object):
             self.threaded_data_stream.stop_running()
             # empty the data queue
             self.master.after_cancel(self.display_loop)
+            logging.info('display stats: {0}'.format(self.display_scheduler.stats()))
+            if isinstance(self.threaded_data_stream, ProcessUSBAcquisition):
+                # get the last of the data from the acquisition process and free the shared memory
+                self.threaded_data_stream.join(timeout=2)
+                logging.info('acquisition process stats: {0}'.format(self.threaded_data_stream.stats()))
+                while not self.data_source.empty():
+                    self.display_scheduler.drain(self.data_source, self.data.extend)
+                self.threaded_data_stream.close()
+                self.data_source = self.data_queue
 
     def clear_in_buffer(self):
         pass
@@ -239,6 +302,7 @@ class PlantUSB(object):
     def set_number_channels(self, num_channels: int):
         logging.debug('setting channels to: {0}'.format(num_channels))
         self.number_channels = num_channels
+        self.clock_sync.reset(num_channels)
         self.usb_write('S{0}'.format(num_channels))
         self.data.set_number_channels(num_channels)
 
@@ -257,70 +321,100 @@ class PlantUSB(object):
         :param polarity:
         :return:
         """
-        time_str = str(time).zfill(5)
-        current_str = str(current).zfill(3)
-        channel_str = str(channel)
-        if polarity == 'Sink':
-            polarity_str = 'n'
-        elif polarity == "Source":
-            polarity_str = 'p'
-        else:
-            raise Exception("wrong polarity entry")
-        usb_str = "s|{0}|{1}|{2}|{3}".format(current_str, time_str, polarity_str, channel_str)
-        self.usb_write(usb_str)
+        self.usb_write(stimulator_message(time, current, channel, polarity))
 
     def give_stimulation(self):
-        self.usb_write('G')
+        """ Give a stimulation now and stamp it with the raw sample it was given at (see stimulus_sample) in the
+        data class.  The 'G' is written from this thread ahead of the messages waiting in the command writer, so it
+        only waits for a write already in progress.  When the acquisition process owns the device the 'G' is passed
+        to it and the time it was passed on is used
+        :return: float, time.perf_counter() the 'G' was written, and int, raw sample of the stimulation, None if
+        there is no data class
+        """
+        if not self.connected:
+            logging.info("Device not connected")
+        process_running = (isinstance(self.threaded_data_stream, ProcessUSBAcquisition) and
+                           self.threaded_data_stream.is_alive())
+        if self.connected and not process_running and self.command_writer and self.command_writer.is_alive():
+            stimulus_time = self.command_writer.write_now('G')
+        else:
+            self.usb_write('G')
+            stimulus_time = time.perf_counter()
+        sample = self.data.mark_stimulus(self.stimulus_sample(stimulus_time)) if self.data else None
+        return stimulus_time, sample
+
+    def stimulus_sample(self, stimulus_time):
+        """ Get the raw sample the device took at a time, from the acquisition side so it does not depend on when
+        the adc buffers reach the data class.  clock_sync has the fit of the host time each sample was taken at from
+        the adc buffers the acquisition thread has read.  In the 'process' acquisition mode the fit is the one the
+        acquisition process shares through the ring buffer
+        :param stimulus_time: float, time.perf_counter() of the stimulation
+        :return: int, raw sample from the start of the data stream
+        """
+        clock = self.clock_sync
+        stream = self.threaded_data_stream
+        if isinstance(stream, ProcessUSBAcquisition) and stream.is_alive():
+            clock = stream.sync_clock()
+        if not clock.buffers:
+            return 0  # no adc buffer has been read yet
+        return max(int(round(clock.sample_at(stimulus_time))), 0)
 
     def calibrate(self):
-        # get 3 seconds of data
+        """ Start reading with the calibration signal on, the raw adc counts are given to a StreamingCalibration
+        and the reading is stopped as soon as it has an estimate of the levels, see calibration.py """
         self.data.clear()
+        self.calibration = calibration.StreamingCalibration(self.number_channels, data_class.SAMPLE_RATE)
+        self.data.set_calibration(self.calibration)
         self.start_reading()
-        self.after(4000, self._device.stop_reading)
-        self.after(4100, self.calibrate_finish)
-        self._device.send_message('C')
+        self.usb_write('C')
 
     def calibrate_finish(self):
+        self.stop_reading()
+        self.data.set_calibration(None)
+        self.process_calibration(self.calibration.result())
+        self.calibration = None
         self.master.calibrate_finish()  # will reenable the buttons
-        self.process_calibration_data(self.data)
-
-    def process_calibration_data(self, data):
-        # dump the first 500 msec of data to let the calibration cycle start
-        # and the amplifiers to settle
-        voltage_data = data.get_voltage_data()[5000:]
-        mean_voltage = sum(voltage_data) / len(voltage_data)
-        upper_level = [i for i in voltage_data if i > mean_voltage]
-        lower_level = [i for i in voltage_data if i < mean_voltage]
-        upper_level_mean = sum(upper_level) / len(upper_level)
-        lower_level_mean = sum(lower_level) / len(lower_level)
-        print('upper level mean = ', upper_level_mean)
-        print('lower level mean = ', lower_level_mean)
-
-        self.counts_to_volts /= (upper_level_mean - lower_level_mean) / \
-                                CALIBRATION_RANGE  # counts per mV change in signal
-        voltage_difference = upper_level_mean - lower_level_mean
 
+    def process_calibration(self, result):
+        """ Set and save the gain and zero level from the levels of the calibration square wave
+        :param result: dict from calibration.StreamingCalibration.result
+        """
+        logging.info('calibration: {0}'.format(result))
+        if not result['converged']:
+            logging.error('Calibration failed, no steady square wave was found in {0:.1f} s, check calibration '
+                          'again'.format(result['time']))
+            return
+        voltage_difference = result['step'] * self.counts_to_volts  # with the gain before this calibration
         if CALIBRATION_RANGE - 0.5 < voltage_difference < CALIBRATION_RANGE + 0.5:
-            print('Passed Calibration')
+            logging.info('Passed Calibration')
         else:
-            print('======================= CALIBRATION FAIL ==============================')
-            print('Check calibration again')
-        print('gain = ', self.counts_to_volts)
-
-        self.zero_level -= lower_level_mean
-        settings = shelve.open('usb_settings.db')
-        settings['gain'] = self.counts_to_volts
-        settings['zero level'] = self.zero_level
+            logging.warning('Calibration changed the step from {0:.2f} mV to {1} mV'.format(voltage_difference,
+                                                                                       CALIBRATION_RANGE))
+        self.zero_level -= result['lower'] * self.counts_to_volts
+        self.counts_to_volts = CALIBRATION_RANGE / result['step']  # mV per adc count
+        self.gain = float(MAX_ADC_VOLTAGE) / MAX_ADC_COUNTS / self.counts_to_volts
+        logging.info('gain = {0}'.format(self.gain))
+        try:
+            calibration.save_settings({'gain': self.gain, 'zero level': self.zero_level})
+        except OSError as error:
+            logging.error("Could not save the calibration: {0}".format(error))
         self.data.set_count_to_volts(self.counts_to_volts, self.zero_level)
 
 
 class ThreadedUSBDataCollector(threading.Thread):
     """ Seperate thread to collect the adc channel packets from the device.  This starts another thread that 
     handles the timing of when to get what adc channel.
+
+    The time each 'Done#' was read is passed on with the adc buffer to the device's clock_sync as the host time the
+    last sample of the buffer was taken.
+
+    An adc buffer is read in one bulk transfer (read_mode='bulk') or one usb packet at a time
+    (read_mode='packet').  If a bulk read fails that adc buffer is read by packet, and after
+    BULK_FAILURES_BEFORE_PACKETS bulk reads fail in a row the thread only reads packets.
     """
 
     def __init__(self, device, number_adc_channels: int,
-                 data_queue: queue.Queue, data_event: threading.Event):
+                 data_queue: queue.Queue, data_event: threading.Event, read_mode='bulk'):
         self.channel_tracker = 0
         self.read_count = 0  # for debug
         threading.Thread.__init__(self)
@@ -333,6 +427,10 @@ class ThreadedUSBDataCollector(threading.Thread):
         self.adc_channel_ready_event = threading.Event()  # event to signal an adc channel is ready to export its data
         self.running = True
         self.termination_flag = False
+        self.read_mode = read_mode  # type: str  'bulk' or 'packet'
+        self.bulk_failures = 0  # bulk reads that failed in a row
+        self.done_time = None  # time.perf_counter() the 'Done#' of the adc buffer being read was read
+        self.bulk_buffer = array.array('B')  # reused for every bulk read, sized on the first read
         # make another thread to read the information endpoint of the device what will signal when an adc channel is
         # ready to export its data and what channel it is
         self.info_thread = ThreadedUSBInfo(device, self.adc_channel_queue,
@@ -360,7 +458,7 @@ class ThreadedUSBDataCollector(threading.Thread):
                     logging.debug("====== qsize: {0}".format(self.adc_channel_queue.qsize()))
                     # raise Exception
                 # tell the device to send the data
-                hold = self.adc_channel_queue.get()
+                hold, self.done_time = self.adc_channel_queue.get()
                 logging.debug('channel tracker: {0}, channel expected{1}'
                               .format(self.channel_tracker, hold))
                 if int(hold) != self.channel_tracker:
@@ -380,31 +478,70 @@ class ThreadedUSBDataCollector(threading.Thread):
         return 0
 
     def get_adc_buffer(self, endpoint=DATA_STREAM_ENDPOINT, number_packets=1):
-        """ Read an adc buffer from the device.
+        """ Read an adc buffer from the device with the read mode the thread was made with.
         :param endpoint: device endpoint to read, NOTE: the read endpoint needs to be format as
         0x8n where n is the endpoint point number
         :param number_packets: int, how many usb packet to read
         """
-        # logging.debug('getting adc channel with {0} inputs'.format(self.number_adc_channels))
-        packets_gotten = 0  # keep track of haw many packets have been retrieved
-        full_array = array.array('h')  # array to store data
-        # logging.debug('getting buffer')
-        while number_packets + 1 > packets_gotten:
-            # logging.debug('getting packet: {0}; len = {1}'.format(packets_gotten, len(full_array)))
-            data_packet = self.data_try(endpoint=endpoint)  # try to get a packet
-            # logging.info('full array len: {0}; {1}'.format(len(full_array), len(data_packet)))
-            if not data_packet:
+        if self.read_mode == 'bulk':
+            if self.get_adc_buffer_bulk(endpoint=endpoint, number_packets=number_packets):
+                self.bulk_failures = 0
                 return
+            self.read_mode = bulk_failed(self)
+        self.get_adc_buffer_packets(endpoint=endpoint, number_packets=number_packets)
 
-            full_array.extend(data_packet)  # add data to array
-            # the device should put a termination code at the end of the adc channel
-            if full_array[-1] == TERMINATION_CODE:
-                full_array.pop()  # remove the termination code and exit loop
-                break
-            # if len(full_array) == 2040:
-            #     break
-            packets_gotten += 1
-        self.data_queue.put(full_array)
+    def get_adc_buffer_bulk(self, endpoint=DATA_STREAM_ENDPOINT, number_packets=1):
+        """ Read an adc buffer from the device in one bulk transfer into bulk_buffer, then copy the adc counts
+        up to the termination code out of it and put them in the data queue
+        :param endpoint: device endpoint to read, NOTE: the read endpoint needs to be format as
+        0x8n where n is the endpoint point number
+        :param number_packets: int, how many usb packet to read
+        :return: True if the adc buffer was read, False if the bulk read failed
+        """
+        # the device can send 1 more packet than asked for, the termination code can be in that packet
+        read_size = (number_packets + 1) * USB_DATA_BYTE_SIZE
+        if len(self.bulk_buffer) != read_size:
+            self.bulk_buffer = array.array('B', bytes(read_size))
+        bytes_read = self.device.usb_read_into(self.bulk_buffer, endpoint=endpoint)
+        if not bytes_read:
+            return False
+        adc_counts = strip_termination(convert_uint8_to_signed_int16(self.bulk_buffer)[:bytes_read // 2])
+        # copy the adc counts out because bulk_buffer will be written over by the next read
+        self.put_adc_buffer(adc_counts.copy())
+        return True
+
+    def get_adc_buffer_packets(self, endpoint=DATA_STREAM_ENDPOINT, number_packets=1):
+        """ Read an adc buffer from the device one packet at a time.  Each packet is decoded in place and copied
+        once into a block allocated for the whole buffer.  A short packet is the end of the buffer, the block
+        (without the termination code at its end) is put in the data queue
+        :param endpoint: device endpoint to read, NOTE: the read endpoint needs to be format as
+        0x8n where n is the endpoint point number
+        :param number_packets: int, how many usb packet to read
+        """
+        # the device can send 1 more packet than asked for, the termination code can be in that packet
+        adc_buffer = np.empty((number_packets + 1) * USB_DATA_INT16_SIZE, dtype=np.int16)
+        buffer_end = 0  # where the next packet goes in adc_buffer
+        for _ in range(number_packets + 1):
+            data_packet = self.data_try(endpoint=endpoint)  # try to get a packet
+            if data_packet is None:
+                if ends_with_termination(adc_buffer[:buffer_end]):
+                    break  # the termination code ended a full packet and no short packet followed
+                return
+            packet_end = buffer_end + len(data_packet)
+            adc_buffer[buffer_end:packet_end] = data_packet
+            buffer_end = packet_end
+            if len(data_packet) < USB_DATA_INT16_SIZE:
+                break  # a short (or empty) packet is the end of the adc buffer
+        self.put_adc_buffer(strip_termination(adc_buffer[:buffer_end]))
+
+    def put_adc_buffer(self, adc_counts):
+        """ Time stamp an adc buffer in the device's clock_sync and put it in the data queue, an adc buffer read
+        without a 'Done#' message is not time stamped
+        :param adc_counts: numpy array of the adc counts read
+        """
+        if self.done_time is not None:
+            self.device.clock_sync.add_buffer(len(adc_counts), self.done_time)
+        self.data_queue.put(adc_counts)
         self.data_done.set()  # set adc channel loaded flag
 
     def data_try(self, endpoint=DATA_STREAM_ENDPOINT):
@@ -451,9 +588,11 @@ class ThreadedUSBInfo(threading.Thread):
                 # check if an adc channel has been finished by looking at the INFO_ENDPOINT,
                 # the timeout is long enough that this should hold here til the device responds
                 message = self.device.usb_read_info()
+                done_time = time.perf_counter()
                 logging.debug('got message: {0}'.format(message))
                 if message:
-                    self.adc_queue.put(chr(message[4]))  # put what channel the device should get
+                    # put what channel the device should get and when the device said it was done
+                    self.adc_queue.put((chr(message[4]), done_time))
                     self.adc_event.set()  # set flag so ThreadedUSBDataCollector knows to get the adc buffer channel
                     logging.debug('got info: {0}'.format(message))
                     # logging.debug('self.running: {0}'.format(self.running))
@@ -470,6 +609,312 @@ class ThreadedUSBInfo(threading.Thread):
         self.running = False
 
 
+class ThreadedUSBAcquisition(threading.Thread):
+    """ Pipelined replacement for ThreadedUSBDataCollector and ThreadedUSBInfo.  This thread reads the information
+    endpoint, requests the adc buffer the device says is ready and reads it in one transfer, without handing off to
+    another thread in between.  The raw bytes are passed to a decoding thread so the next 'Done#' can be read and
+    the next adc buffer requested while the last one is still being decoded.
+
+    The time from a 'Done#' message to the 'F#' request is the time the device's buffer sat waiting for the host,
+    it is summed in device_wait_time.  The time spent waiting on the information endpoint is summed in
+    host_wait_time.  The time each 'Done#' was read is passed on with the adc buffer to the device's clock_sync as
+    the host time the last sample of the buffer was taken.
+    """
+
+    def __init__(self, device, data_queue: queue.Queue, data_event: threading.Event, read_mode='bulk',
+                 number_packets=PACKETS_PER_CHANNEL, number_raw_buffers=RAW_BUFFERS_IN_PIPELINE):
+        """
+        :param device: PlantUSB to read from
+        :param data_queue: queue to put the decoded adc buffers in
+        :param data_event: event to signal the main thread the data is ready
+        :param read_mode: 'bulk' to read each adc buffer in 1 transfer, 'packet' to read it one usb packet at a time
+        :param number_packets: int, usb packets in an adc buffer
+        :param number_raw_buffers: int, how many adc buffers can be waiting to be decoded
+        """
+        threading.Thread.__init__(self)
+        self.device = device
+        self.data_queue = data_queue
+        self.data_done = data_event
+        self.read_mode = read_mode  # type: str
+        self.bulk_failures = 0  # bulk reads that failed in a row
+        self.number_packets = number_packets
+        self.running = True
+        self.channel_tracker = 0
+        # the device can send 1 more packet than asked for, the termination code can be in that packet
+        raw_buffer_size = (number_packets + 1) * USB_DATA_BYTE_SIZE
+        self.free_raw_buffers = queue.Queue()  # raw buffers the acquisition thread can read into
+        for _ in range(number_raw_buffers):
+            self.free_raw_buffers.put(array.array('B', bytes(raw_buffer_size)))
+        self.decode_queue = queue.Queue()  # raw buffers, and the number of bytes read, waiting to be decoded
+        self.decode_thread = threading.Thread(target=self.decode_loop)
+        # statistics of the pipeline
+        self.buffers_read = 0
+        self.failed_reads = 0
+        self.device_wait_time = 0.0  # s
+        self.host_wait_time = 0.0  # s
+
+    def run(self):
+        """ Start the decoding thread, then read adc buffers until told to stop """
+        self.decode_thread.start()
+        try:
+            self.acquisition_loop()
+        finally:
+            self.decode_queue.put(None)  # signal the decoding thread to finish
+            logging.info('acquisition stats: {0}'.format(self.stats()))
+
+    def acquisition_loop(self):
+        """ Read the 'Done#' message, request adc buffer # and read it, then pass the raw bytes on to be decoded
+        """
+        while True:
+            wait_start = time.perf_counter()
+            message = self.device.usb_read_info()
+            done_time = time.perf_counter()
+            if not self.running:
+                # dont request an ADC channel if read should be stopped, just send termination code to device
+                self.device.usb_write('E')  # 'E' is device symbol to stop the data reading
+                return
+            if not message:
+                continue  # timed out waiting for the device
+            self.host_wait_time += done_time - wait_start
+            adc_channel = chr(message[4])
+            if int(adc_channel) != self.channel_tracker:
+                logging.debug('channel tracker: {0}, expected: {1}'.format(self.channel_tracker, adc_channel))
+            self.channel_tracker = (int(adc_channel) + 1) % 4
+
+            raw_buffer = self.free_raw_buffers.get()
+            self.device.usb_write('F{0}'.format(adc_channel))  # 'F#' is device symbol to export # adc channel
+            self.device_wait_time += time.perf_counter() - done_time
+            bytes_read = self.read_raw_buffer(raw_buffer)
+            if bytes_read:
+                self.buffers_read += 1
+                self.decode_queue.put((raw_buffer, bytes_read, done_time))
+            else:
+                self.failed_reads += 1
+                self.free_raw_buffers.put(raw_buffer)
+
+    def read_raw_buffer(self, raw_buffer):
+        """ Read the bytes of an adc buffer into raw_buffer
+        :param raw_buffer: array.array('B') big enough for an adc buffer and the termination code
+        :return: int of the number of bytes read, or None if the read failed
+        """
+        if self.read_mode == 'bulk':
+            bytes_read = self.device.usb_read_into(raw_buffer)
+            if bytes_read:
+                self.bulk_failures = 0
+                return bytes_read
+            self.read_mode = bulk_failed(self)
+        bytes_read = 0
+        for _ in range(self.number_packets + 1):
+            usb_input = self.device.usb_read_data()
+            if usb_input is None:
+                if ends_with_termination(convert_uint8_to_signed_int16(raw_buffer)[:bytes_read // 2]):
+                    break  # the termination code ended a full packet and no short packet followed
+                return None
+            raw_buffer[bytes_read:bytes_read + len(usb_input)] = usb_input
+            bytes_read += len(usb_input)
+            if len(usb_input) < USB_DATA_BYTE_SIZE:
+                break  # a short (or empty) packet is the end of the adc buffer
+        return bytes_read or None
+
+    def decode_loop(self):
+        """ Decode the raw buffers the acquisition thread read, put the adc counts without the termination code at
+        their end in the data queue and give the raw buffer back to the acquisition thread """
+        while True:
+            raw_read = self.decode_queue.get()
+            if raw_read is None:
+                return
+            raw_buffer, bytes_read, done_time = raw_read
+            adc_counts = strip_termination(convert_uint8_to_signed_int16(raw_buffer)[:bytes_read // 2])
+            self.device.clock_sync.add_buffer(len(adc_counts), done_time)
+            if isinstance(self.data_queue, shared_ring_buffer.SharedRingBuffer):  # pass the fit on to the GUI process
+                self.data_queue.set_clock(self.device.clock_sync)
+            self.data_queue.put(adc_counts.copy())
+            self.free_raw_buffers.put(raw_buffer)
+            self.data_done.set()  # set adc channel loaded flag
+
+    def stop_running(self):
+        """ Set the flag that tells the thread to stop after the next 'Done#' message from the device """
+        self.running = False
+
+    def stats(self):
+        """ Get the statistics of the pipeline
+        :return: dict of the buffers read, failed reads, and the total and average time the device waited for the
+        host and the host waited for the device, in seconds
+        """
+        buffers_read = max(self.buffers_read, 1)
+        return {'buffers read': self.buffers_read,
+                'failed reads': self.failed_reads,
+                'device wait time': self.device_wait_time,
+                'device wait per buffer': self.device_wait_time / buffers_read,
+                'host wait time': self.host_wait_time,
+                'host wait per buffer': self.host_wait_time / buffers_read}
+
+
+class ProcessUSBAcquisition(object):
+    """ Run a ThreadedUSBAcquisition in a separate process so the usb reads do not share the GIL with the data
+    processing and plotting.  The adc buffers come back whole through a SharedRingBuffer, and messages written to
+    the device while the process runs are passed to it in command_queue because the process owns the usb device.
+    Only plain settings are passed to the process, it finds the device and makes its own PlantUSB, so it can be
+    started with the spawn start method as well as fork.  Has the same start, stop_running and join methods as the
+    threads.
+    """
+
+    def __init__(self, device, capacity=RING_BUFFER_SIZE):
+        """
+        :param device: PlantUSB that is starting the data stream
+        :param capacity: int, int16 words the shared ring buffer can hold
+        """
+        self.device = device
+        self.ring_buffer = shared_ring_buffer.SharedRingBuffer(capacity=capacity)
+        # fit of the host time each sample was taken at, copied from the acquisition process (see sync_clock)
+        self.clock_sync = clock_sync.ClockSync(device.number_channels, data_class.SAMPLE_RATE)
+        self.command_queue = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        # the usb backend can not be passed to another process, the process finds the device itself, or makes a
+        # simulated device with the same settings
+        simulated_settings = None if device.usb_backend is usb else dict(device.usb_backend.device_settings)
+        self.process = multiprocessing.Process(target=run_acquisition_process,
+                                               args=(self.ring_buffer.name, self.ring_buffer.lock, device.vendor_id,
+                                                     device.product_id, device.number_channels, self.command_queue,
+                                                     self.stop_event, simulated_settings))
+
+    def start(self):
+        """ Let go of the usb device in this process and start the acquisition process """
+        if self.device.usb_backend is usb:
+            usb.util.dispose_resources(self.device._device)
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def write(self, message):
+        """ Pass a message to the acquisition process to write to the device
+        :param message: str to write to the device
+        """
+        self.command_queue.put(message)
+
+    def stop_running(self):
+        """ Signal the acquisition process to stop the device and exit """
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def sync_clock(self):
+        """ Get the acquisition process's fit of the host time each sample was taken at from the shared ring buffer
+        :return: clock_sync.ClockSync with the fit of the adc buffers the process has read
+        """
+        self.clock_sync.buffers, self.clock_sync.first_time, self.clock_sync.fit = self.ring_buffer.get_clock()
+        return self.clock_sync
+
+    def stats(self):
+        """ Get the statistics of the shared ring buffer
+        :return: dict of the adc buffers dropped because the ring buffer was full and the adc counts not read yet
+        """
+        return {'overruns': self.ring_buffer.overruns,
+                'unread': self.ring_buffer.unread()}
+
+    def close(self):
+        """ Free the shared ring buffer, call after the data in it has been read """
+        self.ring_buffer.close()
+
+
+def run_acquisition_process(ring_buffer_name, ring_buffer_lock, vendor_id, product_id, number_channels,
+                            command_queue, stop_event, simulated_settings=None):
+    """ Target of the acquisition process made by ProcessUSBAcquisition.  Connects to the device, reads it with a
+    ThreadedUSBAcquisition into the shared ring buffer and writes the messages passed in command_queue to the
+    device until stop_event is set
+    :param ring_buffer_name: str, name of the SharedRingBuffer to write the adc counts to
+    :param ring_buffer_lock: multiprocessing.Lock of the SharedRingBuffer
+    :param vendor_id: hexadecimal of USB's vendor id
+    :param product_id: hexadecimal of USB's product id
+    :param number_channels: int, adc channels the device is set to read
+    :param command_queue: multiprocessing.Queue of messages to write to the device
+    :param stop_event: multiprocessing.Event that is set when the process should stop
+    :param simulated_settings: dict of the keyword arguments of a usb_mock.SimulatedUSBBackend to read a simulated
+    device, or None to use pyusb
+    """
+    ring_buffer = shared_ring_buffer.SharedRingBuffer(name=ring_buffer_name, lock=ring_buffer_lock)
+    if simulated_settings is None:
+        usb_backend = usb
+    else:
+        import usb_mock
+        usb_backend = usb_mock.SimulatedUSBBackend(**simulated_settings)
+    device = PlantUSB(None, vendor_id, product_id, usb_backend=usb_backend)
+    device.number_channels = number_channels
+    device.clock_sync.reset(number_channels)
+    device.usb_write('S{0}'.format(number_channels))  # a simulated device made here starts with 1 channel
+    acquisition = ThreadedUSBAcquisition(device, ring_buffer, threading.Event())
+    acquisition.start()
+    while not stop_event.is_set():
+        try:
+            device.usb_write(command_queue.get(timeout=0.05))
+        except queue.Empty:
+            pass
+    acquisition.stop_running()
+    acquisition.join()
+    logging.info('ring buffer overruns: {0}'.format(ring_buffer.overruns))
+    ring_buffer.close()
+
+
+def find_devices(usb_backend=usb, vendor_id=0x04B4, product_id=0x8051):
+    """ Find every connected device, to read several devices at once
+    :param usb_backend: module used to find the devices, the pyusb module or a usb_mock.SimulatedUSBBackend
+    :param vendor_id: hexadecimal of USB's vendor id
+    :param product_id: hexadecimal of USB's product id
+    :return: list of the USB devices, give each to a PlantUSB as usb_device
+    """
+    return list(usb_backend.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id))
+
+
+def stimulator_message(time, current, channel, polarity):
+    """ Make the message that sets the electrical stimulator, see PlantUSB.set_stimulator """
+    time_str = str(time).zfill(5)
+    current_str = str(current).zfill(3)
+    channel_str = str(channel)
+    if polarity == 'Sink':
+        polarity_str = 'n'
+    elif polarity == "Source":
+        polarity_str = 'p'
+    else:
+        raise Exception("wrong polarity entry")
+    return "s|{0}|{1}|{2}|{3}".format(current_str, time_str, polarity_str, channel_str)
+
+
+def bulk_failed(reader):
+    """ Count a failed bulk read of a thread that reads adc buffers, the adc buffer is then read by packet.  After
+    BULK_FAILURES_BEFORE_PACKETS failures in a row the thread switches to reading by packet
+    :param reader: ThreadedUSBDataCollector or ThreadedUSBAcquisition with read_mode and bulk_failures
+    :return: str, the read mode for the next adc buffer
+    """
+    reader.bulk_failures += 1
+    if reader.bulk_failures < BULK_FAILURES_BEFORE_PACKETS:
+        logging.info("Bulk read failed ({0} in a row), reading this adc buffer by packet"
+                     .format(reader.bulk_failures))
+        return 'bulk'
+    logging.warning("{0} bulk reads failed in a row, reading adc buffers by packet from now on"
+                    .format(reader.bulk_failures))
+    return 'packet'
+
+
+def ends_with_termination(adc_counts):
+    """ Check if the adc counts read end with the termination code the device puts after an adc buffer.  The
+    termination code is only the end of the buffer as the last adc count of a transfer, the same value anywhere
+    else is an adc count
+    :param adc_counts: numpy array of signed int16 read from the device
+    :return: bool
+    """
+    return len(adc_counts) > 0 and adc_counts[-1] == TERMINATION_CODE
+
+
+def strip_termination(adc_counts):
+    """ Remove the termination code from the end of the adc counts read, if it is there
+    :param adc_counts: numpy array of signed int16 read from the device
+    :return: numpy array of the adc counts without the termination code
+    """
+    return adc_counts[:-1] if ends_with_termination(adc_counts) else adc_counts
+
+
 def convert_uint8_uint16(_array):
     """ Convert an array of uint8 to uint16
     :param _array: list of uint8 array of data to convert
@@ -487,18 +932,21 @@ def convert_uint8_uint16(_array):
 
 
 def convert_uint8_to_signed_int16(_bytes):
-    """ Convert an array of bytes into an array of signed int16
+    """ Convert an array of bytes into an array of signed int16.  The bytes are not copied, the array
+    returned is a view of the same memory
     :param _bytes: array of uint8
-    :return: array of signed int16
+    :return: numpy array of signed int16
     """
     """  below takes 7 msecs
     length = int(len(_bytes) / 2)
     hold = (ctypes.c_short * length).from_buffer_copy(_bytes)
     return list(hold)
     """
-    # below takes 6-11msec
+    """ below takes 6-11msec
     length = int(len(_bytes) / 2)
     return array.array('h', (ctypes.c_short * length).from_buffer_copy(_bytes))
+    """
+    return np.frombuffer(_bytes, dtype=USB_INT16_FORMAT, count=len(_bytes) // 2)
 
 
 def convert_uint8_to_string(_bytes):
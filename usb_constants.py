@@ -5,6 +5,8 @@ OUT_ENDPOINT = 2
 DATA_STREAM_ENDPOINT = 0x83
 USB_INFO_BYTES_SIZE = 5
 USB_DATA_BYTE_SIZE = 64
+USB_DATA_INT16_SIZE = USB_DATA_BYTE_SIZE // 2  # adc counts in a full data packet
+USB_INT16_FORMAT = '<i2'  # the device sends the adc counts as little endian signed int16
 USB_TERMINATION_SIGNAL = 255 * 257
 USB_OUT_BYTE_SIZE = 32
 TEST_MESSAGE = "USB Test"
@@ -19,5 +21,7 @@ MAX_ADC_VOLTAGE = 2048
 
 ADC_CHANNEL_DATA_SIZE = 4082
 PACKETS_PER_CHANNEL = 64  # 2402 bytes / 64 bytes per packet
+RAW_BUFFERS_IN_PIPELINE = 4  # adc buffers that can be read but not decoded yet
+BULK_FAILURES_BEFORE_PACKETS = 3  # bulk reads that fail in a row before only reading by packet
 
 CALIBRATION_RANGE = 80  # mV
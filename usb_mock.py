@@ -1,23 +1,242 @@
+# Copyright (c) 2015-2017 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+# Licensed under the Creative Commons Attribution-ShareAlike  3.0 (CC BY-SA 3.0 US) License
+
+""" Simulated PSoC data acquisition device to run usb_comm.py without the hardware.  SimulatedUSBBackend
+stands in for the pyusb module, pass it to PlantUSB as usb_backend and usb_backend.core.find will return a
+SimulatedPSoC that follows the same protocol as the device firmware:
+
+OUT_ENDPOINT takes 'I' (identify), 'R' (start reading), 'S#' (number of adc channels), 'F#' (export adc
+buffer #), 'E' (stop reading) and 'V####' (offset voltage DAC setting), other messages are recorded and ignored
+
+INFO_IN_ENDPOINT sends 'Done#' when adc buffer # is full and ready to be exported
+
+DATA_STREAM_ENDPOINT sends the identification message after an 'I' and the adc counts of a buffer, in 64 byte
+packets ended with TERMINATION_CODE, after an 'F#'
+
+The adc buffers fill at sample_rate * number of channels adc counts per second, times speed to run faster
+than real time.  The device has ADC_BUFFERS_IN_DEVICE buffers, if the host does not export a buffer before
+the device needs it again the old data is written over and counted in overruns
+"""
+# standard libraries
+import array
+import threading
+import time
+# installed libraries
+import numpy as np
+# local files
+from usb_constants import *
+
 __author__ = 'Kyle Vitautas Lopin'
 
+ADC_BUFFERS_IN_DEVICE = 4
+DEFAULT_TIMEOUT = 1000  # ms, same as pyusb
+
+
+class USBTimeoutError(Exception):
+    """ Raised when a read of the simulated device times out, like pyusb's USBTimeoutError """
+    pass
+
+
+class SimulatedUSBBackend(object):
+    """ Stands in for the pyusb module, only the core.find part is used by usb_comm.py """
+    def __init__(self, number_devices=1, **device_settings):
+        """
+        :param number_devices: int, how many simulated devices are "plugged in"
+        :param device_settings: keyword arguments passed to each SimulatedPSoC
+        """
+        self.device_settings = device_settings  # so another process can make the same simulated device
+        self.devices = [SimulatedPSoC(**device_settings) for _ in range(number_devices)]
+        self.core = SimulatedCore(self)
+
 
-class usb2(object):
-    def __init__(self):
-        print('init usb')
-        self.core = object()
-        self.core.find = find_mock()
-    def core(object):
-        def find(self, *args):
-            print('finding')
-            return 1
+class SimulatedCore(object):
+    def __init__(self, backend: SimulatedUSBBackend):
+        self.backend = backend
 
-def find_mock():
-    print('finding2')
-    return 1
+    def find(self, find_all=False, idVendor=None, idProduct=None):
+        """ Same call as usb.core.find
+        :return: first SimulatedPSoC, or a list of all of them if find_all is True
+        """
+        if find_all:
+            return list(self.backend.devices)
+        return self.backend.devices[0] if self.backend.devices else None
 
 
-class core(object):
-    def __init__(self):
+class SimulatedPSoC(object):
+    """ pyusb like device that simulates the timing and protocol of the PSoC data acquisition device """
+
+    def __init__(self, sample_rate=5000.0, number_channels=1, speed=1.0, jitter=0.0, packet_loss=0.0,
+                 buffer_size=ADC_CHANNEL_DATA_SIZE // 2, seed=None, write_time=0.0):
+        """
+        :param sample_rate: float, Hz, samples per second of each adc channel
+        :param number_channels: int, number of adc channels being read until an 'S#' is sent
+        :param speed: float, how many times faster than real time to fill the adc buffers
+        :param jitter: float, seconds, standard deviation of the extra delay before a 'Done#' is sent
+        :param packet_loss: float, 0 to 1, chance that each usb data packet is lost
+        :param buffer_size: int, adc counts in an adc buffer
+        :param seed: int, seed for the signal, jitter and packet loss random numbers
+        :param write_time: float, seconds each write to the OUT_ENDPOINT takes, writes from different threads
+        wait for each other like usb transfers to the same endpoint
+        """
+        self.sample_rate = sample_rate
+        self.number_channels = number_channels
+        self.speed = speed
+        self.jitter = jitter
+        self.packet_loss = packet_loss
+        self.write_time = write_time
+        self.write_lock = threading.Lock()  # held for write_time by each write
+        self.buffer_size = buffer_size
+        self.random_state = np.random.RandomState(seed)
+        self.vdac_setting = 0
+        self.other_messages = []  # messages written to the device that it does not simulate
+        self.lock = threading.Condition()
+        self.reading = False
+        self.start_time = 0
+        self.buffers_filled = 0  # buffers the device has filled since the last 'R'
+        self.buffers_reported = 0  # buffers the device has sent a 'Done#' for
+        self.buffers_exported = 0
+        self.overruns = 0  # buffers that were written over before they were exported
+        self.packets_lost = 0
+        self.device_buffers = [None] * ADC_BUFFERS_IN_DEVICE
+        self.data_to_send = b''
+        self.send_ptr = 0
+
+    def set_configuration(self):
         pass
-    def find(idVendor=None, idProduct=None):
-        print('wtf')
+
+    def write(self, endpoint, message, timeout=None):
+        """ Handle a message written to the OUT_ENDPOINT of the device
+        :param endpoint: should be OUT_ENDPOINT
+        :param message: str or bytes
+        :return: int, number of bytes written
+        """
+        if isinstance(message, (bytes, bytearray)):
+            message = message.decode()
+        if self.write_time:
+            with self.write_lock:
+                time.sleep(self.write_time)
+        with self.lock:
+            if message == 'I':
+                self._set_data_to_send(RECIEVED_TEST_MESSAGE)
+            elif message == 'R':
+                self.reading = True
+                self.start_time = time.perf_counter()
+                self.buffers_filled = self.buffers_reported = self.buffers_exported = 0
+                self.overruns = self.packets_lost = 0
+            elif message == 'E':
+                self.reading = False
+            elif message.startswith('S'):
+                self.number_channels = int(message[1:])
+            elif message.startswith('V'):
+                self.vdac_setting = int(message[1:])
+            elif message.startswith('F'):
+                self._export_buffer(int(message[1:]))
+            else:
+                self.other_messages.append(message)
+            self.lock.notify_all()
+        return len(message)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        """ Read an IN endpoint of the device, the same as pyusb if size_or_buffer is an array the bytes are put
+        into it and the number of bytes read is returned, else an array of the bytes read is returned
+        :param endpoint: INFO_IN_ENDPOINT or DATA_STREAM_ENDPOINT
+        :param size_or_buffer: int of the most bytes to read or array.array('B') to read into
+        :param timeout: int, ms to wait for the device to respond
+        """
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        if isinstance(size_or_buffer, array.array):
+            size = len(size_or_buffer)
+        else:
+            size = size_or_buffer
+        if endpoint == INFO_IN_ENDPOINT:
+            usb_input = self._read_info(timeout)
+        else:
+            usb_input = self._read_data(size, timeout)
+        if isinstance(size_or_buffer, array.array):
+            size_or_buffer[:len(usb_input)] = array.array('B', usb_input)
+            return len(usb_input)
+        return array.array('B', usb_input)
+
+    def buffer_done_time(self, buffer_number):
+        """ Time, on the time.perf_counter clock, that an adc buffer is filled
+        :param buffer_number: int, number of buffers filled since the last 'R'
+        """
+        counts_per_second = self.sample_rate * self.number_channels * self.speed
+        return self.start_time + (buffer_number + 1) * self.buffer_size / counts_per_second
+
+    def _read_info(self, timeout):
+        deadline = time.perf_counter() + timeout / 1000.
+        with self.lock:
+            while True:
+                now = time.perf_counter()
+                if self.reading:
+                    self._fill_buffers(now)
+                    if self.buffers_reported < self.buffers_filled:
+                        break
+                    wait_time = self.buffer_done_time(self.buffers_reported) - now
+                else:
+                    wait_time = deadline - now
+                if now >= deadline:
+                    raise USBTimeoutError("[Errno 110] Operation timed out")
+                self.lock.wait(min(wait_time, deadline - now))
+            # only the newest ADC_BUFFERS_IN_DEVICE buffers are still in the device
+            self.buffers_reported = max(self.buffers_reported, self.buffers_filled - ADC_BUFFERS_IN_DEVICE)
+            buffer_number = self.buffers_reported % ADC_BUFFERS_IN_DEVICE
+            self.buffers_reported += 1
+        if self.jitter:
+            time.sleep(abs(self.random_state.normal(0, self.jitter)))
+        return 'Done{0}'.format(buffer_number).encode()
+
+    def _read_data(self, size, timeout):
+        deadline = time.perf_counter() + timeout / 1000.
+        with self.lock:
+            while self.send_ptr >= len(self.data_to_send):
+                wait_time = deadline - time.perf_counter()
+                if wait_time <= 0:
+                    raise USBTimeoutError("[Errno 110] Operation timed out")
+                self.lock.wait(wait_time)
+            # a bulk transfer ends at the end of the data, which is a short usb packet
+            usb_input = self.data_to_send[self.send_ptr:self.send_ptr + size]
+            self.send_ptr += len(usb_input)
+        return usb_input
+
+    def _fill_buffers(self, now):
+        """ Make the adc counts of every buffer that has been filled by the time now, a buffer that has not
+        been exported yet is written over """
+        while self.buffer_done_time(self.buffers_filled) <= now:
+            buffer_number = self.buffers_filled % ADC_BUFFERS_IN_DEVICE
+            if self.device_buffers[buffer_number] is not None:
+                self.overruns += 1
+            self.device_buffers[buffer_number] = self._make_adc_counts(self.buffers_filled)
+            self.buffers_filled += 1
+
+    def _make_adc_counts(self, buffer_number):
+        """ Make a buffer of interleaved adc counts, each channel is a slow sine wave plus noise and the
+        sample index is continuous between buffers """
+        start = buffer_number * self.buffer_size
+        count_index = np.arange(start, start + self.buffer_size)
+        channel = count_index % self.number_channels
+        sample_time = (count_index // self.number_channels) / self.sample_rate
+        signal = 2000 * np.sin(2 * np.pi * (channel + 1) * sample_time)
+        signal += self.random_state.normal(0, 50, self.buffer_size)
+        return np.clip(signal, -MAX_ADC_COUNTS // 2, MAX_ADC_COUNTS // 2 - 1).astype(USB_INT16_FORMAT)
+
+    def _export_buffer(self, buffer_number):
+        adc_counts = self.device_buffers[buffer_number]
+        self.device_buffers[buffer_number] = None
+        if adc_counts is None:  # the buffer was already exported or never filled, send only the termination code
+            adc_counts = np.empty(0, dtype=USB_INT16_FORMAT)
+        else:
+            self.buffers_exported += 1
+        usb_data = np.append(adc_counts, np.array(TERMINATION_CODE, dtype=USB_INT16_FORMAT)).tobytes()
+        if self.packet_loss:
+            packets = [usb_data[i:i + USB_DATA_BYTE_SIZE] for i in range(0, len(usb_data), USB_DATA_BYTE_SIZE)]
+            kept = self.random_state.random_sample(len(packets)) >= self.packet_loss
+            self.packets_lost += len(packets) - int(kept.sum())
+            usb_data = b''.join(packet for packet, keep in zip(packets, kept) if keep)
+        self._set_data_to_send(usb_data)
+
+    def _set_data_to_send(self, usb_data):
+        self.data_to_send = usb_data
+        self.send_ptr = 0